@@ -0,0 +1,150 @@
+"""
+Compare the I/O path of XenBusTransportGPLPV (a reader thread filling a ring
+buffer with overlapped reads, and writes made without copying) with the
+previous implementation (a blocking ReadFile per header & payload with the
+chunks joined into a new string, and a copy of the remaining data for every
+partial write).
+
+The GPLPV device is replaced by a temporary file opened with CreateFile so
+this benchmark only needs pywin32, not the GPLPV drivers. The file is filled
+with WATCH_EVENT packets because the transport drops replies to requests it
+has not sent. For each variant the throughput & peak memory traced by
+tracemalloc are printed.
+
+Usage: python benchmarks/gplpv_io.py [--packets N] [--payload BYTES]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import mock
+from win32file import CreateFile, CloseHandle, ReadFile, WriteFile
+from win32file import (
+    FILE_GENERIC_READ, FILE_GENERIC_WRITE, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
+)
+
+from pyxs._internal import Op, Packet
+
+from win_pyxs.gplpv import XenBusTransportGPLPV
+
+
+def _legacy_recv(handle, size):
+    chunks = []
+    while size:
+        (err, read) = ReadFile(handle, size, None)
+        if err:
+            raise OSError(err)
+
+        chunks.append(read)
+        size -= len(read)
+
+    return b"".join(chunks)
+
+
+def _legacy_send(handle, data):
+    size = len(data)
+    while size:
+        err, lwrite = WriteFile(handle, data[-size:], None)
+        if err:
+            raise OSError(err)
+
+        size -= lwrite
+
+
+def _bench_legacy_recv(path, packets):
+    handle = CreateFile(
+        path, FILE_GENERIC_READ, 0, None, OPEN_EXISTING,
+        FILE_ATTRIBUTE_NORMAL, None
+    )
+    try:
+        header_size = Packet._struct.size
+        for _ in range(packets):
+            header = _legacy_recv(handle, header_size)
+            _legacy_recv(handle, Packet._struct.unpack(header)[3])
+    finally:
+        CloseHandle(handle)
+
+
+def _bench_legacy_send(path, packets, data):
+    handle = CreateFile(
+        path, FILE_GENERIC_WRITE, 0, None, OPEN_EXISTING,
+        FILE_ATTRIBUTE_NORMAL, None
+    )
+    try:
+        for _ in range(packets):
+            _legacy_send(handle, data[:16])
+            _legacy_send(handle, data[16:])
+    finally:
+        CloseHandle(handle)
+
+
+def _open(path):
+    with mock.patch.object(
+        XenBusTransportGPLPV, '_get_device_path', return_value=path
+    ), mock.patch('win_pyxs.gplpv._WIN_DEVICE_PATH', None):
+        return XenBusTransportGPLPV()
+
+
+def _bench_recv(path, packets):
+    transport = _open(path)
+    try:
+        for _ in range(packets):
+            transport.recv_packet()
+    finally:
+        transport.close()
+
+
+def _bench_send(path, packets, data):
+    transport = _open(path)
+    try:
+        for _ in range(packets):
+            transport.send(data)
+    finally:
+        transport.close()
+
+
+def _measure(name, func, *args):
+    tracemalloc.start()
+    started = time.time()
+    func(*args)
+    elapsed = time.time() - started
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{0:<16} {1:>10.0f} packets/s {2:>10} bytes peak'.format(
+        name, args[1] / elapsed, peak
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--payload', type=int, default=4096)
+    args = parser.parse_args()
+
+    packet = Packet(Op.WATCH_EVENT, b'n' * args.payload, 0)
+    data = Packet._struct.pack(
+        packet.op, packet.rq_id, packet.tx_id, packet.size
+    ) + packet.payload
+
+    handle, path = tempfile.mkstemp(prefix='win_pyxs-bench-')
+    with os.fdopen(handle, 'wb') as device:
+        for _ in range(args.packets):
+            device.write(data)
+
+    try:
+        _measure('legacy recv', _bench_legacy_recv, path, args.packets)
+        _measure('ring recv', _bench_recv, path, args.packets)
+        _measure('legacy send', _bench_legacy_send, path, args.packets, data)
+        _measure('overlapped send', _bench_send, path, args.packets, data)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
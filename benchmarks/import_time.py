@@ -0,0 +1,155 @@
+"""
+Measure the time taken to import win_pyxs using python -X importtime.
+
+Stub versions of the Windows-only modules (pythoncom, win32file & wmi) are
+put first on the path so the benchmark runs anywhere & each stub can be
+given an artificial import cost to stand in for the real module. Three
+statements are timed in a fresh interpreter:
+
+    import win_pyxs
+    from win_pyxs import XenBusConnectionWinPV
+    from win_pyxs import XenBusConnectionGPLPV
+
+For each the cumulative import time of the win_pyxs modules is reported
+along with any heavy modules which were imported. The run fails (exit
+status 1) if import win_pyxs loads any heavy module, or if its import time
+exceeds --max-ms.
+
+Usage: python benchmarks/import_time.py [--stub-cost MS] [--runs N]
+                                        [--max-ms MS]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Modules which should only be imported when a connection is used
+HEAVY_MODULES = (
+    'ctypes', 'ctypes.wintypes', 'pythoncom', 'win32file', 'wmi',
+    'win_pyxs.gplpv', 'win_pyxs.winpv',
+)
+
+STATEMENTS = (
+    'import win_pyxs',
+    'from win_pyxs import XenBusConnectionWinPV',
+    'from win_pyxs import XenBusConnectionGPLPV',
+)
+
+_STUB = '''
+import time
+time.sleep({cost})
+{body}
+'''
+
+_STUB_BODIES = {
+    'pythoncom': 'CoInitialize = CoUninitialize = lambda: None',
+    'win32file': (
+        'CreateFile = CloseHandle = None\n'
+        'FILE_GENERIC_READ = FILE_GENERIC_WRITE = OPEN_EXISTING = 0\n'
+        'FILE_ATTRIBUTE_NORMAL = FILE_FLAG_OVERLAPPED = 0'
+    ),
+    'wmi': 'class x_wmi(Exception):\n    pass',
+}
+
+
+def write_stubs(directory, cost_ms):
+    for name, body in _STUB_BODIES.items():
+        with open(os.path.join(directory, name + '.py'), 'w') as stub:
+            stub.write(_STUB.format(cost=cost_ms / 1000.0, body=body))
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of -X importtime. Returns a dict of module name ->
+    cumulative import time in microseconds & the total time of the
+    top-level imports made after interpreter startup (i.e. by the
+    statement being measured).
+    """
+    times, total, started = {}, 0, False
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+
+        # Nested imports are indented beneath the module importing them
+        top_level = not name[1:].startswith(' ')
+        if top_level and name.strip() == 'site':
+            started = True
+        elif started and top_level:
+            total += int(cumulative)
+    return times, total
+
+
+def measure(statement, stubs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [stubs, ROOT] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stderr=subprocess.PIPE, env=env, universal_newlines=True
+    )
+    _stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError('{0!r} failed:\n{1}'.format(statement, stderr))
+    return parse_importtime(stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--stub-cost', type=float, default=20.0,
+        help='Artificial import time of each stub module in milliseconds'
+    )
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument(
+        '--max-ms', type=float, default=None,
+        help='Fail if import win_pyxs takes longer than this'
+    )
+    args = parser.parse_args()
+
+    stubs = tempfile.mkdtemp(prefix='win_pyxs-stubs-')
+    failures = []
+    try:
+        write_stubs(stubs, args.stub_cost)
+        for statement in STATEMENTS:
+            runs = [measure(statement, stubs) for _ in range(args.runs)]
+            best = min(total for _times, total in runs) / 1000.0
+            heavy = sorted(
+                name for name in HEAVY_MODULES if name in runs[0][0]
+            )
+            print('{0:<46} {1:>8.2f} ms  heavy: {2}'.format(
+                statement, best, ', '.join(heavy) or '-'
+            ))
+
+            if statement == STATEMENTS[0]:
+                if heavy:
+                    failures.append(
+                        'import win_pyxs loaded ' + ', '.join(heavy)
+                    )
+                if args.max_ms is not None and best > args.max_ms:
+                    failures.append(
+                        'import win_pyxs took {0:.2f} ms (max {1} ms)'.format(
+                            best, args.max_ms
+                        )
+                    )
+    finally:
+        shutil.rmtree(stubs)
+
+    for failure in failures:
+        print('FAIL', failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
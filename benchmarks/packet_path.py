@@ -0,0 +1,109 @@
+"""
+Measure the packet path of XenBusConnectionWinPV (send(), the queue of
+responses & recv()) against the in-process simulator, without a Router so
+that the cost of the connection itself is what is measured.
+
+    roundtrip   send() of a READ followed by recv() of its reply
+    burst       send() of --burst READs followed by recv() of every reply,
+                reported per reply
+
+For each the throughput & the memory traced by tracemalloc are printed: the
+peak per round trip & the memory (bytes & blocks) held per queued reply
+while a burst is waiting to be received.
+
+Usage: python benchmarks/packet_path.py [--iterations N] [--burst N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+import tracemalloc
+
+from pyxs._internal import Op, Packet
+
+from win_pyxs.simulator import Simulator
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _connection():
+    from win_pyxs import XenBusConnectionWinPV
+
+    connection = XenBusConnectionWinPV()
+    connection.connect()
+    return connection
+
+
+def bench_roundtrip(connection, iterations):
+    request = Packet(Op.READ, b'data/key\x00', 1)
+    for _ in range(100):
+        connection.send(request)
+        connection.recv()
+
+    tracemalloc.start()
+    started = _clock()
+    for _ in range(iterations):
+        connection.send(request)
+        connection.recv()
+    elapsed = _clock() - started
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'ops_per_sec': iterations / elapsed, 'peak_bytes': peak}
+
+
+def bench_burst(connection, replies):
+    requests = [
+        Packet(Op.READ, b'data/key\x00', rq_id) for rq_id in range(replies)
+    ]
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    started = _clock()
+    for request in requests:
+        connection.send(request)
+    sent = _clock()
+    queued = tracemalloc.take_snapshot().compare_to(before, 'filename')
+    for _ in requests:
+        connection.recv()
+    elapsed = _clock() - started
+    tracemalloc.stop()
+
+    return {
+        'ops_per_sec': replies / elapsed,
+        'send_per_sec': replies / (sent - started),
+        'bytes_per_reply': sum(stat.size_diff for stat in queued) / replies,
+        'blocks_per_reply': sum(stat.count_diff for stat in queued) / replies,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--burst', type=int, default=20000)
+    args = parser.parse_args()
+
+    with Simulator() as simulator:
+        simulator.store.write('data/key', 'value')
+        connection = _connection()
+        try:
+            roundtrip = bench_roundtrip(connection, args.iterations)
+            burst = bench_burst(connection, args.burst)
+        finally:
+            connection.close()
+
+    print('roundtrip  {0:>10.0f} ops/s  peak {1:>8.0f} B'.format(
+        roundtrip['ops_per_sec'], roundtrip['peak_bytes']
+    ))
+    print(
+        'burst      {0:>10.0f} ops/s  send {1:>10.0f} ops/s  '
+        '{2:>6.1f} B & {3:>4.2f} blocks per queued reply'.format(
+            burst['ops_per_sec'], burst['send_per_sec'],
+            burst['bytes_per_reply'], burst['blocks_per_reply']
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
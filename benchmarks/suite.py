@@ -0,0 +1,346 @@
+"""
+Benchmark XenBusConnectionWinPV & XenBusConnectionGPLPV against the
+in-process xenstore simulator (win_pyxs.simulator) so that they can be run
+without a Windows guest.
+
+Each benchmark times individual operations made through a pyxs.Client and
+reports the number of operations per second along with the p50 & p99
+latency. The benchmarks are:
+
+    <backend>.read             read of a short value
+    <backend>.write            write of a short value
+    <backend>.directory_<N>    listing of a node with N children (10, 1000 &
+                               100000 by default). Listings which do not fit
+                               in a single xenstore packet are refused with
+                               E2BIG (as xenstored does) so the 100000 case
+                               measures the cost of the refusal.
+    <backend>.connect_close    a connect() & close() cycle
+    <backend>.large_read       read of a value filling a whole packet
+    <backend>.large_write      write of a value filling a whole packet
+
+The results can be saved as JSON with --save & compared against a saved
+baseline with --compare. The comparison fails (exit status 1) when the
+ops/sec of a benchmark falls, or its p99 latency rises, by more than
+--threshold (a fraction of the baseline). --metric limits the comparison
+to the given metrics (ops_per_sec is much less noisy than p99 on shared
+machines).
+
+CI (see .github/workflows/test.yml) uploads its results as the
+benchmark-results artifact & compares them against benchmarks/baseline.json
+when that file exists. The baseline must come from that artifact, since
+numbers from another machine or OS are not comparable: commit it as
+benchmarks/baseline.json to turn the comparison on & replace it when the
+runners change or a change is expected to alter the results.
+
+win_pyxs must be importable, i.e. installed (pip install -e .) or on
+PYTHONPATH.
+
+Usage: python benchmarks/suite.py [--filter TEXT] [--save FILE]
+                                  [--compare FILE] [--threshold FRACTION]
+                                  [--metric NAME]
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import sys
+import time
+
+import pyxs
+
+from win_pyxs.simulator import Faults, Simulator
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#: The metrics compared against a baseline & whether higher is better
+TRACKED_METRICS = {
+    'ops_per_sec': True,
+    'p99': False,
+}
+
+#: The length of value which fills a packet once the path is included
+LARGE_VALUE_SIZE = 4000
+
+DIRECTORY_SIZES = (10, 1000, 100000)
+
+
+def percentile(samples, fraction):
+    """
+    Return the nearest-rank percentile of a sorted list of samples.
+    """
+    if not samples:
+        return 0.0
+    index = int(round(fraction * (len(samples) - 1)))
+    return samples[index]
+
+
+def summarise(latencies, elapsed, payload_bytes=0):
+    """
+    Turn the per-operation latencies (in seconds) of a benchmark into the
+    reported metrics.
+    """
+    latencies = sorted(latencies)
+    result = {
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+    if payload_bytes:
+        result['bytes_per_sec'] = \
+            payload_bytes * len(latencies) / elapsed if elapsed else 0.0
+    return result
+
+
+def _time(operation, iterations, warmup=10):
+    for _ in range(min(warmup, iterations)):
+        operation()
+
+    latencies = []
+    started = _clock()
+    for _ in range(iterations):
+        op_started = _clock()
+        operation()
+        latencies.append(_clock() - op_started)
+
+    return latencies, _clock() - started
+
+
+def _connections():
+    # Imported here as the simulator must be installed first on platforms
+    # without pywin32 & WMI
+    from win_pyxs import XenBusConnectionGPLPV, XenBusConnectionWinPV
+
+    return {
+        'winpv': XenBusConnectionWinPV,
+        'gplpv': XenBusConnectionGPLPV,
+    }
+
+
+def _client(connection_class):
+    return pyxs.Client(router=pyxs.Router(connection_class()))
+
+
+def _expect_error(code, func, *args):
+    try:
+        func(*args)
+    except pyxs.PyXSError as exc:
+        if exc.args[0] != code:
+            raise
+    else:
+        raise AssertionError('Expected error {0}'.format(code))
+
+
+def bench_read(simulator, connection_class, iterations):
+    simulator.store.write('data/read', 'value')
+    with _client(connection_class) as client:
+        return _time(lambda: client.read(b'data/read'), iterations), 0
+
+
+def bench_write(simulator, connection_class, iterations):
+    with _client(connection_class) as client:
+        return _time(
+            lambda: client.write(b'data/write', b'value'), iterations
+        ), 0
+
+
+def bench_large_read(simulator, connection_class, iterations):
+    simulator.store.write('data/large', 'v' * LARGE_VALUE_SIZE)
+    with _client(connection_class) as client:
+        return _time(
+            lambda: client.read(b'data/large'), iterations
+        ), LARGE_VALUE_SIZE
+
+
+def bench_large_write(simulator, connection_class, iterations):
+    value = b'v' * LARGE_VALUE_SIZE
+    with _client(connection_class) as client:
+        return _time(
+            lambda: client.write(b'data/large', value), iterations
+        ), LARGE_VALUE_SIZE
+
+
+def bench_connect_close(simulator, connection_class, iterations):
+    def _cycle():
+        client = _client(connection_class)
+        client.connect()
+        client.close()
+
+    return _time(_cycle, iterations), 0
+
+
+def bench_directory(size):
+    path = 'data/dir{0}'.format(size)
+
+    def _bench(simulator, connection_class, iterations):
+        if not simulator.store.exists(path):
+            for index in range(size):
+                simulator.store.write('{0}/{1}'.format(path, index), '')
+
+        with _client(connection_class) as client:
+            try:
+                client.list(path.encode('ascii'))
+                operation = lambda: client.list(path.encode('ascii'))
+            except pyxs.PyXSError as exc:
+                if exc.args[0] != errno.E2BIG:
+                    raise
+                operation = lambda: _expect_error(
+                    errno.E2BIG, client.list, path.encode('ascii')
+                )
+            return _time(operation, iterations), 0
+
+    return _bench
+
+
+def benchmarks(iterations):
+    """
+    Return a list of (name, function, iterations) for every benchmark.
+    """
+    cases = [
+        ('read', bench_read, iterations),
+        ('write', bench_write, iterations),
+        ('large_read', bench_large_read, iterations),
+        ('large_write', bench_large_write, iterations),
+        ('connect_close', bench_connect_close, max(iterations // 10, 1)),
+    ]
+    for size in DIRECTORY_SIZES:
+        cases.append((
+            'directory_{0}'.format(size), bench_directory(size),
+            max(iterations // max(size // 100, 1), 5)
+        ))
+
+    return [
+        ('{0}.{1}'.format(backend, name), func, count)
+        for backend in ('winpv', 'gplpv')
+        for name, func, count in cases
+    ]
+
+
+def run(names=None, iterations=2000, latency=0.0, jitter=0.0, output=None):
+    """
+    Run the benchmarks whose names contain one of the given strings (all of
+    them if names is empty) & return a dict of name -> metrics.
+    """
+    output = output or sys.stdout
+    results = {}
+    faults = dict(latency=latency, jitter=jitter, seed=1)
+
+    with Simulator(
+        wmi_faults=Faults(**faults), device_faults=Faults(**faults)
+    ) as simulator:
+        connections = _connections()
+        for name, func, count in benchmarks(iterations):
+            if names and not any(text in name for text in names):
+                continue
+
+            backend = name.split('.')[0]
+            (latencies, elapsed), payload_bytes = func(
+                simulator, connections[backend], count
+            )
+            results[name] = summarise(latencies, elapsed, payload_bytes)
+            print(format_result(name, results[name]), file=output)
+
+    return results
+
+
+def format_result(name, result):
+    line = '{0:<28} {1:>10.0f} ops/s  p50 {2:>9.1f}us  p99 {3:>9.1f}us'.format(
+        name, result['ops_per_sec'], result['p50'] * 1e6, result['p99'] * 1e6
+    )
+    if 'bytes_per_sec' in result:
+        line += '  {0:>8.2f} MB/s'.format(result['bytes_per_sec'] / 1e6)
+    return line
+
+
+def compare(results, baseline, threshold, metrics=None):
+    """
+    Compare results with a baseline & return a list of messages describing
+    every tracked metric (or only those in metrics) which regressed by more
+    than threshold.
+    """
+    tracked = dict(
+        (metric, higher_is_better)
+        for metric, higher_is_better in TRACKED_METRICS.items()
+        if not metrics or metric in metrics
+    )
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        for metric, higher_is_better in sorted(tracked.items()):
+            old, new = baseline[name].get(metric), results[name].get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) / old
+            if higher_is_better:
+                change = -change
+
+            if change > threshold:
+                regressions.append(
+                    '{0} {1}: {2:.6g} -> {3:.6g} ({4:+.1%})'.format(
+                        name, metric, old, new, change
+                    )
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--filter', action='append', default=[],
+        help='Only run benchmarks whose name contains this (repeatable)'
+    )
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Simulated latency of each backend call in seconds'
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Maximum extra simulated latency in seconds'
+    )
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument(
+        '--compare', help='Compare the results with this JSON baseline'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Allowed regression as a fraction of the baseline'
+    )
+    parser.add_argument(
+        '--metric', action='append', default=[],
+        choices=sorted(TRACKED_METRICS),
+        help='Only compare this metric (repeatable)'
+    )
+    args = parser.parse_args()
+
+    results = run(
+        names=args.filter, iterations=args.iterations, latency=args.latency,
+        jitter=args.jitter
+    )
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare(
+            results, baseline, args.threshold, metrics=args.metric
+        )
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions beyond {0:.0%}'.format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,7 +30,7 @@ setup(
     author='Joel Noyce Barnham',
     author_email='joelnbarnham@gmail.com',
     url='https://github.com/joelnb/win-pyxs',
-    packages=['win_pyxs'],
+    packages=['win_pyxs', 'win_pyxs.simulator'],
     package_dir={
         'win_pyxs': 'win_pyxs',
     },
@@ -0,0 +1,26 @@
+"""
+Helpers shared by the tests which run against several backends.
+"""
+
+#: The keyword arguments of XenBusConnectionWinPV for each of its modes: a
+#: single session used from send(), session workers & a session per thread
+WINPV_MODES = {
+    'winpv': {},
+    'winpv-workers': {'sessions': 2},
+    'winpv-threads': {'thread_sessions': True},
+}
+
+
+def backend_connection(backend, **kwargs):
+    """
+    Return a new (not connected) connection for backend, which is 'gplpv' or
+    one of WINPV_MODES. The keyword arguments are passed to the connection
+    class.
+    """
+    from win_pyxs import XenBusConnectionGPLPV, XenBusConnectionWinPV
+
+    if backend == 'gplpv':
+        return XenBusConnectionGPLPV(**kwargs)
+
+    kwargs.update(WINPV_MODES[backend])
+    return XenBusConnectionWinPV(**kwargs)
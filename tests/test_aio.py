@@ -0,0 +1,64 @@
+import asyncio
+import errno
+import unittest
+
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs.aio import AsyncXenBusConnection
+
+from tests.test_bulk import FakeConnection
+
+
+class AsyncConnectionTester(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        self.connection = FakeConnection({b'vm': b'uuid', b'domid': b'3'})
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_reads(self):
+
+        async def main():
+            async with AsyncXenBusConnection(self.connection) as conn:
+                return await asyncio.gather(
+                    *[conn.read(path) for path in [b'vm', b'domid'] * 50]
+                )
+
+        values = self.run_async(main())
+        self.assertEqual(values, [b'uuid', b'3'] * 50)
+        self.assertFalse(self.connection.is_connected)
+
+    def test_write_and_errors(self):
+
+        async def main():
+            async with AsyncXenBusConnection(self.connection) as conn:
+                await conn.write(b'data/a', b'1')
+                self.assertEqual(await conn.read(b'data/a'), b'1')
+                self.assertEqual(
+                    await conn.read(b'missing', default=b'x'), b'x'
+                )
+                with self.assertRaises(pyxs.PyXSError) as ctx:
+                    await conn.read(b'missing')
+                return ctx.exception
+
+        exc = self.run_async(main())
+        self.assertEqual(exc.args[0], errno.ENOENT)
+
+    def test_close_fails_pending(self):
+        connection = AsyncXenBusConnection(self.connection, loop=self.loop)
+
+        async def main():
+            await connection.connect()
+            # Send without the fake connection replying
+            self.connection.send = lambda packet: None
+            future = connection.send(Packet(Op.READ, b'vm\x00', 1))
+            connection.close()
+            await future
+
+        with self.assertRaises(pyxs.ConnectionError):
+            self.run_async(main())
@@ -0,0 +1,305 @@
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import mock
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs.broker import (
+    XenBusConnectionBroker, XenStoreBroker, _encode, _read_packet,
+    parse_address
+)
+from win_pyxs.simulator import Simulator
+
+from tests.helpers import backend_connection
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for the broker')
+        time.sleep(0.01)
+
+
+class ParseAddressTester(unittest.TestCase):
+
+    def test_addresses(self):
+        self.assertEqual(parse_address('localhost:1234'), ('localhost', 1234))
+        self.assertEqual(parse_address(':1234'), ('127.0.0.1', 1234))
+        self.assertEqual(parse_address('/tmp/broker.sock'), '/tmp/broker.sock')
+        self.assertEqual(parse_address('C:\\broker:1'), 'C:\\broker:1')
+
+
+class TCPBrokerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.simulator.store.write('data/key', 'value')
+
+    def test_needs_allow_tcp(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        with self.assertRaises(ValueError):
+            XenStoreBroker(XenBusConnectionGPLPV(), address='127.0.0.1:0')
+
+    def test_allow_tcp(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        broker = XenStoreBroker(
+            XenBusConnectionGPLPV(), address='127.0.0.1:0', allow_tcp=True
+        )
+        with mock.patch('win_pyxs.broker._logger') as logger:
+            broker.start()
+        self.addCleanup(broker.stop)
+        self.assertTrue(logger.warning.called)
+
+        with pyxs.Client(router=pyxs.Router(
+            XenBusConnectionBroker(broker.address)
+        )) as client:
+            self.assertEqual(client.read(b'data/key'), b'value')
+
+
+class WinPVBackendTester(unittest.TestCase):
+
+    def setUp(self):
+        # WMI objects used outside the thread which obtained them fail
+        self.simulator = Simulator(strict_apartments=True)
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.simulator.store.write('data/key', 'value')
+
+    def test_single_session_refused(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        for connection in (XenBusConnectionWinPV(),
+                           XenBusConnectionWinPV(sessions=1)):
+            with self.assertRaises(ValueError):
+                XenStoreBroker(
+                    connection, address='127.0.0.1:0', allow_tcp=True
+                )
+
+    def test_serve_needs_two_sessions(self):
+        from win_pyxs import __main__ as cli
+
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            cli._parser().parse_args(['serve', '--sessions', '1'])
+        self.assertEqual(
+            cli._parser().parse_args(['serve', '--sessions', '3']).sessions,
+            3
+        )
+
+    def test_usable_modes(self):
+        for backend in ('winpv-workers', 'winpv-threads'):
+            broker = XenStoreBroker(
+                backend_connection(backend), address='127.0.0.1:0',
+                allow_tcp=True
+            )
+            broker.start()
+            self.addCleanup(broker.stop)
+
+            with pyxs.Client(router=pyxs.Router(
+                XenBusConnectionBroker(broker.address)
+            )) as client:
+                self.assertEqual(client.read(b'data/key'), b'value')
+        self.assertEqual(self.simulator.wmi.wrong_thread_calls, 0)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class XenStoreBrokerTester(unittest.TestCase):
+
+    # The backend of the broker & of the tests which need WinPV
+    backend = 'gplpv'
+    winpv_backend = 'winpv-workers'
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.simulator.store.write('data/key', 'value')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.address = os.path.join(directory, 'broker.sock')
+
+    def _broker(self, backend=None):
+        broker = XenStoreBroker(
+            backend_connection(backend or self.backend), address=self.address
+        )
+        broker.start()
+        self.addCleanup(broker.stop)
+        return broker
+
+    def _backend_watches(self, broker):
+        if self.backend == 'gplpv':
+            return len(self.simulator.store._watches)
+        # WinPV polls the watched paths rather than watching the store
+        return broker.connection._watch_count()
+
+    def _client(self):
+        client = pyxs.Client(router=pyxs.Router(
+            XenBusConnectionBroker(self.address)
+        ))
+        client.connect()
+        self.addCleanup(client.close)
+        return client
+
+    def _raw(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_clients_share_connection(self):
+        self._broker()
+        first, second = self._client(), self._client()
+
+        first.write(b'data/other', b'1')
+        self.assertEqual(second.read(b'data/other'), b'1')
+        self.assertEqual(first.read(b'data/key'), b'value')
+
+        with self.assertRaises(pyxs.PyXSError) as context:
+            second.read(b'data/missing')
+        self.assertEqual(context.exception.args[0], errno.ENOENT)
+
+    def test_rq_ids_rewritten(self):
+        self._broker()
+        socks = [self._raw(), self._raw()]
+
+        request = Packet(Op.READ, b'data/key\x00', 7)
+        for sock in socks:
+            sock.sendall(_encode(request))
+        for sock in socks:
+            reply = _read_packet(sock)
+            self.assertEqual(reply.rq_id, 7)
+            self.assertEqual(reply.payload, b'value')
+
+    def test_watch_fan_out(self):
+        broker = self._broker()
+        monitors = [self._client().monitor() for _ in range(2)]
+        events = []
+        for index, monitor in enumerate(monitors):
+            token = 'token-{0}'.format(index).encode('ascii')
+            monitor.watch(b'data', token)
+            events.append(monitor.wait())
+            self.assertEqual(next(events[-1]), (b'data', token))
+
+        # One backend watch is shared by both clients
+        self.assertEqual(self._backend_watches(broker), 1)
+
+        self.simulator.store.write('data/new', '1')
+        self.assertEqual(next(events[0]), (b'data/new', b'token-0'))
+        self.assertEqual(next(events[1]), (b'data/new', b'token-1'))
+
+        monitors[0].unwatch(b'data', b'token-0')
+        self.assertEqual(self._backend_watches(broker), 1)
+        monitors[1].unwatch(b'data', b'token-1')
+        _wait_for(lambda: not self._backend_watches(broker))
+
+    def test_duplicate_and_unknown_watch(self):
+        self._broker()
+        monitor = self._client().monitor()
+        monitor.watch(b'data', b'token')
+
+        with self.assertRaises(pyxs.PyXSError) as context:
+            monitor.watch(b'data', b'token')
+        self.assertEqual(context.exception.args[0], errno.EEXIST)
+
+        with self.assertRaises(pyxs.PyXSError) as context:
+            monitor.unwatch(b'data', b'other')
+        self.assertEqual(context.exception.args[0], errno.ENOENT)
+
+    def test_disconnect_removes_watches(self):
+        broker = self._broker()
+        sock = self._raw()
+        sock.sendall(_encode(Packet(Op.WATCH, b'data\x00token\x00', 1)))
+        # Events can be sent before replies so either can come first
+        self.assertEqual(
+            sorted(_read_packet(sock).op for _ in range(2)),
+            [Op.WATCH, Op.WATCH_EVENT]
+        )
+        _wait_for(lambda: self._backend_watches(broker) == 1)
+
+        sock.close()
+        _wait_for(lambda: not self._backend_watches(broker))
+        _wait_for(lambda: broker.clients == 0)
+
+    def test_transactions(self):
+        self._broker(self.winpv_backend)
+        client = self._client()
+
+        client.transaction()
+        client.write(b'data/key', b'changed')
+        self.assertEqual(self.simulator.store.read('data/key'), 'value')
+        self.assertTrue(client.commit())
+        self.assertEqual(self.simulator.store.read('data/key'), 'changed')
+
+    def test_disconnect_ends_transactions(self):
+        broker = self._broker(self.winpv_backend)
+        sock = self._raw()
+        sock.sendall(_encode(Packet(Op.TRANSACTION_START, b'\x00', 1)))
+        tx_id = int(_read_packet(sock).payload.rstrip(b'\x00'))
+        sock.sendall(_encode(
+            Packet(Op.WRITE, b'data/key\x00changed', 2, tx_id)
+        ))
+        _read_packet(sock)
+
+        sock.close()
+        _wait_for(lambda: broker.clients == 0)
+        _wait_for(lambda: not broker.connection._transactions)
+        self.assertEqual(self.simulator.store.read('data/key'), 'value')
+
+    def test_backend_failure_stops_broker(self):
+        broker = self._broker()
+        broker.connection.recv = mock.Mock(
+            side_effect=OSError(errno.ECONNRESET, 'Device returned EOF')
+        )
+        sock = self._raw()
+        sock.settimeout(5)
+        sock.sendall(_encode(Packet(Op.READ, b'data/key\x00', 1)))
+
+        # The client is disconnected rather than left waiting
+        self.assertIsNone(_read_packet(sock))
+        _wait_for(lambda: not broker.connection.is_connected)
+        self.assertFalse(os.path.exists(self.address))
+        with self.assertRaises(pyxs.ConnectionError):
+            XenBusConnectionBroker.probe(self.address)
+
+    def test_socket_only_accessible_to_owner(self):
+        self._broker()
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o600)
+
+    def test_second_broker_refused(self):
+        self._broker()
+
+        from win_pyxs import XenBusConnectionGPLPV
+        with self.assertRaises(pyxs.PyXSError):
+            XenStoreBroker(
+                XenBusConnectionGPLPV(), address=self.address
+            ).start()
+
+    def test_no_broker(self):
+        with self.assertRaises(pyxs.ConnectionError):
+            XenBusConnectionBroker.probe(self.address)
+
+
+class WinPVWorkersBrokerTester(XenStoreBrokerTester):
+
+    backend = 'winpv-workers'
+
+
+class WinPVThreadsBrokerTester(XenStoreBrokerTester):
+
+    # Each client is served by a thread with a session of its own
+    backend = winpv_backend = 'winpv-threads'
+
+
+if __name__ == '__main__':
+    unittest.main()
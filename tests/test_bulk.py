@@ -0,0 +1,248 @@
+import errno
+import socket
+import threading
+import unittest
+
+import pyxs
+from pyxs._internal import NUL, Op, Packet
+
+from win_pyxs.bulk import (
+    TreeStats, iter_tree, read_tree, tree_speedup, read_many, write_many
+)
+
+
+class FakeClient(object):
+    """
+    A minimal stand-in for pyxs.Client backed by a dict of path -> value.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        with self.lock:
+            try:
+                return self.values[path]
+            except KeyError:
+                raise pyxs.PyXSError(errno.ENOENT, 'No such file')
+
+    def list(self, path):
+        with self.lock:
+            if path not in self.values:
+                raise pyxs.PyXSError(errno.ENOENT, 'No such file')
+            prefix = path.rstrip(b'/') + b'/'
+            return sorted(
+                set(
+                    key[len(prefix):].split(b'/')[0]
+                    for key in self.values if key.startswith(prefix)
+                )
+            )
+
+
+class FakeConnection(object):
+    """
+    A packet connection which answers READ & WRITE requests from a dict.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.replies = []
+        self.sent = []
+        self.batches = 0
+        self.r_terminator = self.w_terminator = None
+
+    @property
+    def is_connected(self):
+        return self.r_terminator is not None
+
+    def connect(self):
+        if not self.is_connected:
+            self.r_terminator, self.w_terminator = socket.socketpair()
+
+    def close(self, silent=True):
+        self.r_terminator.close()
+        self.w_terminator.close()
+        self.r_terminator = self.w_terminator = None
+
+    def fileno(self):
+        return self.r_terminator.fileno()
+
+    def send(self, packet):
+        self.sent.append(packet)
+        path, _sep, value = packet.payload.partition(NUL)
+        if packet.op == Op.WRITE:
+            self.values[path] = value
+            reply = Packet(Op.WRITE, b'OK\x00', packet.rq_id)
+        elif path in self.values:
+            reply = Packet(Op.READ, self.values[path], packet.rq_id)
+        else:
+            reply = Packet(Op.ERROR, b'ENOENT\x00', packet.rq_id)
+
+        self.replies.append(reply)
+        self.w_terminator.sendall(NUL)
+
+    def recv(self):
+        self.r_terminator.recv(1)
+        return self.replies.pop(0)
+
+
+class BatchedConnection(FakeConnection):
+
+    def send_many(self, packets):
+        self.batches += 1
+        failures = {}
+        for packet in packets:
+            if packet.payload.startswith(b'bad'):
+                failures[packet.rq_id] = pyxs.PyXSError('cannot send')
+            else:
+                self.send(packet)
+        return failures
+
+
+class BatchTester(unittest.TestCase):
+
+    def _client(self, connection):
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+        return client
+
+    def test_read_many(self):
+        connection = FakeConnection({b'vm': b'uuid', b'domid': b'3'})
+        client = self._client(connection)
+
+        result = read_many(client, [b'vm', b'domid', b'vm', b'missing'])
+
+        self.assertEqual(
+            dict(result.values), {
+                b'vm': b'uuid',
+                b'domid': b'3'
+            }
+        )
+        self.assertEqual(result.errors[b'missing'].args[0], errno.ENOENT)
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual(len(connection.sent), 3)
+        self.assertFalse(result.ok)
+
+    def test_write_many(self):
+        connection = FakeConnection({})
+        client = self._client(connection)
+
+        result = write_many(
+            client, [(b'data/a', b'1'), (b'data/b', b'2'), (b'data/a', b'3')]
+        )
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual(
+            connection.values, {
+                b'data/a': b'3',
+                b'data/b': b'2'
+            }
+        )
+
+    def test_invalid_path(self):
+        client = self._client(FakeConnection({}))
+
+        result = write_many(client, {b'data/ok': b'1', b'data/bad/': b'2'})
+
+        self.assertEqual(list(result.values), [b'data/ok'])
+        self.assertIsInstance(result.errors[b'data/bad/'], pyxs.InvalidPath)
+
+    def test_send_many(self):
+        connection = BatchedConnection({b'a': b'1', b'b': b'2'})
+        client = self._client(connection)
+
+        result = read_many(client, [b'a', b'b', b'bad'])
+
+        self.assertEqual(connection.batches, 1)
+        self.assertEqual(len(result.values), 2)
+        self.assertEqual(str(result.errors[b'bad']), 'cannot send')
+        self.assertEqual(client.router.rvars, {})
+
+
+class ReadTreeTester(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient({
+            b'/local': b'',
+            b'/local/domain': b'',
+            b'/local/domain/3': b'',
+            b'/local/domain/3/name': b'guest',
+            b'/local/domain/3/data': b'',
+            b'/local/domain/3/data/a': b'1',
+            b'/local/domain/3/data/b': b'2',
+        })
+
+    def test_iter_tree_serial_and_parallel(self):
+        serial = dict(iter_tree(self.client, b'/local', workers=1))
+        parallel = dict(iter_tree(self.client, b'/local', workers=4))
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(serial), 7)
+        self.assertEqual(serial[b'/local/domain/3/data/b'], b'2')
+
+    def test_read_tree(self):
+        stats = TreeStats()
+        tree = read_tree(self.client, b'/local/domain/3', stats=stats)
+
+        self.assertEqual(tree.children[b'name'].value, b'guest')
+        self.assertEqual(
+            sorted(tree.children[b'data'].children), [b'a', b'b']
+        )
+        self.assertEqual(stats.nodes, 5)
+        self.assertEqual(stats.requests, 10)
+
+    def test_max_depth(self):
+        tree = read_tree(self.client, b'/local/domain/3', max_depth=1)
+
+        self.assertEqual(tree.children[b'data'].children, {})
+
+    def test_missing_root(self):
+        self.assertIsNone(read_tree(self.client, b'/missing', workers=2))
+
+    def test_trailing_slash(self):
+        tree = read_tree(self.client, b'/local/domain/3/', workers=2)
+
+        self.assertEqual(sorted(tree.children), [b'data', b'name'])
+
+    def test_node_removed_during_walk(self):
+        values = dict(self.client.values)
+
+        def read(path):
+            if path == b'/local/domain/3/data':
+                # Removed after its parent was listed
+                for key in list(self.client.values):
+                    if key.startswith(path):
+                        del self.client.values[key]
+                # As WMI reports it, without an errno
+                raise pyxs.PyXSError('session.GetValue call failed')
+            return FakeClient.read(self.client, path)
+
+        self.client.read = read
+        for workers in (1, 3):
+            self.client.values = dict(values)
+            tree = read_tree(self.client, b'/local', workers=workers)
+            self.assertEqual(
+                sorted(tree.children[b'domain'].children[b'3'].children),
+                [b'name']
+            )
+
+    def test_errors_are_raised(self):
+        self.client.values[b'/local/domain/3/bad'] = b''
+
+        def read(path):
+            if path.endswith(b'bad'):
+                raise pyxs.PyXSError(errno.EACCES, 'Permission denied')
+            return FakeClient.read(self.client, path)
+
+        self.client.read = read
+        with self.assertRaises(pyxs.PyXSError):
+            read_tree(self.client, b'/local', workers=3)
+
+    def test_tree_speedup(self):
+        report = tree_speedup(self.client, b'/local', workers=2)
+
+        self.assertEqual(report['nodes'], 7)
+        self.assertIn('speedup', report)
@@ -0,0 +1,120 @@
+import unittest
+
+from pyxs._internal import Op
+
+from win_pyxs.cache import ReadCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ReadCacheTester(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ReadCache(
+            max_entries=3,
+            ttl=1.0,
+            prefix_ttls={
+                'vm': None,
+                'data/': 5.0
+            },
+            clock=self.clock
+        )
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(Op.READ, 'domid'))
+        self.cache.put(Op.READ, 'domid', '3')
+
+        self.assertEqual(self.cache.get(Op.READ, 'domid').payload, '3')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_prefix_ttls(self):
+        self.cache.put(Op.READ, 'vm', 'uuid')
+        self.cache.put(Op.READ, 'data/foo', 'bar')
+        self.cache.put(Op.READ, 'domid', '3')
+
+        self.clock.now = 2.0
+        self.assertIsNotNone(self.cache.get(Op.READ, 'vm'))
+        self.assertIsNotNone(self.cache.get(Op.READ, 'data/foo'))
+        self.assertIsNone(self.cache.get(Op.READ, 'domid'))
+
+        self.clock.now = 10.0
+        self.assertIsNotNone(self.cache.get(Op.READ, 'vm'))
+        self.assertIsNone(self.cache.get(Op.READ, 'data/foo'))
+
+    def test_prefix_ttls_through_connection(self):
+        import pyxs
+        from win_pyxs import XenBusConnectionWinPV
+        from win_pyxs.simulator import Simulator
+
+        simulator = Simulator()
+        simulator.install()
+        self.addCleanup(simulator.uninstall)
+
+        cache = ReadCache(
+            prefix_ttls={'vm': None, b'data/': 5.0}, clock=self.clock
+        )
+        with pyxs.Client(router=pyxs.Router(
+            XenBusConnectionWinPV(cache=cache)
+        )) as client:
+            client.write(b'data/foo', b'bar')
+            self.assertEqual(client.read(b'vm'), client.read(b'vm'))
+            client.read(b'data/foo')
+            client.read(b'domid')
+
+            self.clock.now = 2.0
+            self.assertIsNotNone(cache.get(Op.READ, b'vm'))
+            self.assertIsNotNone(cache.get(Op.READ, b'data/foo'))
+            self.assertIsNone(cache.get(Op.READ, b'domid'))
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.put(Op.READ, key, key)
+        self.cache.get(Op.READ, 'a')
+        self.cache.put(Op.READ, 'd', 'd')
+
+        self.assertIsNone(self.cache.get(Op.READ, 'b'))
+        self.assertIsNotNone(self.cache.get(Op.READ, 'a'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_negative_cache(self):
+        self.cache.put_missing(Op.READ, 'device/vif/1/mac')
+
+        entry = self.cache.get(Op.READ, 'device/vif/1/mac')
+        self.assertTrue(entry.missing)
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+
+    def test_write_invalidates_key_and_ancestor_listings(self):
+        self.cache.put(Op.READ, '/local/domain/3/data/foo', 'old')
+        self.cache.put(Op.DIRECTORY, '/local/domain/3/data', 'foo')
+        self.cache.put(Op.DIRECTORY, '/local/domain/3', 'data')
+
+        self.cache.invalidate('/local/domain/3/data/foo')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_rm_invalidates_subtree(self):
+        cache = ReadCache(clock=self.clock)
+        cache.put(Op.READ, 'data/a/b', 'x')
+        cache.put(Op.DIRECTORY, 'data/a', 'b')
+        cache.put(Op.READ, 'data/ab', 'y')
+
+        cache.invalidate('data/a', recursive=True)
+        self.assertIsNone(cache.get(Op.READ, 'data/a/b'))
+        self.assertIsNone(cache.get(Op.DIRECTORY, 'data/a'))
+        self.assertIsNotNone(cache.get(Op.READ, 'data/ab'))
+
+    def test_stale_put_is_discarded(self):
+        epoch = self.cache.epoch
+        self.cache.invalidate('domid')
+        self.cache.put(Op.READ, 'domid', '3', epoch)
+
+        self.assertIsNone(self.cache.get(Op.READ, 'domid'))
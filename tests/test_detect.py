@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+import pyxs
+
+from win_pyxs import detect
+from win_pyxs.exceptions import BackendNotFoundError, GPLPVDriverError
+from win_pyxs.simulator import Simulator
+from win_pyxs.utils import CACHE_DIR_ENV, read_cache
+
+
+def _backend(available=True, blocked=None):
+    """
+    Return a stand-in connection class whose probe() & connect() succeed if
+    available. probe() waits for the blocked event first if one is given.
+    """
+    class Connection(object):
+        probes = 0
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.connected = False
+
+        @classmethod
+        def probe(cls):
+            cls.probes += 1
+            if blocked is not None:
+                blocked.wait()
+            if not available:
+                raise GPLPVDriverError('Not available')
+
+        def connect(self):
+            if not available:
+                raise pyxs.PyXSError('Not available')
+            self.connected = True
+
+    return Connection
+
+
+class DetectTester(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+
+        self.backends = {}
+        patches = [
+            mock.patch.dict(os.environ, {CACHE_DIR_ENV: cache_dir}),
+            mock.patch('win_pyxs.detect._BACKEND', None),
+            mock.patch(
+                'win_pyxs.detect.connection_class',
+                side_effect=lambda name: self.backends[name]
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_first_available_backend_is_used(self):
+        self.backends = {
+            'gplpv': _backend(available=False),
+            'winpv': _backend(),
+        }
+
+        connection = detect.connect(sessions=2)
+
+        self.assertIsInstance(connection, self.backends['winpv'])
+        self.assertTrue(connection.connected)
+        self.assertEqual(connection.kwargs, {'sessions': 2})
+        self.assertEqual(
+            read_cache(detect.BACKEND_CACHE)['backend'], 'winpv'
+        )
+
+    def test_slow_probe_does_not_delay_detection(self):
+        blocked = threading.Event()
+        self.addCleanup(blocked.set)
+        self.backends = {
+            'gplpv': _backend(blocked=blocked),
+            'winpv': _backend(),
+        }
+
+        self.assertEqual(detect.detect_backend(timeout=5), 'winpv')
+
+    def test_timeout(self):
+        blocked = threading.Event()
+        self.addCleanup(blocked.set)
+        self.backends = {
+            'gplpv': _backend(available=False),
+            'winpv': _backend(blocked=blocked),
+        }
+
+        with self.assertRaises(BackendNotFoundError) as context:
+            detect.detect_backend(timeout=0.1)
+        self.assertIn('winpv: timed out', str(context.exception))
+
+    def test_decision_is_cached(self):
+        self.backends = {'gplpv': _backend(), 'winpv': _backend(False)}
+        self.assertEqual(detect.detect_backend(), 'gplpv')
+
+        # Another process only has the cache file
+        detect._BACKEND = None
+        self.assertEqual(detect.detect_backend(), 'gplpv')
+        self.assertEqual(self.backends['gplpv'].probes, 1)
+
+        detect.forget_backend()
+        self.assertIsNone(read_cache(detect.BACKEND_CACHE))
+
+    def test_stale_cached_backend(self):
+        detect._save_backend('gplpv')
+        self.backends = {'gplpv': _backend(False), 'winpv': _backend()}
+
+        connection = detect.connect()
+
+        self.assertIsInstance(connection, self.backends['winpv'])
+        self.assertEqual(
+            read_cache(detect.BACKEND_CACHE)['backend'], 'winpv'
+        )
+
+    def test_forced_backend(self):
+        self.backends = {'gplpv': _backend(), 'winpv': _backend()}
+
+        connection = detect.connect('winpv')
+
+        self.assertIsInstance(connection, self.backends['winpv'])
+        self.assertEqual(self.backends['winpv'].probes, 0)
+
+
+class SimulatedDetectTester(unittest.TestCase):
+
+    def test_connect(self):
+        with Simulator() as simulator:
+            simulator.store.write('vm', '/vm/uuid')
+            connection = detect.connect()
+            with pyxs.Client(router=pyxs.Router(connection)) as client:
+                self.assertEqual(client.read(b'vm'), b'/vm/uuid')
+            self.assertIn(detect._BACKEND, detect.BACKENDS)
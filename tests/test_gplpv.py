@@ -1,10 +1,19 @@
+import os
+import shutil
 import tempfile
+import threading
 import unittest
 
 import mock
+import pyxs
 from win32file import CreateFile
+from pyxs._internal import Op, Packet
 
 from win_pyxs import XenBusConnectionGPLPV
+from win_pyxs import gplpv
+from win_pyxs.exceptions import GPLPVDeviceOpenError
+from win_pyxs.gplpv import XenBusTransportGPLPV
+from win_pyxs.utils import CACHE_DIR_ENV, cache_path, read_cache
 
 EXAMPLE_DEVICE_PATH = (
     r'\\?\pci#ven_5853&dev_0001&subsys_00015853&rev_01#3&267a616a&1&10#'
@@ -12,9 +21,99 @@ EXAMPLE_DEVICE_PATH = (
 )
 
 
+def _frame(packet):
+    return Packet._struct.pack(
+        packet.op, packet.rq_id, packet.tx_id, packet.size
+    ) + packet.payload
+
+
+class FakeDevice(object):
+    """
+    An in-memory stand-in for the overlapped GPLPV device. Reads block until
+    data is fed in (or the device is cancelled) & only part of each read and
+    write is completed so the transport has to handle partial I/O.
+    """
+
+    def __init__(self, chunk=7):
+        self.chunk = chunk
+        self.pending = bytearray()
+        self.writes = bytearray()
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        with self.condition:
+            self.pending.extend(data)
+            self.condition.notify_all()
+
+    def read_into(self, view):
+        with self.condition:
+            while not self.pending and not self.cancelled:
+                self.condition.wait()
+            if self.cancelled:
+                raise OSError(995, 'The I/O operation has been aborted')
+
+            count = min(len(view), self.chunk, len(self.pending))
+            view[:count] = self.pending[:count]
+            del self.pending[:count]
+            return count
+
+    def write(self, data, start=0):
+        count = min(len(data) - start, self.chunk)
+        self.writes.extend(data[start:start + count])
+        return count
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def close(self):
+        pass
+
+
+def _use_temp_cache_dir(test):
+    """
+    Keep the device path cache of a test out of the real cache directory.
+    """
+    cache_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, cache_dir, True)
+    patch = mock.patch.dict(os.environ, {CACHE_DIR_ENV: cache_dir})
+    patch.start()
+    test.addCleanup(patch.stop)
+
+
+class PacketRingTester(unittest.TestCase):
+
+    def test_wrapped_packet(self):
+        ring = gplpv._PacketRing(capacity=64)
+        first, second = Packet(Op.READ, b'a' * 20, 1), \
+            Packet(Op.READ, b'b' * 30, 2)
+
+        def write(data):
+            while data:
+                view = ring.writable()
+                count = min(len(view), len(data))
+                view[:count] = data[:count]
+                ring.commit(count)
+                data = data[count:]
+
+        # The second packet wraps around the end of the ring
+        write(_frame(first) + _frame(second)[:20])
+        framed = list(ring.packets())
+        self.assertIsInstance(framed[0].payload, memoryview)
+        self.assertEqual([gplpv._copied(p) for p in framed], [first])
+
+        write(_frame(second)[20:])
+        self.assertEqual(
+            [gplpv._copied(p) for p in ring.packets()], [second]
+        )
+
+
 class GPLPVTester(unittest.TestCase):
 
     def setUp(self):
+        _use_temp_cache_dir(self)
         self.connection = XenBusConnectionGPLPV()
 
     def test_connect(self):
@@ -24,3 +123,197 @@ class GPLPVTester(unittest.TestCase):
 
             self.connection.connect()
             self.connection.close()
+
+    def _connect(self, device):
+        patches = [
+            mock.patch.object(
+                XenBusTransportGPLPV,
+                '_get_device_path',
+                return_value=EXAMPLE_DEVICE_PATH
+            ),
+            mock.patch('win_pyxs.gplpv._WIN_DEVICE_PATH', None),
+            mock.patch.object(
+                XenBusTransportGPLPV, '_open_device', return_value=device
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.connection.connect()
+        self.addCleanup(self.connection.close)
+
+    def test_pipelined_replies(self):
+        device = FakeDevice()
+        self._connect(device)
+
+        requests = [Packet(Op.READ, b'vm\x00', rq_id) for rq_id in (1, 2)]
+        for packet in requests:
+            self.connection.send(packet)
+        self.assertEqual(
+            bytes(device.writes), b''.join(_frame(p) for p in requests)
+        )
+
+        device.feed(_frame(Packet(Op.READ, b'y', 2)))
+        device.feed(_frame(Packet(Op.READ, b'x' * 4096, 1)))
+
+        first = self.connection.recv()
+        self.assertEqual((first.rq_id, first.payload), (2, b'y'))
+        second = self.connection.recv()
+        self.assertEqual((second.rq_id, second.payload), (1, b'x' * 4096))
+
+    def test_intercepted_replies_not_copied(self):
+        device = FakeDevice(chunk=4096)
+        self._connect(device)
+        seen = []
+
+        def intercept(packet):
+            seen.append(type(packet.payload))
+            return packet.rq_id == 1
+
+        self.connection.transport.intercept = intercept
+        for rq_id in (1, 2):
+            self.connection.send(Packet(Op.READ, b'vm\x00', rq_id))
+        device.feed(
+            _frame(Packet(Op.READ, b'x', 1)) + _frame(Packet(Op.READ, b'y', 2))
+        )
+
+        reply = self.connection.recv()
+        self.assertEqual((reply.rq_id, reply.payload), (2, b'y'))
+        self.assertIsInstance(reply.payload, bytes)
+        self.assertEqual(seen, [memoryview, memoryview])
+
+    def test_watch_events(self):
+        device = FakeDevice(chunk=4096)
+        self._connect(device)
+
+        self.connection.send(Packet(Op.WATCH, b'data\x00token\x00', 1))
+        device.feed(
+            _frame(Packet(Op.WATCH, b'OK\x00', 1))
+            + _frame(Packet(Op.WATCH_EVENT, b'data\x00token\x00', 0))
+            # A reply nobody asked for is dropped
+            + _frame(Packet(Op.READ, b'?\x00', 99))
+        )
+
+        replies = [self.connection.recv() for _ in range(2)]
+        self.assertEqual(
+            sorted(packet.op for packet in replies), [Op.WATCH, Op.WATCH_EVENT]
+        )
+
+    def test_router_watch(self):
+        device = FakeDevice(chunk=4096)
+
+        def write(data, start=0):
+            # Acknowledge every request & fire the watch once it is set
+            op, rq_id, tx_id, _size = Packet._struct.unpack(data[:16])
+            device.feed(_frame(Packet(op, b'OK\x00', rq_id, tx_id)))
+            if op == Op.WATCH:
+                device.feed(
+                    _frame(Packet(Op.WATCH_EVENT, b'data\x00tok\x00', 0))
+                )
+            return len(data) - start
+
+        device.write = write
+        self._connect(device)
+
+        client = pyxs.Client(router=pyxs.Router(self.connection))
+        with client, client.monitor() as monitor:
+            monitor.watch(b'data', b'tok')
+            self.assertEqual(next(monitor.wait()), (b'data', b'tok'))
+
+
+class DevicePathCacheTester(unittest.TestCase):
+
+    def setUp(self):
+        _use_temp_cache_dir(self)
+
+        patches = [
+            mock.patch('win_pyxs.gplpv._WIN_DEVICE_PATH', None),
+            mock.patch.object(
+                XenBusTransportGPLPV, '_get_device_path',
+                return_value=EXAMPLE_DEVICE_PATH
+            ),
+        ]
+        self.get_device_path = [patch.start() for patch in patches][1]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def _transport(self, open_device):
+        with mock.patch.object(
+            XenBusTransportGPLPV, '_open_device', autospec=True,
+            side_effect=open_device
+        ):
+            transport = XenBusTransportGPLPV()
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_discovered_path_is_saved(self):
+        transport = self._transport(lambda _transport: FakeDevice())
+
+        self.assertEqual(transport.path, EXAMPLE_DEVICE_PATH)
+        self.assertEqual(self.get_device_path.call_count, 1)
+        self.assertEqual(gplpv._WIN_DEVICE_PATH, EXAMPLE_DEVICE_PATH)
+        self.assertEqual(
+            read_cache(gplpv.DEVICE_PATH_CACHE)['path'], EXAMPLE_DEVICE_PATH
+        )
+
+    def test_cached_path_skips_discovery(self):
+        gplpv._save_device_path(r'\\?\cached')
+        paths = []
+
+        def open_device(transport):
+            paths.append(transport.path)
+            return FakeDevice()
+
+        transport = self._transport(open_device)
+
+        self.assertEqual(paths, [r'\\?\cached'])
+        self.assertEqual(transport.path, r'\\?\cached')
+        self.assertFalse(self.get_device_path.called)
+
+    def test_stale_cached_path_is_rediscovered(self):
+        gplpv._save_device_path(r'\\?\stale')
+        paths = []
+
+        def open_device(transport):
+            paths.append(transport.path)
+            if transport.path != EXAMPLE_DEVICE_PATH:
+                raise GPLPVDeviceOpenError(
+                    transport.path, winerror=gplpv.ERROR_FILE_NOT_FOUND
+                )
+            return FakeDevice()
+
+        transport = self._transport(open_device)
+
+        self.assertEqual(paths, [r'\\?\stale', EXAMPLE_DEVICE_PATH])
+        self.assertEqual(transport.path, EXAMPLE_DEVICE_PATH)
+        self.assertEqual(
+            read_cache(gplpv.DEVICE_PATH_CACHE)['path'], EXAMPLE_DEVICE_PATH
+        )
+
+    def test_cached_path_in_use_is_kept(self):
+        gplpv._save_device_path(r'\\?\cached')
+        paths = []
+
+        def open_device(transport):
+            paths.append(transport.path)
+            # ERROR_SHARING_VIOLATION
+            raise GPLPVDeviceOpenError(transport.path, winerror=32)
+
+        with self.assertRaises(GPLPVDeviceOpenError):
+            self._transport(open_device)
+
+        self.assertEqual(paths, [r'\\?\cached'])
+        self.assertFalse(self.get_device_path.called)
+        self.assertEqual(
+            read_cache(gplpv.DEVICE_PATH_CACHE)['path'], r'\\?\cached'
+        )
+
+    def test_corrupt_cache_is_ignored(self):
+        with open(cache_path(gplpv.DEVICE_PATH_CACHE), 'w') as cache_file:
+            cache_file.write('{not json')
+
+        transport = self._transport(lambda _transport: FakeDevice())
+
+        self.assertEqual(transport.path, EXAMPLE_DEVICE_PATH)
+        self.assertEqual(self.get_device_path.call_count, 1)
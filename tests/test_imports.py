@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from win_pyxs.utils import LazyModule
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _imported_after(statement, modules):
+    """
+    Run statement in a new interpreter & return which of modules it
+    imported.
+    """
+    code = (
+        'import sys\n'
+        'before = set(sys.modules)\n'
+        '{0}\n'
+        'print(",".join(sorted(\n'
+        '    name for name in {1!r} if name in set(sys.modules) - before\n'
+        ')))\n'
+    ).format(statement, tuple(modules))
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], env=env, universal_newlines=True
+    )
+    return [name for name in output.strip().split(',') if name]
+
+
+class LazyImportTester(unittest.TestCase):
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs module __getattr__')
+    def test_package_import_is_lazy(self):
+        self.assertEqual(_imported_after('import win_pyxs', [
+            'ctypes.wintypes', 'pythoncom', 'win32file', 'wmi',
+            'win_pyxs.gplpv', 'win_pyxs.winpv',
+        ]), [])
+
+    def test_backend_import_is_lazy(self):
+        self.assertEqual(_imported_after(
+            'from win_pyxs import XenBusConnectionWinPV', [
+                'ctypes.wintypes', 'pythoncom', 'win32file', 'wmi',
+            ]
+        ), [])
+
+    def test_lazy_module(self):
+        module = LazyModule('json')
+        self.assertEqual(module.dumps([1]), '[1]')
+        self.assertIs(module.loads, __import__('json').loads)
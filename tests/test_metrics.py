@@ -0,0 +1,141 @@
+import unittest
+
+from pyxs._internal import Op, Packet
+
+from win_pyxs.metrics import ConnectionMetrics, Histogram
+from win_pyxs.simulator import Simulator
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class HistogramTester(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(bounds=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        self.assertEqual(
+            histogram.cumulative(), [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+        )
+
+
+class ConnectionMetricsTester(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = ConnectionMetrics(buckets=(0.01, 0.1), clock=self.clock)
+
+    def test_request_latency(self):
+        request = Packet(Op.READ, b'domid\x00', 1)
+        self.metrics.request_sent(request)
+        self.clock.now = 0.005
+        self.metrics.reply_ready(Packet(Op.READ, b'3', 1))
+        self.clock.now = 0.05
+        self.metrics.reply_received(Packet(Op.READ, b'3', 1))
+
+        snapshot = self.metrics.snapshot()
+        read = snapshot['ops']['READ']
+        self.assertEqual(read['requests'], 1)
+        self.assertEqual(read['errors'], 0)
+        self.assertEqual(read['service']['buckets'][0], (0.01, 1))
+        self.assertEqual(read['latency']['buckets'][0], (0.01, 0))
+        self.assertEqual(read['latency']['buckets'][1], (0.1, 1))
+        self.assertEqual(snapshot['bytes_sent'], 16 + 6)
+        self.assertEqual(snapshot['bytes_received'], 16 + 1)
+        self.assertEqual(snapshot['gauges']['in_flight'], 0)
+
+    def test_errors(self):
+        self.metrics.request_sent(Packet(Op.READ, b'a\x00', 1))
+        self.metrics.reply_received(Packet(Op.ERROR, b'ENOENT\x00', 1))
+        self.metrics.request_sent(Packet(Op.WRITE, b'b\x00c', 2))
+        self.metrics.request_failed(Packet(Op.WRITE, b'b\x00c', 2))
+
+        ops = self.metrics.snapshot()['ops']
+        self.assertEqual(ops['READ']['errors'], 1)
+        self.assertEqual(ops['WRITE']['errors'], 1)
+        self.assertEqual(ops['WRITE']['latency']['count'], 0)
+
+    def test_prometheus(self):
+        self.metrics.request_sent(Packet(Op.READ, b'a\x00', 1))
+        self.metrics.reply_received(Packet(Op.READ, b'', 1))
+        self.metrics.increment('wmi_connect_retries', 2)
+        self.metrics.gauge('queue_depth', lambda: 3)
+
+        text = self.metrics.to_prometheus(labels={'backend': 'winpv'})
+        self.assertIn(
+            'win_pyxs_requests_total{backend="winpv",op="READ"} 1', text
+        )
+        self.assertIn(
+            'win_pyxs_request_latency_seconds_bucket'
+            '{backend="winpv",op="READ",le="+Inf"} 1', text
+        )
+        self.assertIn(
+            'win_pyxs_wmi_connect_retries_total{backend="winpv"} 2', text
+        )
+        self.assertIn('win_pyxs_queue_depth{backend="winpv"} 3', text)
+
+    def test_labelled_histograms(self):
+        self.metrics.observe('queue_seconds', 0.005, priority='bulk')
+        self.metrics.observe('queue_seconds', 0.05, priority='bulk')
+        self.metrics.observe('queue_seconds', 0.005, priority='control')
+
+        histograms = self.metrics.snapshot()['histograms']['queue_seconds']
+        self.assertEqual(
+            sorted((data['labels']['priority'], data['count'])
+                   for data in histograms),
+            [('bulk', 2), ('control', 1)]
+        )
+
+        text = self.metrics.to_prometheus()
+        self.assertIn(
+            'win_pyxs_queue_seconds_bucket{priority="bulk",le="0.01"} 1', text
+        )
+        self.assertIn(
+            'win_pyxs_queue_seconds_count{priority="control"} 1', text
+        )
+
+
+class ConnectionInstrumentationTester(unittest.TestCase):
+
+    def setUp(self):
+        simulator = Simulator()
+        simulator.install()
+        self.addCleanup(simulator.uninstall)
+
+    def _check(self, connection):
+        import pyxs
+
+        with pyxs.Client(router=pyxs.Router(connection)) as client:
+            client.write(b'data/key', b'value')
+            client.read(b'data/key')
+            with self.assertRaises(pyxs.PyXSError):
+                client.read(b'data/missing')
+
+        snapshot = connection.metrics.snapshot()
+        self.assertEqual(snapshot['ops']['READ']['requests'], 2)
+        self.assertEqual(snapshot['ops']['READ']['errors'], 1)
+        self.assertEqual(snapshot['ops']['WRITE']['latency']['count'], 1)
+        self.assertEqual(snapshot['gauges']['in_flight'], 0)
+        self.assertIn('queue_depth', snapshot['gauges'])
+        return snapshot
+
+    def test_winpv(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        snapshot = self._check(XenBusConnectionWinPV(sessions=2))
+        self.assertEqual(snapshot['counters']['sessions_added'], 2)
+
+    def test_gplpv(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        self._check(XenBusConnectionGPLPV())
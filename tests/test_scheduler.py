@@ -0,0 +1,191 @@
+import errno
+import threading
+import unittest
+
+import mock
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs.bulk import read_many
+from win_pyxs.metrics import ConnectionMetrics
+from win_pyxs.scheduler import BULK, CONTROL, RequestScheduler
+from win_pyxs.simulator import Simulator
+
+
+def _packet(rq_id, path=b'data/a'):
+    return Packet(Op.READ, path + b'\x00', rq_id)
+
+
+class RequestSchedulerTester(unittest.TestCase):
+
+    def _run(self, scheduler, count, metrics=None):
+        """
+        Attach a dispatch which answers each request straight away & return
+        the rq_ids in the order they were sent once count have been.
+        """
+        sent = []
+        done = threading.Event()
+
+        def _dispatch(packets):
+            for packet in packets:
+                sent.append(packet.rq_id)
+                scheduler.completed(packet)
+            if len(sent) >= count:
+                done.set()
+
+        scheduler.attach(_dispatch, metrics=metrics)
+        self.addCleanup(scheduler.detach)
+        self.assertTrue(done.wait(5))
+        return sent
+
+    def test_weighted_round_robin(self):
+        scheduler = RequestScheduler(
+            weights={CONTROL: 2, BULK: 1}, max_in_flight=1
+        )
+        with scheduler.priority(BULK):
+            for rq_id in range(1, 7):
+                scheduler.submit(_packet(rq_id))
+        for rq_id in range(101, 105):
+            scheduler.submit(_packet(rq_id))
+        self.assertEqual(len(scheduler), 10)
+
+        self.assertEqual(
+            self._run(scheduler, 10),
+            [101, 1, 102, 103, 2, 104, 3, 4, 5, 6]
+        )
+
+    def test_classify_and_delay(self):
+        metrics = ConnectionMetrics()
+        scheduler = RequestScheduler(
+            classify=lambda packet: BULK if packet.rq_id > 1 else None
+        )
+        for rq_id in (1, 2, 3):
+            scheduler.submit(_packet(rq_id))
+        self._run(scheduler, 3, metrics=metrics)
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['classes'][CONTROL]['sent'], 1)
+        self.assertEqual(stats['classes'][BULK]['sent'], 2)
+        histograms = metrics.snapshot()['histograms']
+        self.assertEqual(
+            sorted((data['labels']['class'], data['count'])
+                   for data in histograms['scheduler_queue_seconds']),
+            [(BULK, 2), (CONTROL, 1)]
+        )
+
+    def test_in_flight_limit(self):
+        scheduler = RequestScheduler(max_in_flight=2)
+        sent = []
+        ready = threading.Semaphore(0)
+
+        def _dispatch(packets):
+            sent.extend(packets)
+            for _packet_ in packets:
+                ready.release()
+
+        scheduler.attach(_dispatch)
+        self.addCleanup(scheduler.detach)
+        for rq_id in range(1, 6):
+            scheduler.submit(_packet(rq_id))
+
+        for _ in range(2):
+            self.assertTrue(ready.acquire(timeout=5))
+        self.assertFalse(ready.acquire(timeout=0.05))
+        self.assertEqual(len(sent), 2)
+
+        scheduler.completed(sent[0])
+        self.assertTrue(ready.acquire(timeout=5))
+        self.assertEqual([packet.rq_id for packet in sent], [1, 2, 3])
+
+    def test_unknown_class(self):
+        with self.assertRaises(ValueError):
+            RequestScheduler(default='other')
+        with self.assertRaises(ValueError):
+            with RequestScheduler().priority('other'):
+                pass
+
+
+class ConnectionSchedulerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        for index in range(50):
+            self.simulator.store.write('data/key{0}'.format(index), 'value')
+
+    def _check(self, connection):
+        scheduler = connection.scheduler
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+
+        paths = [b'data/key' + str(index).encode() for index in range(50)]
+        with scheduler.priority(BULK):
+            result = read_many(client, paths)
+        self.assertEqual(len(result.values), 50)
+
+        client.write(b'data/heartbeat', b'1')
+        self.assertEqual(client.read(b'data/heartbeat'), b'1')
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['classes'][BULK]['sent'], 50)
+        self.assertEqual(stats['classes'][CONTROL]['sent'], 2)
+        self.assertIn(
+            'scheduler_queue_seconds',
+            connection.metrics.snapshot()['histograms']
+        )
+
+    def test_winpv(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        self._check(XenBusConnectionWinPV(
+            sessions=2, scheduler=RequestScheduler(max_in_flight=4)
+        ))
+
+    def test_gplpv(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        self._check(XenBusConnectionGPLPV(
+            scheduler=RequestScheduler(max_in_flight=4)
+        ))
+
+    def _check_dispatch_failure(self, connection, method):
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+
+        with mock.patch.object(
+            connection, method, side_effect=RuntimeError('broken')
+        ):
+            with self.assertRaises(pyxs.PyXSError) as context:
+                client.read(b'data/key0')
+        self.assertEqual(context.exception.args[0], errno.EIO)
+
+        # The failed request no longer counts against max_in_flight
+        self.assertEqual(connection.scheduler.stats()['in_flight'], 0)
+        self.assertEqual(client.read(b'data/key0'), b'value')
+
+    def test_winpv_dispatch_failure(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        self._check_dispatch_failure(XenBusConnectionWinPV(
+            sessions=2, scheduler=RequestScheduler(max_in_flight=1)
+        ), '_worker_index')
+
+    def test_gplpv_dispatch_failure(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        self._check_dispatch_failure(XenBusConnectionGPLPV(
+            scheduler=RequestScheduler(max_in_flight=1)
+        ), '_write')
+
+    def test_winpv_needs_workers(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        with self.assertRaises(ValueError):
+            XenBusConnectionWinPV(scheduler=RequestScheduler())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import errno
+import unittest
+
+import pyxs
+
+from win_pyxs.simulator import (
+    Faults, InjectedFailure, Simulator, XenStore, XenStoreError
+)
+from win_pyxs.simulator.fakewmi import x_wmi
+
+
+class XenStoreTester(unittest.TestCase):
+
+    def setUp(self):
+        self.store = XenStore(domid=3)
+
+    def test_write_creates_parents(self):
+        self.store.write('data/a/b', 'value')
+
+        self.assertEqual(self.store.read('/local/domain/3/data/a/b'), 'value')
+        self.assertEqual(self.store.read('data/a'), '')
+        self.assertEqual(self.store.directory('data'), ['a'])
+
+    def test_rm(self):
+        self.store.write('data/a/b', 'value')
+        self.store.rm('data/a')
+
+        self.assertFalse(self.store.exists('data/a/b'))
+        self.assertEqual(self.store.directory('data'), [])
+
+        with self.assertRaises(XenStoreError) as context:
+            self.store.rm('missing/child')
+        self.assertEqual(context.exception.errno, errno.ENOENT)
+
+    def test_watch(self):
+        events = []
+        callback = lambda path, token: events.append((path, token))
+
+        self.store.add_watch('data', 'token', callback)
+        self.store.write('data/a', '1')
+        self.store.write('other', '2')
+        self.store.remove_watch('data', 'token', callback)
+        self.store.write('data/b', '3')
+
+        self.assertEqual(events, [('data', 'token'), ('data/a', 'token')])
+
+
+class SimulatorTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+
+    def _client(self, connection):
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+        return client
+
+    def _check_client(self, client):
+        client.write(b'data/key', b'value')
+
+        self.assertEqual(client.read(b'data/key'), b'value')
+        self.assertEqual(client.list(b'data'), [b'key'])
+        self.assertEqual(self.simulator.store.read('data/key'), 'value')
+
+        client.delete(b'data/key')
+        self.assertEqual(client.list(b'data'), [])
+
+    def test_winpv(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        self._check_client(self._client(XenBusConnectionWinPV()))
+        self.assertEqual(self.simulator.wmi.sessions_added, 1)
+
+    def test_winpv_session_pool(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        client = self._client(XenBusConnectionWinPV(sessions=3))
+        self._check_client(client)
+        self.assertEqual(len(self.simulator.wmi.sessions), 3)
+
+        client.close()
+        self.assertEqual(len(self.simulator.wmi.sessions), 0)
+
+    def test_winpv_errors_match_across_modes(self):
+        from win_pyxs import XenBusConnectionWinPV
+        from win_pyxs.cache import ReadCache
+
+        for sessions in (1, 3):
+            client = self._client(
+                XenBusConnectionWinPV(sessions=sessions, cache=ReadCache())
+            )
+            # The second read is answered from the cache
+            for _ in range(2):
+                with self.assertRaises(pyxs.PyXSError) as context:
+                    client.read(b'data/missing')
+                self.assertEqual(context.exception.args[0], errno.ENOENT)
+
+            self.simulator.wmi.faults.failure_rate = 1.0
+            with self.assertRaises(pyxs.PyXSError) as context:
+                client.write(b'data/key', b'value')
+            self.assertEqual(context.exception.args[0], errno.EIO)
+            self.simulator.wmi.faults.failure_rate = 0.0
+
+    def test_gplpv(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        client = self._client(XenBusConnectionGPLPV())
+        self._check_client(client)
+
+        with self.assertRaises(pyxs.PyXSError) as context:
+            client.read(b'data/missing')
+        self.assertEqual(context.exception.args[0], errno.ENOENT)
+
+    def test_gplpv_watch(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        client = self._client(XenBusConnectionGPLPV())
+        monitor = client.monitor()
+        monitor.watch(b'data', b'token')
+        events = monitor.wait()
+
+        self.assertEqual(next(events), (b'data', b'token'))
+        self.simulator.store.write('data/key', 'value')
+        self.assertEqual(next(events), (b'data/key', b'token'))
+
+    def test_directory_too_large(self):
+        from win_pyxs import XenBusConnectionGPLPV, XenBusConnectionWinPV
+
+        for index in range(1000):
+            self.simulator.store.write('data/big/child{0}'.format(index), '')
+
+        for connection in (XenBusConnectionWinPV(), XenBusConnectionGPLPV()):
+            client = self._client(connection)
+            with self.assertRaises(pyxs.PyXSError) as context:
+                client.list(b'data/big')
+            self.assertEqual(context.exception.args[0], errno.E2BIG)
+
+    def test_device_failure_injection(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        self.simulator.device_faults.failure_rate = 1.0
+        client = self._client(XenBusConnectionGPLPV())
+
+        with self.assertRaises(pyxs.PyXSError) as context:
+            client.read(b'domid')
+        self.assertEqual(context.exception.args[0], errno.EIO)
+        self.assertEqual(self.simulator.device_faults.failures, 1)
+
+    def test_wmi_failure_injection(self):
+        from win_pyxs import XenBusConnectionWinPV
+
+        self.simulator.wmi.connect_faults.failure_rate = 1.0
+        connection = XenBusConnectionWinPV()
+
+        with self.assertRaises(pyxs.PyXSError):
+            connection.connect(wmi_connect_retry=0)
+        self.assertEqual(self.simulator.wmi.connect_faults.failures, 1)
+
+        self.simulator.wmi.connect_faults.failure_rate = 0.0
+        self.simulator.wmi.faults.failure_rate = 1.0
+        with self.assertRaises(x_wmi):
+            connection.connect(wmi_connect_retry=0)
+
+
+class FaultsTester(unittest.TestCase):
+
+    def test_seeded_failures_repeat(self):
+        def _outcomes():
+            faults = Faults(failure_rate=0.5, seed=1)
+            outcomes = []
+            for _ in range(20):
+                try:
+                    faults.apply()
+                    outcomes.append(True)
+                except InjectedFailure:
+                    outcomes.append(False)
+            return outcomes
+
+        self.assertEqual(_outcomes(), _outcomes())
+        self.assertIn(False, _outcomes())
+        self.assertIn(True, _outcomes())
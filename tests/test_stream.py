@@ -0,0 +1,105 @@
+import io
+import os
+import unittest
+
+import pyxs
+
+from win_pyxs.exceptions import StreamCorruptError
+from win_pyxs.simulator import Simulator
+from win_pyxs.stream import (
+    ChunkWriter, read_manifest, read_stream, write_stream
+)
+
+from tests.helpers import backend_connection
+
+
+class StreamTester(unittest.TestCase):
+
+    backend = 'gplpv'
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.store = self.simulator.store
+
+        self.client = pyxs.Client(
+            router=pyxs.Router(backend_connection(self.backend))
+        )
+        self.client.connect()
+        self.addCleanup(self.client.close)
+
+        self.data = os.urandom(10000) + b'inventory ' * 2000
+
+    def _read(self, path=b'data/value', **kwargs):
+        return b''.join(read_stream(self.client, path, **kwargs))
+
+    def test_round_trip(self):
+        manifest = write_stream(
+            self.client, b'data/value', io.BytesIO(self.data), chunk_size=1000
+        )
+        self.assertEqual(manifest['chunks'], 30)
+        self.assertEqual(manifest['size'], len(self.data))
+        self.assertEqual(read_manifest(self.client, b'data/value'), manifest)
+        self.assertTrue(self.store.exists('data/value/29'))
+        self.assertEqual(self._read(window=3), self.data)
+
+    def test_compressed(self):
+        manifest = write_stream(
+            self.client, b'data/value', [self.data[:5000], self.data[5000:]],
+            compress=True
+        )
+        self.assertEqual(manifest['compression'], 'zlib')
+        self.assertLess(manifest['chunks'], 10)
+        self.assertEqual(self._read(), self.data)
+
+    def test_rewrite_removes_old_chunks(self):
+        write_stream(self.client, b'data/value', [self.data])
+        write_stream(self.client, b'data/value', [b'short'], checksum=None)
+
+        self.assertEqual(
+            sorted(self.client.list(b'data/value')), [b'0', b'manifest']
+        )
+        self.assertEqual(self._read(), b'short')
+
+    def test_corruption_detected(self):
+        write_stream(self.client, b'data/value', [self.data])
+        self.store.write('data/value/1', self.store.read('data/value/2'))
+
+        with self.assertRaises(StreamCorruptError):
+            self._read()
+        self.assertEqual(len(self._read(verify=False)), len(self.data))
+
+    def test_abandoned_write_unreadable(self):
+        write_stream(self.client, b'data/value', [self.data])
+
+        with self.assertRaises(RuntimeError):
+            with ChunkWriter(self.client, b'data/value') as writer:
+                writer.write(self.data)
+                raise RuntimeError('stopped')
+
+        with self.assertRaises(pyxs.PyXSError):
+            self._read()
+
+    def test_chunk_size_checked(self):
+        with self.assertRaises(ValueError):
+            ChunkWriter(self.client, b'data/value', chunk_size=4096)
+
+
+class WinPVStreamTester(StreamTester):
+
+    backend = 'winpv'
+
+
+class WinPVWorkersStreamTester(StreamTester):
+
+    backend = 'winpv-workers'
+
+
+class WinPVThreadsStreamTester(StreamTester):
+
+    backend = 'winpv-threads'
+
+
+if __name__ == '__main__':
+    unittest.main()
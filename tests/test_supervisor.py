@@ -0,0 +1,265 @@
+import unittest
+
+import mock
+import pyxs
+
+from win_pyxs.exceptions import CircuitOpenError
+from win_pyxs.simulator import Simulator
+from win_pyxs.supervisor import (
+    CIRCUIT_CLOSED, CIRCUIT_OPEN, GAVE_UP, RECOVERED, REPLAYED, RETRYING,
+    SESSION_LOST, Backoff, CircuitBreaker, ReconnectSupervisor
+)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+class Failing(object):
+    """
+    A function which fails the given number of times before succeeding.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise IOError('attempt {0} failed'.format(self.calls))
+        return 'connected'
+
+
+class BackoffTester(unittest.TestCase):
+
+    def test_exponential_up_to_maximum(self):
+        backoff = Backoff(0.1, 1.0, jitter=0.0)
+
+        self.assertEqual(
+            [round(backoff.delay(retry), 3) for retry in range(6)],
+            [0.1, 0.2, 0.4, 0.8, 1.0, 1.0]
+        )
+
+    def test_jitter(self):
+        self.assertEqual(Backoff(1.0, 1.0, random=lambda: 1.0).delay(0), 0.5)
+        self.assertEqual(Backoff(1.0, 1.0, random=lambda: 0.0).delay(0), 1.0)
+
+
+class CircuitBreakerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(2, reset_timeout=10, clock=self.clock)
+
+    def test_opens_after_threshold(self):
+        self.assertFalse(self.breaker.failure())
+        self.breaker.check()
+        self.assertTrue(self.breaker.failure())
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.check()
+
+    def test_half_open_lets_one_attempt_through(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.clock.now = 10
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.check()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.check()
+
+        # The trial failing starts a new cool-down
+        self.assertFalse(self.breaker.failure())
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.clock.now = 20
+        self.breaker.check()
+        self.assertTrue(self.breaker.success())
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.failures, 0)
+
+
+class ReconnectSupervisorTester(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.supervisor = ReconnectSupervisor(
+            Backoff(1.0, 4.0, jitter=0.0), deadline=10,
+            breaker=CircuitBreaker(2, reset_timeout=60, clock=self.clock),
+            clock=self.clock, sleep=self.clock.sleep
+        )
+        self.events = []
+        self.supervisor.add_listener(self.events.append)
+
+    def _kinds(self):
+        return [event.kind for event in self.events]
+
+    def test_retries_until_success(self):
+        func = Failing(2)
+
+        self.assertEqual(self.supervisor.run(func), 'connected')
+        self.assertEqual(func.calls, 3)
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0])
+        self.assertEqual(self._kinds(), [RETRYING, RETRYING, RECOVERED])
+        self.assertFalse(self.supervisor.degraded)
+
+    def test_retry_limit(self):
+        func = Failing(5)
+
+        with self.assertRaises(IOError):
+            self.supervisor.run(func, retries=1)
+        self.assertEqual(func.calls, 2)
+        self.assertEqual(self._kinds(), [RETRYING, GAVE_UP])
+
+    def test_deadline(self):
+        func = Failing(10)
+
+        with self.assertRaises(IOError):
+            self.supervisor.run(func)
+        # 1 + 2 + 4 seconds of delays, another 4 would pass the deadline
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0])
+        self.assertEqual(func.calls, 4)
+
+    def test_circuit_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(IOError):
+                self.supervisor.run(Failing(1), retries=0)
+        self.assertEqual(self._kinds()[-1], CIRCUIT_OPEN)
+        self.assertTrue(self.supervisor.degraded)
+
+        func = Failing(0)
+        with self.assertRaises(CircuitOpenError):
+            self.supervisor.run(func)
+        self.assertEqual(func.calls, 0)
+
+        self.clock.now += 60
+        self.assertEqual(self.supervisor.run(func), 'connected')
+        self.assertEqual(self._kinds()[-1], CIRCUIT_CLOSED)
+        self.assertFalse(self.supervisor.degraded)
+
+    def test_failing_listener_is_ignored(self):
+        def listener(_event):
+            raise ValueError('broken listener')
+
+        self.supervisor.add_listener(listener)
+        self.assertEqual(self.supervisor.run(Failing(1)), 'connected')
+        self.supervisor.remove_listener(listener)
+
+
+class WinPVSupervisorTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.simulator.store.write('data/key', 'value')
+
+        self.clock = FakeClock()
+        self.supervisor = ReconnectSupervisor(
+            Backoff(0.1, 1.0, jitter=0.0), clock=self.clock,
+            sleep=self._sleep
+        )
+        self.events = []
+        self.supervisor.add_listener(self.events.append)
+
+    def _sleep(self, delay):
+        self.clock.sleep(delay)
+        # WMI becomes available again after the first retry
+        if len(self.clock.sleeps) == 2:
+            self.simulator.wmi.connect_faults.failure_rate = 0.0
+
+    def _client(self, **kwargs):
+        from win_pyxs import XenBusConnectionWinPV
+
+        connection = XenBusConnectionWinPV(supervisor=self.supervisor,
+                                           **kwargs)
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+        return connection, client
+
+    def test_connect_retries_with_backoff(self):
+        self.simulator.wmi.connect_faults.failure_rate = 1.0
+
+        connection, client = self._client()
+
+        self.assertEqual(client.read(b'data/key'), b'value')
+        self.assertEqual(self.clock.sleeps, [0.1, 0.2])
+        self.assertEqual(
+            connection.metrics.snapshot()['counters']['wmi_connect_retries'],
+            2
+        )
+
+    def test_read_replayed_on_new_session(self):
+        connection, client = self._client()
+        self.simulator.wmi.end_session(connection.session_id)
+
+        self.assertEqual(client.read(b'data/key'), b'value')
+        self.assertEqual(
+            [event.kind for event in self.events], [SESSION_LOST, REPLAYED]
+        )
+        self.assertEqual(len(self.simulator.wmi.sessions), 1)
+        self.assertIn(connection.session_id, self.simulator.wmi.sessions)
+
+    def test_write_not_replayed(self):
+        connection, client = self._client()
+        self.simulator.wmi.end_session(connection.session_id)
+
+        with self.assertRaises(pyxs.PyXSError):
+            client.write(b'data/key', b'other')
+        self.assertEqual(self.simulator.store.read('data/key'), 'value')
+
+        # The next request uses the new session
+        client.write(b'data/key', b'other')
+        self.assertEqual(self.simulator.store.read('data/key'), 'other')
+
+    def test_missing_keys_rarely_probe_the_session(self):
+        from win_pyxs import XenBusConnectionWinPV, winpv
+
+        connection, client = self._client()
+        with mock.patch.object(winpv, '_clock', self.clock), \
+                mock.patch.object(
+                    XenBusConnectionWinPV, '_session_lost', autospec=True,
+                    return_value=False
+                ) as session_lost:
+            for _ in range(3):
+                with self.assertRaises(pyxs.PyXSError):
+                    client.read(b'data/missing')
+            self.assertEqual(session_lost.call_count, 1)
+
+            self.clock.now += winpv.SESSION_PROBE_INTERVAL
+            with self.assertRaises(pyxs.PyXSError):
+                client.read(b'data/missing')
+            self.assertEqual(session_lost.call_count, 2)
+
+            # Other failures always look for the session
+            self.simulator.wmi.faults.failure_rate = 1.0
+            for _ in range(2):
+                with self.assertRaises(pyxs.PyXSError):
+                    client.read(b'data/key')
+            self.assertEqual(session_lost.call_count, 4)
+
+    def test_worker_session_replaced(self):
+        connection, client = self._client(sessions=2)
+        for session_id in list(self.simulator.wmi.sessions):
+            self.simulator.wmi.end_session(session_id)
+
+        self.assertEqual(client.read(b'data/key'), b'value')
+        self.assertIn(REPLAYED, [event.kind for event in self.events])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import io
+import os
+import tempfile
+import unittest
+
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs import trace
+from win_pyxs.simulator import Simulator
+
+
+class PacketTracerTester(unittest.TestCase):
+
+    def test_ring_keeps_newest(self):
+        tracer = trace.PacketTracer(capacity=3)
+        for rq_id in range(1, 6):
+            tracer.sent(Packet(Op.READ, b'domid\x00', rq_id))
+
+        records = tracer.records()
+        self.assertEqual([record.rq_id for record in records], [3, 4, 5])
+        self.assertEqual(records[0].op, Op.READ)
+        self.assertEqual(records[0].size, 6)
+
+    def test_sampling(self):
+        tracer = trace.PacketTracer(sample=2)
+        for rq_id in range(1, 5):
+            tracer.sent(Packet(Op.READ, b'a\x00', rq_id))
+            tracer.received(Packet(Op.READ, b'', rq_id))
+        tracer.received(Packet(Op.WATCH_EVENT, b'a\x00t\x00', 0))
+
+        self.assertEqual(
+            [(record.kind, record.rq_id) for record in tracer.records()],
+            [(trace.SEND, 2), (trace.RECV, 2), (trace.SEND, 4),
+             (trace.RECV, 4), (trace.RECV, 0)]
+        )
+
+        tracer.sample = 0
+        tracer.sent(Packet(Op.READ, b'a\x00', 6))
+        self.assertEqual(len(tracer), 5)
+
+    def test_dump_and_load(self):
+        tracer = trace.PacketTracer()
+        tracer.sent(Packet(Op.READ, b'a\x00', 1))
+        tracer.received(Packet(Op.ERROR, b'ENOENT\x00', 1))
+
+        dump = io.BytesIO()
+        tracer.dump(dump)
+        dump.seek(0)
+        records = trace.load(dump)
+
+        self.assertEqual(records, tracer.records())
+        self.assertEqual(records[1].outcome, trace.ERROR)
+        self.assertIn('ERROR', trace.format_record(records[1], records[0]))
+
+    def test_dump_on_failure(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+
+        tracer = trace.PacketTracer(dump_path=path)
+        tracer.failed(Packet(Op.WRITE, b'a\x00b', 1))
+
+        records = trace.load(path)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].outcome, trace.FAILED)
+
+
+class ConnectionTraceTester(unittest.TestCase):
+
+    def test_connections_record_packets(self):
+        with Simulator():
+            from win_pyxs import XenBusConnectionGPLPV, XenBusConnectionWinPV
+
+            for connection in (XenBusConnectionWinPV(sessions=2),
+                               XenBusConnectionGPLPV()):
+                with pyxs.Client(router=pyxs.Router(connection)) as client:
+                    client.read(b'domid')
+
+                kinds = [
+                    (record.kind, record.op)
+                    for record in connection.tracer.records()
+                ]
+                self.assertEqual(
+                    kinds, [(trace.SEND, Op.READ), (trace.RECV, Op.READ)]
+                )
@@ -0,0 +1,134 @@
+import threading
+import unittest
+
+import pyxs
+
+from win_pyxs.simulator import Simulator
+from win_pyxs.transaction import Transaction
+
+from tests.test_watch import DictReader
+
+
+class TransactionTester(unittest.TestCase):
+
+    def setUp(self):
+        self.values = {b'data': b'', b'data/a': b'1', b'data/b': b'2'}
+        self.reader = DictReader(self.values)
+        self.transaction = Transaction(1)
+
+    def test_reads_see_buffered_changes(self):
+        self.transaction.write(b'data/a', b'3')
+        self.transaction.write(b'data/c/d', b'4')
+        self.assertTrue(self.transaction.remove(self.reader, b'data/b'))
+
+        self.assertEqual(self.transaction.read(self.reader, b'data/a'), b'3')
+        self.assertEqual(self.transaction.read(self.reader, b'data/c'), b'')
+        self.assertIsNone(self.transaction.read(self.reader, b'data/b'))
+        self.assertEqual(
+            sorted(self.transaction.directory(self.reader, b'data')),
+            [b'a', b'c']
+        )
+        # Nothing is written until the transaction is committed
+        self.assertEqual(self.values[b'data/a'], b'1')
+
+    def test_remove_then_recreate(self):
+        self.transaction.write(b'data/a', b'3')
+        self.assertTrue(self.transaction.remove(self.reader, b'data'))
+        self.transaction.write(b'data/e', b'5')
+
+        self.assertEqual(self.transaction.read(self.reader, b'data'), b'')
+        self.assertIsNone(self.transaction.read(self.reader, b'data/a'))
+        self.assertEqual(
+            self.transaction.directory(self.reader, b'data'), [b'e']
+        )
+        self.assertEqual(self.transaction.mutations, [
+            (b'data', None), (b'data/e', b'5')
+        ])
+
+    def test_writes_are_coalesced(self):
+        for value in (b'1', b'2', b'3'):
+            self.transaction.write(b'data/a', value)
+        self.assertEqual(self.transaction.mutations, [(b'data/a', b'3')])
+
+    def test_conflicts(self):
+        self.transaction.read(self.reader, b'data/a')
+        self.transaction.directory(self.reader, b'data')
+        self.transaction.write(b'data/blind', b'x')
+        self.assertEqual(self.transaction.conflicts(self.reader), [])
+
+        self.values[b'data/blind'] = b'y'
+        self.values[b'data/a'] = b'changed'
+        self.assertEqual(
+            self.transaction.conflicts(self.reader), [b'data', b'data/a']
+        )
+
+
+class WinPVTransactionTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.simulator.store.write('data/counter', '0')
+
+    def _client(self, **kwargs):
+        from win_pyxs import XenBusConnectionWinPV
+
+        return pyxs.Client(
+            router=pyxs.Router(XenBusConnectionWinPV(**kwargs))
+        )
+
+    def test_commit(self):
+        with self._client() as client:
+            client.transaction()
+            client.write(b'data/a', b'1')
+            client.write(b'data/b', b'2')
+            self.assertEqual(client.read(b'data/a'), b'1')
+            self.assertFalse(self.simulator.store.exists('data/a'))
+            self.assertTrue(client.commit())
+
+        self.assertEqual(self.simulator.store.read('data/a'), '1')
+        self.assertEqual(self.simulator.store.read('data/b'), '2')
+
+    def test_rollback(self):
+        with self._client() as client:
+            client.transaction()
+            client.write(b'data/a', b'1')
+            client.rollback()
+
+        self.assertFalse(self.simulator.store.exists('data/a'))
+
+    def test_conflict(self):
+        with self._client() as client:
+            client.transaction()
+            value = client.read(b'data/counter')
+            self.simulator.store.write('data/counter', '5')
+            client.write(b'data/counter', str(int(value) + 1).encode())
+            self.assertFalse(client.commit())
+
+        self.assertEqual(self.simulator.store.read('data/counter'), '5')
+
+    def _increment(self, count, **kwargs):
+        with self._client(**kwargs) as client:
+            for _ in range(count):
+                while True:
+                    client.transaction()
+                    value = int(client.read(b'data/counter'))
+                    client.write(
+                        b'data/counter', str(value + 1).encode('ascii')
+                    )
+                    if client.commit():
+                        break
+
+    def test_concurrent_increments(self):
+        threads = [
+            threading.Thread(target=self._increment, args=(20,), kwargs=kwargs)
+            for kwargs in ({}, {'sessions': 2})
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every conflicting increment was retried
+        self.assertEqual(self.simulator.store.read('data/counter'), '40')
@@ -0,0 +1,203 @@
+import threading
+import time
+import unittest
+
+import mock
+import pyxs
+from pyxs._internal import Op
+
+from win_pyxs.simulator import Simulator
+from win_pyxs.watch import WatchPoller, diff, snapshot
+
+
+class DictReader(object):
+    """
+    A reader over a dict of path -> value where children are found from the
+    paths.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.closed = False
+
+    def read(self, path):
+        return self.values.get(path)
+
+    def children(self, path):
+        return [
+            other[len(path) + 1:] for other in self.values
+            if other.startswith(path + b'/')
+            and b'/' not in other[len(path) + 1:]
+        ]
+
+    def close(self):
+        self.closed = True
+
+
+class SnapshotTester(unittest.TestCase):
+
+    def setUp(self):
+        self.values = {
+            b'data': b'',
+            b'data/a': b'1',
+            b'data/b': b'',
+            b'data/b/c': b'2',
+        }
+        self.reader = DictReader(self.values)
+        self.old = snapshot(self.reader, b'data')
+
+    def test_snapshot(self):
+        self.assertEqual(sorted(self.old), sorted(self.values))
+        self.assertEqual(snapshot(self.reader, b'missing'), {})
+
+    def test_unchanged(self):
+        self.assertEqual(diff(self.old, snapshot(self.reader, b'data')), (
+            [], []
+        ))
+
+    def test_value_changed_and_added(self):
+        self.values[b'data/a'] = b'3'
+        self.values[b'data/d'] = b''
+        self.values[b'data/d/e'] = b''
+
+        # Only the deepest added node is reported
+        self.assertEqual(diff(self.old, snapshot(self.reader, b'data')), (
+            [b'data/a', b'data/d/e'], []
+        ))
+
+    def test_removed_subtree(self):
+        del self.values[b'data/b']
+        del self.values[b'data/b/c']
+
+        self.assertEqual(diff(self.old, snapshot(self.reader, b'data')), (
+            [], [b'data/b']
+        ))
+
+    def test_root_removed(self):
+        self.assertEqual(diff(self.old, {}), ([], [b'data']))
+
+
+class WatchPollerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.values = {b'data': b'', b'data/a': b'1', b'data/a/b': b'2'}
+        self.events = []
+        self.fired = threading.Condition()
+
+        self.poller = WatchPoller(
+            lambda: DictReader(self.values), self._fire,
+            min_interval=0.01, max_interval=0.05
+        )
+        self.addCleanup(self.poller.stop)
+
+    def _fire(self, path, token):
+        with self.fired:
+            self.events.append((path, token))
+            self.fired.notify_all()
+
+    def _wait_for(self, count):
+        with self.fired:
+            for _ in range(100):
+                if len(self.events) >= count:
+                    break
+                self.fired.wait(0.05)
+        return self.events[:count]
+
+    def test_overlapping_watches_share_a_poll(self):
+        reader = DictReader(self.values)
+        self.poller.watch(reader, b'data/a', b'inner')
+        self.poller.watch(reader, b'data', b'outer')
+        self.poller.watch(reader, b'data/a/b', b'innermost')
+
+        self.assertEqual(self.poller.roots, [b'data'])
+        self.assertEqual(self._wait_for(3), [
+            (b'data/a', b'inner'), (b'data', b'outer'),
+            (b'data/a/b', b'innermost'),
+        ])
+
+        del self.events[:]
+        self.values[b'data/a/b'] = b'3'
+        self.assertEqual(sorted(self._wait_for(3)), [
+            (b'data/a/b', b'inner'), (b'data/a/b', b'innermost'),
+            (b'data/a/b', b'outer'),
+        ])
+
+        self.assertTrue(self.poller.unwatch(b'data', b'outer'))
+        self.assertEqual(self.poller.roots, [b'data/a'])
+        self.assertFalse(self.poller.unwatch(b'data', b'outer'))
+
+    def test_removal_reaches_inner_watches(self):
+        self.poller.watch(DictReader(self.values), b'data/a/b', b'tok')
+        self._wait_for(1)
+        del self.events[:]
+
+        for path in (b'data/a', b'data/a/b'):
+            del self.values[path]
+        self.assertEqual(self._wait_for(1), [(b'data/a/b', b'tok')])
+
+    def test_interval_adapts(self):
+        self.poller.watch(DictReader(self.values), b'data', b'tok')
+        self._wait_for(1)
+
+        root = self.poller._roots[b'data']
+        for _ in range(200):
+            if root.interval == self.poller.max_interval:
+                break
+            time.sleep(0.01)
+        self.assertEqual(root.interval, self.poller.max_interval)
+
+        self.values[b'data/a'] = b'changed'
+        self.assertEqual(self._wait_for(2)[1], (b'data/a', b'tok'))
+        self.assertLess(root.interval, self.poller.max_interval)
+
+
+class WinPVWatchTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+
+        patches = [
+            mock.patch('win_pyxs.winpv.WATCH_POLL_MIN_INTERVAL', 0.01),
+            mock.patch('win_pyxs.winpv.WATCH_POLL_MAX_INTERVAL', 0.05),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _client(self, **kwargs):
+        from win_pyxs import XenBusConnectionWinPV
+
+        return pyxs.Client(
+            router=pyxs.Router(XenBusConnectionWinPV(**kwargs))
+        )
+
+    def _check_watch(self, client):
+        with client.monitor() as monitor:
+            monitor.watch(b'data', b'tok')
+            events = monitor.wait()
+            self.assertEqual(next(events), (b'data', b'tok'))
+
+            self.simulator.store.write('data/key', 'value')
+            self.assertEqual(next(events), (b'data/key', b'tok'))
+
+            self.simulator.store.rm('data')
+            self.assertEqual(next(events), (b'data', b'tok'))
+
+    def test_watch(self):
+        with self._client() as client:
+            self._check_watch(client)
+
+    def test_watch_with_session_workers(self):
+        with self._client(sessions=2) as client:
+            self._check_watch(client)
+
+    def test_unknown_watches(self):
+        with self._client() as client:
+            with self.assertRaises(pyxs.PyXSError):
+                client.ack(Op.UNWATCH, b'data\x00', b'tok\x00')
+            with self.assertRaises(pyxs.PyXSError):
+                client.ack(
+                    Op.WATCH, b'@introduceDomain\x00', b'tok\x00'
+                )
@@ -1,15 +1,36 @@
+import copy
+import itertools
+import select
+import socket
+import threading
 import unittest
 
 import mock
+from six.moves import queue
+from pyxs._internal import Op, Packet
+from pyxs.exceptions import InvalidPayload
 
-from win_pyxs import XenBusConnectionWinPV
+from win_pyxs import XenBusConnectionWinPV, winpv
+from win_pyxs.cache import ReadCache
+from win_pyxs.scheduler import RequestScheduler
+from win_pyxs.supervisor import SESSION_LOST
+from win_pyxs.writebehind import WriteBehind
 
 
 class WinPVTester(unittest.TestCase):
 
     def setUp(self):
+        # Each test patches wmi.WMI so it must not reuse a cached connection
+        winpv._wmi_namespace.reset()
+        self.addCleanup(winpv._wmi_namespace.reset)
+        users = mock.patch.dict(winpv._SESSION_USERS, clear=True)
+        users.start()
+        self.addCleanup(users.stop)
+
+        session_ids = itertools.count(3)
         self.base_mock = mock.MagicMock(name='wmi.WMI.XenProjectXenStoreBase')
-        self.base_mock.AddSession.return_value = [3]
+        self.base_mock.AddSession.side_effect = \
+            lambda Id: [next(session_ids)]
 
         self.session_mock = mock.MagicMock(
             name='wmi.WMI.XenProjectXenStoreBase.AddSession'
@@ -44,3 +65,448 @@ class WinPVTester(unittest.TestCase):
 
                 self.session_mock.EndSession.assert_called_with()
                 self.assertEqual(connection.session, None)
+
+    def test_session_pool(self):
+        self.session_mock.GetValue.return_value = ['value']
+        connection = XenBusConnectionWinPV(sessions=3)
+
+        with mock.patch('wmi.WMI', new=self.wmi_mock):
+            connection.connect()
+            self.assertEqual(self.base_mock.AddSession.call_count, 3)
+
+            rq_ids = list(range(10))
+            for rq_id in rq_ids:
+                connection.send(Packet(Op.READ, b'vm\x00', rq_id))
+
+            replies = [connection.recv() for _ in rq_ids]
+            self.assertEqual(
+                sorted(packet.rq_id for packet in replies), rq_ids
+            )
+            for packet in replies:
+                self.assertEqual(packet.op, Op.READ)
+                self.assertEqual(packet.payload, b'value')
+
+            connection.close()
+
+        self.assertEqual(self.session_mock.EndSession.call_count, 3)
+        self.assertFalse(connection.is_connected)
+
+    def test_session_pool_error_reply(self):
+        self.session_mock.GetValue.side_effect = RuntimeError('WMI failure')
+        connection = XenBusConnectionWinPV(sessions=2)
+
+        with mock.patch('wmi.WMI', new=self.wmi_mock):
+            connection.connect()
+            connection.send(Packet(Op.READ, b'vm\x00', 7))
+
+            packet = connection.recv()
+            self.assertEqual(packet.op, Op.ERROR)
+            self.assertEqual(packet.rq_id, 7)
+            self.assertEqual(packet.payload, b'EIO\x00')
+
+            connection.close()
+
+    def test_read_cache(self):
+        self.session_mock.GetValue.return_value = ['value']
+        connection = XenBusConnectionWinPV(cache=ReadCache())
+
+        with mock.patch('wmi.WMI', new=self.wmi_mock):
+            connection.connect()
+
+            for rq_id in range(3):
+                connection.send(Packet(Op.READ, b'vm\x00', rq_id))
+                self.assertEqual(connection.recv().payload, b'value')
+            self.assertEqual(self.session_mock.GetValue.call_count, 1)
+
+            connection.send(Packet(Op.WRITE, b'vm\x00new', 3))
+            connection.recv()
+            connection.send(Packet(Op.READ, b'vm\x00', 4))
+            connection.recv()
+            self.assertEqual(self.session_mock.GetValue.call_count, 2)
+
+            connection.close()
+
+    def test_send_many(self):
+        self.session_mock.GetValue.return_value = ['value']
+        connection = XenBusConnectionWinPV(sessions=2)
+
+        with mock.patch('wmi.WMI', new=self.wmi_mock):
+            connection.connect()
+
+            failures = connection.send_many([
+                Packet(Op.READ, b'vm\x00', 1),
+                Packet(Op.GET_PERMS, b'vm\x00', 2),
+                Packet(Op.READ, b'domid\x00', 3),
+            ])
+            self.assertEqual(list(failures), [2])
+            self.assertIsInstance(failures[2], NotImplementedError)
+
+            replies = [connection.recv() for _ in range(2)]
+            self.assertEqual(
+                sorted(packet.rq_id for packet in replies), [1, 3]
+            )
+
+            connection.close()
+
+
+class SessionReuseTester(unittest.TestCase):
+
+    def setUp(self):
+        from win_pyxs.simulator import Simulator
+
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.wmi = self.simulator.wmi
+
+    def _connect(self, connection, close=True):
+        connection.connect()
+        if close:
+            self.addCleanup(connection.close)
+        return connection
+
+    def _read(self, connection):
+        connection.send(Packet(Op.READ, b'domid\x00', 1))
+        return connection.recv().payload
+
+    def test_wmi_connected_once_per_thread(self):
+        for _ in range(3):
+            self._connect(XenBusConnectionWinPV(), close=False).close()
+        self.assertEqual(self.wmi.connects, 1)
+        self.assertEqual(self.wmi.sessions, {})
+
+        connection = XenBusConnectionWinPV()
+        thread = threading.Thread(target=connection.connect)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.wmi.connects, 2)
+
+        # Closed from a thread which did not open the session
+        connection.close()
+        self.assertEqual(self.wmi.sessions, {})
+
+    def test_reattach(self):
+        orphan = self.wmi.add_session('PyxsSession')
+        self.wmi.add_session('OtherSession')
+
+        connection = self._connect(XenBusConnectionWinPV(reattach=True))
+        self.assertEqual(connection.session_id, orphan.SessionId)
+        self.assertEqual(self._read(connection), b'0')
+        self.assertEqual(
+            connection.metrics.snapshot()['counters']['sessions_reattached'],
+            1
+        )
+
+        # The orphan is in use now so another connection adds a session
+        other = self._connect(XenBusConnectionWinPV(reattach=True))
+        self.assertNotEqual(other.session_id, orphan.SessionId)
+        self.assertEqual(self.wmi.sessions_added, 3)
+
+    def test_end_orphaned_sessions(self):
+        orphans = [self.wmi.add_session('PyxsSession') for _ in range(2)]
+        other = self.wmi.add_session('OtherSession')
+        connection = self._connect(XenBusConnectionWinPV())
+
+        self.assertEqual(
+            winpv.end_orphaned_sessions(),
+            [orphan.SessionId for orphan in orphans]
+        )
+        self.assertEqual(
+            sorted(self.wmi.sessions),
+            sorted([other.SessionId, connection.session_id])
+        )
+
+    def test_copy_shares_session(self):
+        connection = self._connect(XenBusConnectionWinPV(), close=False)
+        duplicate = self._connect(copy.copy(connection), close=False)
+
+        self.assertEqual(duplicate.session_id, connection.session_id)
+        self.assertEqual(self.wmi.sessions_added, 1)
+
+        duplicate.close()
+        self.assertEqual(self._read(connection), b'0')
+
+        connection.close()
+        self.assertEqual(self.wmi.sessions, {})
+
+    def test_copy_shares_observers(self):
+        connection = XenBusConnectionWinPV(
+            sessions=2, write_behind=WriteBehind(),
+            scheduler=RequestScheduler()
+        )
+        duplicate = copy.copy(connection)
+
+        self.assertIs(duplicate.metrics, connection.metrics)
+        self.assertIs(duplicate.tracer, connection.tracer)
+        self.assertIs(duplicate.supervisor, connection.supervisor)
+        self.assertIsNone(duplicate.write_behind)
+        self.assertIsNone(duplicate.scheduler)
+
+        # Each event is counted once in the shared metrics
+        connection.supervisor.emit(SESSION_LOST, error=OSError('gone'))
+        self.assertEqual(
+            connection.metrics.snapshot()['counters']['sessions_lost'], 1
+        )
+
+
+class ResponseQueueTester(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = winpv._ResponseQueue()
+        self.addCleanup(self.queue.close)
+
+    def _readable(self):
+        return bool(select.select([self.queue], [], [], 0)[0])
+
+    def test_notify_coalesced(self):
+        self.assertFalse(self._readable())
+
+        # Far more than would fit in the socket buffer one byte at a time
+        for rq_id in range(5000):
+            self.queue.put(Packet(Op.READ, b'', rq_id))
+        self.assertEqual(
+            len(self.queue.reader.recv(64, socket.MSG_PEEK)), 1
+        )
+
+        self.assertTrue(self._readable())
+        rq_ids = [self.queue.get().rq_id for _ in range(5000)]
+        self.assertEqual(rq_ids, list(range(5000)))
+        self.assertFalse(self._readable())
+
+    def test_concurrent_producers(self):
+        def _produce(base):
+            for rq_id in range(base, base + 1000):
+                self.queue.put(Packet(Op.READ, b'', rq_id))
+
+        threads = [
+            threading.Thread(target=_produce, args=(base, ))
+            for base in range(0, 4000, 1000)
+        ]
+        for thread in threads:
+            thread.start()
+
+        received = []
+        while len(received) < 4000:
+            select.select([self.queue], [], [])
+            received.append(self.queue.get().rq_id)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(received), list(range(4000)))
+        self.assertFalse(self._readable())
+
+    def test_reply(self):
+        request = Packet(Op.READ, b'data/key\x00', 7, 3)
+
+        self.assertEqual(
+            winpv._reply(request, b'value'),
+            Packet(Op.READ, b'value', 7, 3)
+        )
+        self.assertEqual(
+            winpv._error_packet(request), Packet(Op.ERROR, b'EIO\x00', 7, 3)
+        )
+        with self.assertRaises(InvalidPayload):
+            winpv._reply(request, b'v' * 4097)
+
+
+class ThreadSessionsTester(unittest.TestCase):
+
+    THREADS = 8
+    REQUESTS = 200
+
+    def setUp(self):
+        from win_pyxs.simulator import Simulator
+
+        # WMI objects used outside the thread which obtained them fail
+        self.simulator = Simulator(strict_apartments=True)
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.wmi = self.simulator.wmi
+
+    def _run_threads(self, target, count):
+        errors = []
+
+        def _run(index):
+            try:
+                target(index)
+            except Exception as exc:  # pylint: disable=W0703
+                errors.append(exc)
+
+        threads = [
+            threading.Thread(target=_run, args=(index, ))
+            for index in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_strict_provider_detects_shared_session(self):
+        connection = XenBusConnectionWinPV()
+        connection.connect()
+        self.addCleanup(connection.close)
+
+        def _read(_index):
+            connection.send(Packet(Op.READ, b'domid\x00', 1))
+
+        self._run_threads(_read, 1)
+        self.assertEqual(self.wmi.wrong_thread_calls, 1)
+        self.assertEqual(
+            connection.recv(), Packet(Op.ERROR, b'EIO\x00', 1)
+        )
+
+    def test_stress(self):
+        connection = XenBusConnectionWinPV(thread_sessions=True)
+        connection.connect()
+        rq_ids = itertools.count(1)
+
+        def _work(index):
+            prefix = 'data/{0}'.format(index).encode('ascii')
+            for number in range(self.REQUESTS):
+                key = prefix + b'/' + str(number % 10).encode('ascii')
+                value = str(number).encode('ascii')
+
+                reply = connection.execute(Packet(
+                    Op.WRITE, key + b'\x00' + value, next(rq_ids)
+                ))
+                assert reply.payload == b'OK', reply
+                reply = connection.execute(
+                    Packet(Op.READ, key + b'\x00', next(rq_ids))
+                )
+                assert reply.payload == value, reply
+                if number % 20 == 0:
+                    reply = connection.execute(
+                        Packet(Op.DIRECTORY, prefix + b'\x00', next(rq_ids))
+                    )
+                    assert reply.op == Op.DIRECTORY, reply
+
+        self._run_threads(_work, self.THREADS)
+
+        self.assertEqual(self.wmi.wrong_thread_calls, 0)
+        # One session for each thread & one for the thread which connected
+        self.assertEqual(self.wmi.sessions_added, self.THREADS + 1)
+        self.assertEqual(len(self.wmi.sessions), self.THREADS + 1)
+        self.assertEqual(
+            connection.metrics.snapshot()['counters']['thread_sessions'],
+            self.THREADS + 1
+        )
+
+        # The sessions of the other (now finished) threads are ended too
+        connection.close()
+        self.assertEqual(self.wmi.sessions, {})
+        self.assertEqual(self.wmi.wrong_thread_calls, 0)
+
+    def test_router(self):
+        import pyxs
+
+        connection = XenBusConnectionWinPV(thread_sessions=True)
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+
+        def _work(index):
+            key = 'data/router/{0}'.format(index).encode('ascii')
+            for number in range(20):
+                value = str(number).encode('ascii')
+                client.write(key, value)
+                assert client.read(key) == value
+
+        self._run_threads(_work, 4)
+        self.assertEqual(self.wmi.wrong_thread_calls, 0)
+
+    def test_release_thread(self):
+        connection = XenBusConnectionWinPV(thread_sessions=True)
+        connection.connect()
+        self.addCleanup(connection.close)
+
+        def _work(_index):
+            connection.execute(Packet(Op.READ, b'domid\x00', 1))
+            assert len(self.wmi.sessions) == 2
+            connection.release_thread()
+
+        self._run_threads(_work, 1)
+        self.assertEqual(len(self.wmi.sessions), 1)
+
+        # The thread which connected still has its session
+        self.assertEqual(
+            connection.execute(Packet(Op.READ, b'domid\x00', 2)).payload,
+            b'0'
+        )
+
+    def test_lost_thread_session_replaced(self):
+        connection = XenBusConnectionWinPV(thread_sessions=True)
+        connection.connect()
+        self.addCleanup(connection.close)
+
+        for session_id in list(self.wmi.sessions):
+            self.wmi.end_session(session_id)
+
+        self.assertEqual(
+            connection.execute(Packet(Op.READ, b'domid\x00', 1)).payload,
+            b'0'
+        )
+        self.assertEqual(len(self.wmi.sessions), 1)
+
+    def test_execute_errors(self):
+        connection = XenBusConnectionWinPV(thread_sessions=True)
+        connection.connect()
+        self.addCleanup(connection.close)
+
+        self.assertEqual(
+            connection.execute(Packet(Op.READ, b'data/missing\x00', 1)),
+            Packet(Op.ERROR, b'ENOENT\x00', 1)
+        )
+        self.wmi.faults.failure_rate = 1.0
+        self.assertEqual(
+            connection.execute(Packet(Op.READ, b'domid\x00', 2)),
+            Packet(Op.ERROR, b'EIO\x00', 2)
+        )
+        self.assertEqual(
+            connection.metrics.snapshot()['ops']['READ']['errors'], 2
+        )
+
+    def test_close_balances_com_initialisation(self):
+        calls = []
+        com = mock.Mock()
+        com.CoInitialize.side_effect = \
+            lambda: calls.append((threading.current_thread(), 1))
+        com.CoUninitialize.side_effect = \
+            lambda: calls.append((threading.current_thread(), -1))
+
+        actions, done = queue.Queue(), queue.Queue()
+
+        def _work():
+            for action in iter(actions.get, None):
+                done.put(action())
+
+        def _in_thread(action):
+            actions.put(action)
+            return done.get()
+
+        with mock.patch.object(winpv, 'pythoncom', com):
+            connection = XenBusConnectionWinPV(thread_sessions=True)
+            thread = threading.Thread(target=_work)
+            thread.start()
+            for rq_id in range(1, 4):
+                connection.connect()
+                reply = _in_thread(lambda: connection.execute(
+                    Packet(Op.READ, b'domid\x00', rq_id)
+                ))
+                self.assertEqual(reply.payload, b'0')
+                connection.close()
+            _in_thread(connection.release_thread)
+            actions.put(None)
+            thread.join()
+
+        # The other thread initialised COM once & undid it when released
+        self.assertEqual(
+            [delta for owner, delta in calls if owner is thread], [1, -1]
+        )
+        self.assertEqual(sum(delta for _owner, delta in calls), 0)
+        self.assertEqual(self.wmi.sessions, {})
+        self.assertEqual(self.wmi.wrong_thread_calls, 0)
+
+    def test_not_with_session_workers(self):
+        with self.assertRaises(ValueError):
+            XenBusConnectionWinPV(sessions=2, thread_sessions=True)
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs import workload
+from win_pyxs.simulator import Simulator
+
+
+class WorkloadTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def _connect(self):
+        from win_pyxs import XenBusConnectionGPLPV
+
+        client = pyxs.Client(router=pyxs.Router(XenBusConnectionGPLPV()))
+        client.connect()
+        return client
+
+    def test_record_and_replay(self):
+        with workload.PacketRecorder(self.path) as recorder:
+            client = self._connect()
+            client.write(b'data/key', b'value')
+            client.read(b'data/key')
+            client.close()
+        self.assertEqual(recorder.packets, 2)
+
+        operations = workload.recorded_operations(self.path, speed=0)
+        self.assertEqual(
+            [(operation.op, operation.payload) for operation in operations],
+            [(Op.WRITE, b'data/key\x00value'), (Op.READ, b'data/key\x00')]
+        )
+
+        report = workload.run_workload(self._connect, operations, threads=3)
+        self.assertEqual(report.operations, 6)
+        self.assertEqual(report.errors, {})
+
+    def test_recorded_rate(self):
+        with workload.PacketRecorder(self.path):
+            client = self._connect()
+            for _ in range(3):
+                client.read(b'domid')
+            client.close()
+
+        operations = workload.recorded_operations(
+            self.path, rate=10, loops=2
+        )
+        self.assertEqual(
+            [operation.offset for operation in operations],
+            [index / 10.0 for index in range(6)]
+        )
+
+    def test_records_batches_and_executed_requests(self):
+        from win_pyxs import XenBusConnectionWinPV
+        from win_pyxs.bulk import read_many, write_many
+        from win_pyxs.writebehind import WriteBehind
+
+        with workload.PacketRecorder(self.path) as recorder:
+            connection = XenBusConnectionWinPV(
+                sessions=2, write_behind=WriteBehind(interval=60)
+            )
+            with pyxs.Client(router=pyxs.Router(connection)) as client:
+                write_many(client, {b'data/a': b'1', b'data/b': b'2'})
+                read_many(client, [b'data/a', b'data/b'])
+
+            connection = XenBusConnectionWinPV(thread_sessions=True)
+            connection.connect()
+            connection.execute(Packet(Op.READ, b'data/a\x00', 1))
+            connection.close()
+
+        # The writes flushed by the WriteBehind are not recorded again
+        self.assertEqual(
+            sorted((op, payload) for _offset, op, _tx_id, payload
+                   in workload.read_recording(self.path)),
+            sorted([(Op.WRITE, b'data/a\x001'), (Op.WRITE, b'data/b\x002'),
+             (Op.READ, b'data/a\x00'), (Op.READ, b'data/b\x00'),
+             (Op.READ, b'data/a\x00')])
+        )
+        self.assertEqual(recorder.packets, 5)
+
+    def test_synthetic_load(self):
+        operations = workload.synthetic_operations(
+            200, mix={'read': 1, 'directory': 1}, keys=5, seed=1
+        )
+        ops = set(operation.op for operation in operations)
+        self.assertEqual(ops, set([Op.READ, Op.DIRECTORY]))
+
+        client = self._connect()
+        workload.prepare_keys(client, keys=5)
+        client.close()
+
+        report = workload.run_workload(self._connect, operations, threads=2)
+        summary = report.summary()
+        self.assertEqual(summary['operations'], 400)
+        self.assertEqual(summary['errors'], {})
+        self.assertTrue(summary['p50'] <= summary['p99'] <= summary['max'])
+
+    def test_errors_are_counted(self):
+        operations = [workload.Operation(0.0, Op.READ, b'data/missing\x00')]
+        report = workload.run_workload(self._connect, operations)
+        self.assertEqual(report.errors, {'READ ENOENT': 1})
+
+
+class CommandLineTester(unittest.TestCase):
+
+    def test_load(self):
+        from win_pyxs import __main__ as cli
+
+        self.addCleanup(setattr, cli, '_SIMULATOR', None)
+        self.addCleanup(lambda: cli._SIMULATOR.uninstall())
+
+        with mock.patch('win_pyxs.__main__._report') as report:
+            cli._main([
+                'load', '--simulate', '-q', '--backend', 'winpv',
+                '--count', '20', '--threads', '2'
+            ])
+
+        self.assertEqual(report.call_args[0][1].operations, 40)
@@ -0,0 +1,227 @@
+import time
+import unittest
+
+import pyxs
+from pyxs._internal import Op, Packet
+
+from win_pyxs.simulator import Simulator
+from win_pyxs.writebehind import WriteBehind
+
+from tests.helpers import backend_connection
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class WriteBehindTester(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        # Only flushed explicitly
+        self.buffer = WriteBehind(interval=3600, max_age=60, clock=self.clock)
+        self.sent = []
+        self.buffer.attach(self._send)
+        self.addCleanup(self.buffer.detach)
+
+    def _send(self, packets):
+        self.sent.extend(packet.payload for packet in packets)
+        for packet in packets:
+            self.buffer.completed(Packet(Op.WRITE, b'OK\x00', packet.rq_id))
+        return {}
+
+    def _write(self, path, value, rq_id=1):
+        return self.buffer.submit(
+            Packet(Op.WRITE, path + b'\x00' + value, rq_id)
+        )
+
+    def test_coalesces_and_drops_unchanged(self):
+        self.assertEqual(self._write(b'data/a', b'1'), b'OK')
+        self._write(b'data/a', b'2')
+        self._write(b'data/b', b'1')
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.sent, [b'data/a\x002', b'data/b\x001'])
+
+        self._write(b'data/a', b'2')
+        self._write(b'data/b', b'3')
+        self._write(b'data/b', b'1')
+        self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(self.buffer.stats(), dict(
+            self.buffer.stats(), writes=6, unchanged=2, coalesced=2,
+            avoided=4, flushed=2, flushes=1
+        ))
+
+    def test_max_age(self):
+        self._write(b'data/a', b'1')
+        self.buffer.flush()
+
+        self.clock.now = 59
+        self._write(b'data/a', b'1')
+        self.assertEqual(len(self.buffer), 0)
+
+        self.clock.now = 60
+        self._write(b'data/a', b'1')
+        self.assertEqual(len(self.buffer), 1)
+
+    def test_read_of_buffered_key(self):
+        self._write(b'data/a', b'1')
+
+        self.assertEqual(
+            self.buffer.submit(Packet(Op.READ, b'data/a\x00', 2)), b'1'
+        )
+        self.assertIsNone(
+            self.buffer.submit(Packet(Op.READ, b'data/b\x00', 3))
+        )
+        self.assertEqual(self.sent, [])
+
+    def test_related_requests_wait_for_flush(self):
+        self._write(b'data/a', b'1')
+        self.buffer.submit(Packet(Op.DIRECTORY, b'data\x00', 2))
+        self.assertEqual(self.sent, [b'data/a\x001'])
+
+        self._write(b'other/a', b'1')
+        self.buffer.submit(Packet(Op.TRANSACTION_START, b'\x00', 3))
+        self.assertEqual(len(self.sent), 2)
+
+    def test_rm_forgets_written_values(self):
+        self._write(b'data/a/b', b'1')
+        self.buffer.flush()
+
+        self.buffer.submit(Packet(Op.RM, b'data/a\x00', 2))
+        self._write(b'data/a/b', b'1')
+        self.assertEqual(len(self.buffer), 1)
+
+    def test_failed_write_is_retried(self):
+        self._write(b'data/a', b'1')
+        failures = []
+
+        def _send(packets):
+            for packet in packets:
+                failures.append(packet)
+                self.buffer.completed(
+                    Packet(Op.ERROR, b'EIO\x00', packet.rq_id)
+                )
+            return {}
+
+        self.buffer.attach(_send)
+        self.buffer.flush()
+        self._write(b'data/a', b'1')
+
+        self.assertEqual(self.buffer.failures, 1)
+        self.assertEqual(len(self.buffer), 1)
+
+
+class ConnectionWriteBehindTester(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = Simulator()
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.store = self.simulator.store
+
+    def _client(self, backend, **kwargs):
+        self.buffer = WriteBehind(**kwargs)
+        connection = backend_connection(backend, write_behind=self.buffer)
+        client = pyxs.Client(router=pyxs.Router(connection))
+        client.connect()
+        self.addCleanup(client.close)
+        return connection, client
+
+    def _check_buffered(self, backend):
+        connection, client = self._client(backend, interval=3600)
+
+        for value in (b'1', b'2', b'2'):
+            client.write(b'data/metric', value)
+        self.assertFalse(self.store.exists('data/metric'))
+        self.assertEqual(client.read(b'data/metric'), b'2')
+
+        # Listing the parent needs the write to have been made
+        self.assertEqual(client.list(b'data'), [b'metric'])
+        self.assertEqual(self.store.read('data/metric'), '2')
+
+        client.write(b'data/metric', b'2')
+        client.write(b'data/other', b'1')
+        client.close()
+        self.assertEqual(self.store.read('data/other'), '1')
+        self.assertEqual(
+            connection.metrics.snapshot()['gauges']['writes_avoided'], 3
+        )
+
+    def test_gplpv(self):
+        self._check_buffered('gplpv')
+
+    def test_winpv_workers(self):
+        self._check_buffered('winpv-workers')
+
+    def test_winpv_threads(self):
+        self._check_buffered('winpv-threads')
+
+    def _check_flushed_in_background(self, backend):
+        _connection, client = self._client(
+            backend, interval=0.05, max_pending=3
+        )
+        client.write(b'data/a', b'1')
+
+        deadline = time.time() + 5
+        while not self.store.exists('data/a') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.store.read('data/a'), '1')
+
+        self.buffer.interval = 3600
+        time.sleep(0.1)
+        for name in (b'b', b'c', b'd'):
+            client.write(b'data/' + name, b'1')
+        deadline = time.time() + 5
+        while not self.store.exists('data/d') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.store.read('data/d'), '1')
+
+    def test_flushed_in_background_gplpv(self):
+        self._check_flushed_in_background('gplpv')
+
+    def test_flushed_in_background_winpv_workers(self):
+        self._check_flushed_in_background('winpv-workers')
+
+    def test_flushed_in_background_winpv_threads(self):
+        self._check_flushed_in_background('winpv-threads')
+
+
+class WinPVApartmentTester(unittest.TestCase):
+
+    def setUp(self):
+        # WMI objects used outside the thread which obtained them fail
+        self.simulator = Simulator(strict_apartments=True)
+        self.simulator.install()
+        self.addCleanup(self.simulator.uninstall)
+        self.wmi = self.simulator.wmi
+
+    def test_not_with_a_single_session(self):
+        with self.assertRaises(ValueError):
+            backend_connection('winpv', write_behind=WriteBehind())
+
+    def test_flushed_with_a_session_of_its_own(self):
+        buffer = WriteBehind(interval=0.05)
+        connection = backend_connection('winpv-threads', write_behind=buffer)
+        with pyxs.Client(router=pyxs.Router(connection)) as client:
+            client.write(b'data/x', b'1')
+
+            deadline = time.time() + 5
+            while not self.simulator.store.exists('data/x') \
+                    and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.simulator.store.read('data/x'), '1')
+
+        self.assertEqual(buffer.failures, 0)
+        self.assertEqual(self.wmi.wrong_thread_calls, 0)
+        # Including the session of the thread of the WriteBehind
+        self.assertEqual(self.wmi.sessions, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,50 @@ versions of the Xen PV drivers. There are two possible connections:
 XenBusConnectionWinPV which can be used with the WinPV drivers available for
 modern versions of Windows & XenBusConnectionGPLPV which works with the GPLPV
 drivers which were available for older versions of Windows.
+
+win_pyxs.connect() returns a connection using whichever of the two is
+available.
+
+XenBusConnectionBroker connects to a broker (python -m win_pyxs serve) which
+shares one of those connections between the processes on this machine.
 """
 
-__all__ = ['XenBusConnectionWinPV', 'XenBusConnectionGPLPV']
+__all__ = [
+    'XenBusConnectionWinPV', 'XenBusConnectionGPLPV', 'XenBusConnectionBroker',
+    'connect',
+]
+
+import importlib
+import sys
+
+# The connection modules import Windows-only modules so they are only loaded
+# when first used. This lets win_pyxs.simulator install its stand-ins first.
+_LAZY = {
+    'XenBusConnectionBroker': '.broker',
+    'XenBusConnectionGPLPV': '.gplpv',
+    'XenBusConnectionWinPV': '.winpv',
+    'connect': '.detect',
+}
+
+if sys.version_info < (3, 7):
+    from .broker import XenBusConnectionBroker
+    from .detect import connect
+    from .gplpv import XenBusConnectionGPLPV
+    from .winpv import XenBusConnectionWinPV
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY[name]
+    except KeyError:
+        raise AttributeError(
+            'module {0!r} has no attribute {1!r}'.format(__name__, name)
+        )
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
 
-from .gplpv import XenBusConnectionGPLPV
-from .winpv import XenBusConnectionWinPV
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
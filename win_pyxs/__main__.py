@@ -1,19 +1,43 @@
 """
 Performs a simple access to xenstore and prints some details about the
 current VM.
+
+The record, replay & load commands capture & generate xenstore workloads for
+capacity planning (see win_pyxs.workload):
+
+    python -m win_pyxs record -o app.wpxr -- app.py [ARGS...]
+    python -m win_pyxs replay app.wpxr --threads 8 --speed 2
+    python -m win_pyxs load --mix read=80,write=15,directory=5 --rate 500
+
+Each of these accepts --backend (auto, winpv, gplpv or broker) & --simulate
+to run against win_pyxs.simulator rather than the real drivers.
+
+The serve command runs a broker sharing one connection to the drivers with
+every local process using --backend broker or XenBusConnectionBroker (see
+win_pyxs.broker):
+
+    python -m win_pyxs serve --address 127.0.0.1:47655 --allow-tcp
+
+Clients of a broker are not authenticated so it only listens on TCP (the
+default on Windows) with --allow-tcp, as any local user can then connect.
 """
 
 from __future__ import print_function
 
+import argparse
+import functools
+import json
 import logging
 from pprint import pprint
-
-import six
+import runpy
+import sys
 
 import pyxs
 
-from win_pyxs import XenBusConnectionWinPV, XenBusConnectionGPLPV
-from win_pyxs.exceptions import GPLPVDeviceOpenError, GPLPVDriverError
+_COMMANDS = ('info', 'record', 'replay', 'load', 'serve')
+
+# The simulator installed by --simulate in this process
+_SIMULATOR = None
 
 
 def _basic_logger_init(logger, verbose=False):
@@ -37,30 +61,76 @@ def _basic_logger_init(logger, verbose=False):
     logger.addHandler(handler)
 
 
-def _main():
-    logger = logging.getLogger('win_pyxs')
-    _basic_logger_init(logger, verbose=True)
+def _simulate(latency=0.0, jitter=0.0, values=None):
+    """
+    Install a win_pyxs.simulator.Simulator for the rest of this process.
+    """
+    global _SIMULATOR
 
-    try:
-        con = XenBusConnectionGPLPV()
-        logger.info('Using XenBusConnectionGPLPV')
-    except (GPLPVDeviceOpenError, GPLPVDriverError) as gplpv_exc:
-        try:
-            con = XenBusConnectionWinPV()
-            logger.info('Using XenBusConnectionWinPV')
-        except Exception as winpv_exc:
-            six.raise_from(winpv_exc, gplpv_exc)
+    if _SIMULATOR is None:
+        from win_pyxs.simulator import Faults, Simulator
+
+        faults = dict(latency=latency, jitter=jitter)
+        _SIMULATOR = Simulator(
+            wmi_faults=Faults(**faults), device_faults=Faults(**faults)
+        )
+        _SIMULATOR.install()
+        for path, value in (values or {}).items():
+            _SIMULATOR.store.write(path, value)
+
+    return _SIMULATOR
+
+
+def _connection(backend='auto'):
+    # Imported here so that a simulator can be installed first
+    from win_pyxs import (
+        XenBusConnectionBroker, XenBusConnectionWinPV, XenBusConnectionGPLPV,
+        connect
+    )
+
+    if backend == 'winpv':
+        return XenBusConnectionWinPV()
+    if backend == 'gplpv':
+        return XenBusConnectionGPLPV()
+    if backend == 'broker':
+        return XenBusConnectionBroker()
+
+    con = connect()
+    logging.getLogger('win_pyxs').info('Using %s', con.__class__.__name__)
+    return con
 
-    router = pyxs.Router(con)
+
+def _connect_client(backend='auto', simulate=False, latency=0.0, jitter=0.0,
+                    values=None):
+    """
+    Return a connected pyxs.Client. This is passed to the workload worker
+    processes so it must stay a module-level function.
+    """
+    if simulate:
+        _simulate(latency=latency, jitter=jitter, values=values)
+
+    client = pyxs.Client(router=pyxs.Router(_connection(backend)))
+    client.connect()
+    return client
+
+
+def _demo(args):
+    if args.simulate:
+        _simulate(values={
+            'device/vif/0/mac': '00:16:3e:00:00:00',
+            'drivers': '',
+        })
+
+    router = pyxs.Router(_connection(args.backend))
     with pyxs.Client(router=router) as client:
-        my_uuid = client.read("vm")
+        my_uuid = client.read(b"vm")
         print('My UUID: ', my_uuid)
-        my_domid = client.read("domid")
+        my_domid = client.read(b"domid")
         print('My DomID:', my_domid)
-        my_mac = client.read("device/vif/0/mac")
+        my_mac = client.read(b"device/vif/0/mac")
         print('My MAC:  ', my_mac)
         caption, first = 'Drivers: ', True
-        for driver in client.list("drivers"):
+        for driver in client.list(b"drivers"):
             if first:
                 first = False
             print(caption, client.read(driver))
@@ -68,7 +138,282 @@ def _main():
         if first:
             print(caption, 'GPLPV (None in xenstore)')
         print('My Home:')
-        pprint(client.list("/local/domain/{}".format(my_domid)))
+        pprint(client.list(b"/local/domain/" + my_domid))
+
+
+def _record(args):
+    from win_pyxs.workload import PacketRecorder
+
+    if args.simulate:
+        _simulate(latency=args.latency, jitter=args.jitter)
+
+    command = list(args.command)
+    if command and command[0] == '--':
+        command.pop(0)
+    if not command:
+        raise SystemExit('record needs a script (or -m module) to run')
+
+    argv = sys.argv
+    with PacketRecorder(args.output) as recorder:
+        try:
+            if command[0] == '-m':
+                sys.argv = command[1:]
+                runpy.run_module(command[1], run_name='__main__')
+            else:
+                sys.argv = command
+                runpy.run_path(command[0], run_name='__main__')
+        finally:
+            sys.argv = argv
+
+    print('Recorded {0} packets to {1}'.format(
+        recorder.packets, args.output
+    ), file=sys.stderr)
+
+
+def _parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _sep, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _parse_sessions(text):
+    sessions = int(text)
+    if sessions < 2:
+        # The broker sends from the thread serving each client, which a
+        # single WinPV session cannot be used from
+        raise argparse.ArgumentTypeError('the broker needs at least 2')
+    return sessions
+
+
+def _report(args, report):
+    if args.json:
+        print(json.dumps(report.summary(), indent=2, sort_keys=True))
+    else:
+        print(report.format())
+
+
+def _replay(args):
+    from win_pyxs.workload import recorded_operations, run_workload
+
+    operations = recorded_operations(
+        args.recording, speed=args.speed, rate=args.rate, loops=args.loops
+    )
+    connect = functools.partial(
+        _connect_client, backend=args.backend, simulate=args.simulate,
+        latency=args.latency, jitter=args.jitter
+    )
+    _report(args, run_workload(
+        connect, operations, threads=args.threads, processes=args.processes
+    ))
+
+
+def _load(args):
+    from win_pyxs.workload import run_workload, synthetic_operations
+
+    prefix = args.prefix.encode('ascii')
+    operations = synthetic_operations(
+        args.count, mix=_parse_mix(args.mix), rate=args.rate, prefix=prefix,
+        keys=args.keys, value_size=args.value_size, seed=args.seed
+    )
+
+    # Make sure the keys exist so that reads succeed
+    values = dict(
+        ('{0}/{1}'.format(args.prefix, index), '0')
+        for index in range(args.keys)
+    )
+    connect = functools.partial(
+        _connect_client, backend=args.backend, simulate=args.simulate,
+        latency=args.latency, jitter=args.jitter, values=values
+    )
+    if not args.simulate:
+        from win_pyxs.workload import prepare_keys
+
+        client = connect()
+        try:
+            prepare_keys(client, prefix=prefix, keys=args.keys)
+        finally:
+            client.close()
+
+    _report(args, run_workload(
+        connect, operations, threads=args.threads, processes=args.processes
+    ))
+
+
+def _serve(args):
+    from win_pyxs.broker import XenStoreBroker, default_address, parse_address
+    from win_pyxs.detect import connection_class, detect_backend
+
+    address = parse_address(args.address) if args.address \
+        else default_address()
+    if isinstance(address, tuple) and not args.allow_tcp:
+        raise SystemExit(
+            'Clients of the broker are not authenticated: pass --allow-tcp '
+            'to listen on {0}:{1} anyway'.format(*address)
+        )
+
+    if args.simulate:
+        _simulate(latency=args.latency, jitter=args.jitter)
+
+    backend = args.backend
+    if backend == 'broker':
+        raise SystemExit('serve needs the winpv or gplpv backend')
+    if backend == 'auto':
+        backend = detect_backend()
+
+    # Requests are sent from the thread serving each client, which WinPV only
+    # allows with session workers
+    kwargs = {'sessions': args.sessions} if backend == 'winpv' else {}
+    broker = XenStoreBroker(
+        connection_class(backend)(**kwargs), address=address,
+        allow_tcp=args.allow_tcp
+    )
+    broker.start()
+    logging.getLogger('win_pyxs').info(
+        'Serving %s on %s', backend, broker.address
+    )
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _add_backend_arguments(parser):
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', help='Only log warnings'
+    )
+    parser.add_argument(
+        '--backend', choices=['auto', 'winpv', 'gplpv', 'broker'],
+        default='auto',
+        help='The connection class to use (default: detect the drivers)'
+    )
+    parser.add_argument(
+        '--simulate', action='store_true',
+        help='Use the in-process simulator instead of the real drivers'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Simulated latency of each backend call in seconds'
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Maximum extra simulated latency in seconds'
+    )
+
+
+def _add_run_arguments(parser):
+    _add_backend_arguments(parser)
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='The number of threads (each with its own connection)'
+    )
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='The number of processes, each running --threads threads'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=None,
+        help='Target requests per second for each thread'
+    )
+    parser.add_argument(
+        '--json', action='store_true', help='Print the report as JSON'
+    )
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m win_pyxs', description=__doc__.splitlines()[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest='command_name')
+
+    demo = commands.add_parser('info', help='Print details about this VM')
+    _add_backend_arguments(demo)
+    demo.set_defaults(func=_demo)
+
+    record = commands.add_parser(
+        'record', help="Record the xenstore requests of a Python program"
+    )
+    _add_backend_arguments(record)
+    record.add_argument(
+        '-o', '--output', required=True, help='The recording to write'
+    )
+    record.add_argument(
+        'command', nargs=argparse.REMAINDER,
+        help='The script (or -m module) to run & its arguments'
+    )
+    record.set_defaults(func=_record)
+
+    replay = commands.add_parser('replay', help='Replay a recording')
+    _add_run_arguments(replay)
+    replay.add_argument('recording', help='The file written by record')
+    replay.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Replay speed relative to the recording (0 = no delays)'
+    )
+    replay.add_argument(
+        '--loops', type=int, default=1,
+        help='The number of times each thread replays the recording'
+    )
+    replay.set_defaults(func=_replay)
+
+    load = commands.add_parser(
+        'load', help='Generate a synthetic read/write/directory load'
+    )
+    _add_run_arguments(load)
+    load.add_argument(
+        '--count', type=int, default=1000,
+        help='The number of requests made by each thread'
+    )
+    load.add_argument(
+        '--mix', default='read=80,write=15,directory=5',
+        help='Relative weights of read, write & directory requests'
+    )
+    load.add_argument('--prefix', default='data/win_pyxs-load')
+    load.add_argument(
+        '--keys', type=int, default=100,
+        help='The number of keys under --prefix to spread requests over'
+    )
+    load.add_argument('--value-size', type=int, default=32)
+    load.add_argument('--seed', type=int, default=None)
+    load.set_defaults(func=_load)
+
+    serve = commands.add_parser(
+        'serve', help='Share one xenstore connection with local processes'
+    )
+    _add_backend_arguments(serve)
+    serve.add_argument(
+        '--address', default=None,
+        help='The Unix socket path or host:port to listen on'
+    )
+    serve.add_argument(
+        '--allow-tcp', action='store_true',
+        help='Listen on TCP (which any local user can connect to) if the '
+        'address is host:port'
+    )
+    serve.add_argument(
+        '--sessions', type=_parse_sessions, default=2,
+        help='The number of WinPV sessions requests are spread over'
+    )
+    serve.set_defaults(func=_serve)
+
+    return parser
+
+
+def _main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in _COMMANDS + ('-h', '--help'):
+        # Without a command behave as before & print details about this VM
+        argv.insert(0, 'info')
+    args = _parser().parse_args(argv)
+
+    logger = logging.getLogger('win_pyxs')
+    _basic_logger_init(logger, verbose=not args.quiet)
+    if args.quiet:
+        logger.setLevel(logging.WARNING)
+
+    args.func(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""
+win_pyxs.aio contains an asyncio adapter for the win_pyxs connections. Rather
+than running a pyxs.Router thread the connection's fileno() (the reader half
+of its notification socketpair) is registered with the event loop so that
+replies are dispatched to awaiting coroutines from the loop itself.
+
+This module requires Python 3. On Windows the event loop must support
+add_reader() which means using asyncio.SelectorEventLoop rather than the
+default ProactorEventLoop.
+"""
+
+__all__ = ['AsyncXenBusConnection']
+
+import asyncio
+import errno
+import logging
+
+import pyxs
+from pyxs._internal import NUL, Event, Op, Packet, next_rq_id
+from pyxs.exceptions import ConnectionError, UnexpectedPacket
+from pyxs.helpers import check_path, error
+
+
+class AsyncXenBusConnection(object):
+    """
+    Wrap a XenBusConnectionWinPV or XenBusConnectionGPLPV for use from
+    asyncio. Each request is sent straight away & an awaitable keyed by its
+    rq_id is returned, so any number of coroutines can have requests in flight
+    without needing a thread each. The public coroutines mirror the
+    pyxs.Client API (read, write, list, ...).
+
+    Sending is done in the calling coroutine so with XenBusConnectionWinPV
+    sessions > 1 should be used to keep the WMI calls off the event loop.
+
+    :param connection: The (unconnected) connection to wrap.
+    :param loop: The event loop to use. Defaults to the running loop when
+        connect() is called.
+    """
+
+    def __init__(self, connection, loop=None):
+        self._logger = logging.getLogger(
+            __name__ + '.' + self.__class__.__name__
+        )
+
+        self.connection = connection
+        self.loop = loop
+        self.tx_id = 0
+
+        # Replies are matched to the futures awaiting them using the rq_id
+        self._pending = {}
+
+        #: WATCH_EVENT packets are converted to pyxs Events & put on this
+        #: asyncio.Queue (created by connect() so it uses the right loop)
+        self.events = None
+
+        self._fileno = None
+
+    def __repr__(self):
+        return 'AsyncXenBusConnection({0!r})'.format(self.connection)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_connected(self):
+        """
+        Return whether the wrapped connection is registered with the loop.
+        """
+        return self._fileno is not None
+
+    async def connect(self):
+        """
+        Connect the wrapped connection & start watching it for replies.
+        """
+        if self.is_connected:
+            return
+
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+
+        if self.events is None:
+            self.events = asyncio.Queue()
+
+        self.connection.connect()
+        fileno = self.connection.fileno()
+        try:
+            self.loop.add_reader(fileno, self._on_readable)
+        except NotImplementedError:
+            self.connection.close()
+            raise ConnectionError(
+                'The event loop does not support add_reader(), use '
+                'asyncio.SelectorEventLoop'
+            )
+        self._fileno = fileno
+
+    def close(self):
+        """
+        Stop watching & close the wrapped connection. Requests which are
+        still awaiting a reply fail with pyxs.ConnectionError.
+        """
+        if not self.is_connected:
+            return
+
+        self.loop.remove_reader(self._fileno)
+        self._fileno = None
+        self.connection.close()
+
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection closed'))
+
+    def _on_readable(self):
+        try:
+            packet = self.connection.recv()
+        except Exception:  # pylint: disable=W0703
+            self._logger.exception('Failed receiving packet:')
+            self.close()
+            return
+
+        if packet.op == Op.WATCH_EVENT:
+            self.events.put_nowait(Event(*packet.payload.split(NUL)[:-1]))
+            return
+
+        future = self._pending.pop(packet.rq_id, None)
+        if future is None:
+            self._logger.warning('Dropping unexpected packet: %s', packet)
+        elif not future.done():
+            future.set_result(packet)
+
+    def send(self, packet):
+        """
+        Send a packet & return a future which resolves to the reply.
+        """
+        if not self.is_connected:
+            raise ConnectionError('not connected')
+
+        future = self.loop.create_future()
+        # Registered first as the reply can be delivered during send()
+        self._pending[packet.rq_id] = future
+        try:
+            self.connection.send(packet)
+        except BaseException:
+            self._pending.pop(packet.rq_id, None)
+            raise
+
+        return future
+
+    async def execute_command(self, op, *args):
+        """
+        Send a request made up of args & return the reply payload, raising
+        the equivalent pyxs.PyXSError for an Op.ERROR reply.
+        """
+        packet = await self.send(
+            Packet(op, b''.join(args), rq_id=next_rq_id(), tx_id=self.tx_id)
+        )
+        if packet.op == Op.ERROR:
+            raise error(packet.payload[:-1])
+        elif packet.op != op or packet.tx_id != self.tx_id:
+            raise UnexpectedPacket(packet)
+
+        return packet.payload.rstrip(NUL)
+
+    async def _ack(self, *args):
+        payload = await self.execute_command(*args)
+        if payload != b'OK':
+            raise pyxs.PyXSError(payload)
+
+    async def read(self, path, default=None):
+        """
+        Read the value of a path, returning default (if not None) when the
+        path does not exist.
+        """
+        check_path(path)
+        try:
+            return await self.execute_command(Op.READ, path + NUL)
+        except pyxs.PyXSError as exc:
+            if exc.args[0] == errno.ENOENT and default is not None:
+                return default
+            raise
+
+    async def write(self, path, value):
+        """
+        Write a value to a path.
+        """
+        check_path(path)
+        await self._ack(Op.WRITE, path + NUL, value)
+
+    async def mkdir(self, path):
+        """
+        Create a path & any missing parents.
+        """
+        check_path(path)
+        await self._ack(Op.MKDIR, path + NUL)
+
+    async def delete(self, path):
+        """
+        Remove a path & all of its children.
+        """
+        check_path(path)
+        await self._ack(Op.RM, path + NUL)
+
+    async def list(self, path):
+        """
+        Return the names of the immediate children of a path.
+        """
+        check_path(path)
+        payload = await self.execute_command(Op.DIRECTORY, path + NUL)
+        return [] if not payload else payload.split(NUL)
+
+    async def exists(self, path):
+        """
+        Return whether a path exists.
+        """
+        try:
+            await self.list(path)
+        except pyxs.PyXSError as exc:
+            if exc.args[0] == errno.ENOENT:
+                return False
+            raise
+
+        return True
@@ -0,0 +1,732 @@
+"""
+win_pyxs.broker lets many local processes share a single xenstore
+connection. The GPLPV device can only be opened by one process at a time &
+every process using the WinPV drivers pays for connecting to WMI & adding a
+session, so agents & short-lived scripts on the same guest either queue up
+for the device or each pay the connection cost.
+
+XenStoreBroker holds one backend connection & accepts clients on a local
+socket speaking the xenstore wire format:
+
+    python -m win_pyxs serve [--address ADDRESS]
+
+Clients connect with XenBusConnectionBroker. The rq_id of every request is
+replaced by one unique within the broker (& restored in the reply), watches
+of the same path by several clients share one backend watch whose events
+are fanned out to each of them, & the watches & transactions of a client
+are cleaned up when it disconnects.
+
+An address is the path of a Unix socket or host:port. A Unix socket is
+only accessible to the user running the broker. The broker does not
+authenticate clients, so a TCP socket (even on the loopback interface) lets
+any local user read & write xenstore with the broker's privileges. Python has
+no Unix sockets on Windows so there the default is a TCP socket on the
+loopback interface, but the broker only listens on TCP when allow_tcp (or
+--allow-tcp) is given:
+
+    python -m win_pyxs serve --allow-tcp
+"""
+
+__all__ = [
+    'XenBusConnectionBroker',
+    'XenStoreBroker',
+    'default_address',
+    'parse_address',
+    'ADDRESS_ENV',
+    'DEFAULT_PORT',
+]
+
+import errno
+import functools
+import itertools
+import logging
+import os
+import select
+import socket
+import tempfile
+import threading
+
+import pyxs
+import pyxs.connection
+from pyxs._internal import NUL, Op, Packet
+from pyxs.exceptions import ConnectionError  # pylint: disable=W0622
+
+#: The environment variable which overrides the default broker address
+ADDRESS_ENV = 'WIN_PYXS_BROKER'
+
+#: The loopback TCP port used by default where there are no Unix sockets
+DEFAULT_PORT = 47655
+
+_HEADER = Packet._struct
+
+_MAX_PAYLOAD = 4096
+
+_logger = logging.getLogger(__name__)
+
+
+def default_address():
+    """
+    Return the address in ADDRESS_ENV if it is set, otherwise a Unix socket
+    in the temporary directory or (on Windows) 127.0.0.1:DEFAULT_PORT.
+    """
+    address = os.environ.get(ADDRESS_ENV)
+    if address:
+        return parse_address(address)
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(tempfile.gettempdir(), 'win_pyxs-broker.sock')
+    return ('127.0.0.1', DEFAULT_PORT)
+
+
+def parse_address(address):
+    """
+    Return a (host, port) tuple for host:port (or :port, meaning
+    127.0.0.1) & the path of a Unix socket otherwise.
+    """
+    if isinstance(address, tuple):
+        return address
+
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() \
+            and not any(char in host for char in '/\\'):
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def _new_socket(address):
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def _recv_exactly(sock, size):
+    """
+    Read size bytes from sock. Returns None if the peer closes it first.
+    """
+    view = memoryview(bytearray(size))
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return view.tobytes()
+
+
+def _read_packet(sock):
+    """
+    Read a packet in the xenstore wire format. Returns None at the end of
+    the stream.
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+
+    op, rq_id, tx_id, size = _HEADER.unpack(header)
+    if size > _MAX_PAYLOAD:
+        raise ValueError('Payload of {0} bytes is too large'.format(size))
+
+    payload = _recv_exactly(sock, size) if size else b''
+    if payload is None:
+        return None
+    return Packet(op, payload, rq_id, tx_id)
+
+
+def _encode(packet):
+    return _HEADER.pack(
+        packet.op, packet.rq_id, packet.tx_id, packet.size
+    ) + packet.payload
+
+
+def _error(rq_id, code, tx_id=0):
+    return Packet(
+        Op.ERROR, errno.errorcode[code].encode('ascii') + NUL, rq_id, tx_id
+    )
+
+
+def _split_watch(payload):
+    path, token = payload.split(NUL)[:2]
+    return path, token
+
+
+class _Client(object):
+    """
+    A process connected to the broker.
+    """
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.closed = False
+
+        # (path, token) of every watch & the tx_id of every transaction
+        # which the client has not ended
+        self.watches = set()
+        self.transactions = set()
+
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '_Client({0})'.format(self.name)
+
+    def send(self, packet):
+        """
+        Send a packet to the client. Returns False if it has disconnected.
+        """
+        data = _encode(packet)
+        with self._lock:
+            if self.closed:
+                return False
+            try:
+                self.sock.sendall(data)
+            except socket.error as exc:
+                _logger.debug('Failed sending to %s: %s', self.name, exc)
+                return False
+        return True
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class _SharedWatch(object):
+    """
+    The backend watch for a path shared by every client watching it.
+    """
+
+    __slots__ = ['path', 'token', 'subscribers', 'waiting', 'active']
+
+    def __init__(self, path, token):
+        self.path = path
+        self.token = token
+        # (client, token) pairs receiving the events
+        self.subscribers = set()
+        # (client, rq_id, token) of the WATCH requests made before the
+        # backend confirmed the watch
+        self.waiting = []
+        self.active = False
+
+
+class XenStoreBroker(object):
+    """
+    Shares connection (e.g. a XenBusConnectionGPLPV, or a
+    XenBusConnectionWinPV with sessions > 1 or thread_sessions=True) with
+    the clients connecting to address. Requests are sent from the thread
+    serving each client so the backend must allow send() from any thread; a
+    ValueError is raised for a XenBusConnectionWinPV which does not. The
+    broker connects & closes the backend connection itself.
+
+    :param connection: The backend connection (not yet connected).
+    :param address: The Unix socket path or (host, port) to listen on.
+        Defaults to default_address().
+    :param allow_tcp: Whether address may be a TCP socket, which any local
+        user can connect to as clients are not authenticated. A ValueError
+        is raised otherwise.
+    """
+
+    def __init__(self, connection, address=None, backlog=16, allow_tcp=False):
+        from .winpv import XenBusConnectionWinPV
+
+        if isinstance(connection, XenBusConnectionWinPV) \
+                and connection.sessions < 2 \
+                and not connection.thread_sessions:
+            # Its single session could only be used by the thread which
+            # connected, not by the threads serving the clients
+            raise ValueError(
+                'A XenBusConnectionWinPV needs sessions > 1 or '
+                'thread_sessions=True to be used by a broker'
+            )
+
+        self.connection = connection
+        self.address = parse_address(address) if address is not None \
+            else default_address()
+        self.backlog = backlog
+
+        if isinstance(self.address, tuple) and not allow_tcp:
+            raise ValueError(
+                'Clients of a broker listening on TCP ({0}:{1}) are not '
+                'authenticated; pass allow_tcp=True to listen there '
+                'anyway'.format(*self.address)
+            )
+
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._clients = set()
+        self._client_ids = itertools.count(1)
+
+        # Broker rq_id -> (client, client rq_id, reply handler)
+        self._requests = {}
+        self._rq_ids = itertools.count(0)
+
+        # Shared watches by path & by backend token
+        self._watches = {}
+        self._tokens = {}
+        self._watch_ids = itertools.count(1)
+
+        self._server = None
+        self._threads = []
+        # Set as soon as the broker starts stopping (including when the
+        # backend fails), while _stopped makes sure _shutdown() only runs
+        # once & _finished is set when it has
+        self._stopping = threading.Event()
+        self._stopped = False
+        self._finished = threading.Event()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def clients(self):
+        """
+        The number of connected clients.
+        """
+        with self._lock:
+            return len(self._clients)
+
+    def _listen(self):
+        server = _new_socket(self.address)
+        if not isinstance(self.address, tuple) \
+                and os.path.exists(self.address):
+            probe = _new_socket(self.address)
+            try:
+                probe.connect(self.address)
+            except socket.error:
+                # Left behind by a broker which did not stop cleanly
+                os.remove(self.address)
+            else:
+                server.close()
+                raise pyxs.PyXSError(
+                    'A broker is already listening on {0}'.format(
+                        self.address
+                    )
+                )
+            finally:
+                probe.close()
+        else:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        server.bind(self.address)
+        if isinstance(self.address, tuple):
+            _logger.warning(
+                'Listening on TCP %s:%d: clients are not authenticated so any '
+                'local user can use xenstore through the broker',
+                *self.address
+            )
+        else:
+            # Before listen() so nobody else can connect in the meantime
+            os.chmod(self.address, 0o600)
+        server.listen(self.backlog)
+        return server
+
+    def start(self):
+        """
+        Connect the backend & start accepting clients in background threads.
+        """
+        self.connection.connect()
+        try:
+            self._server = self._listen()
+        except Exception:
+            self.connection.close()
+            raise
+
+        if isinstance(self.address, tuple):
+            # Port 0 picks a free port
+            self.address = self._server.getsockname()[:2]
+
+        for target, name in (
+            (self._accept, 'win_pyxs-broker-accept'),
+            (self._read_backend, 'win_pyxs-broker-backend'),
+        ):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        _logger.info('Listening on %s', self.address)
+
+    def serve_forever(self):
+        """
+        Start the broker (unless it has been started) & wait until stop() is
+        called or the backend connection fails.
+        """
+        if self._server is None:
+            self.start()
+        try:
+            while not self._stopping.is_set():
+                self._stopping.wait(1)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Disconnect every client, stop listening & close the backend. This
+        happens by itself if the backend connection fails.
+        """
+        self._shutdown()
+        self._finished.wait()
+
+    def _shutdown(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._stopping.set()
+        try:
+            self._wakeup_w.send(NUL)
+
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+            with self._lock:
+                clients = list(self._clients)
+            for client in clients:
+                client.close()
+
+            if self._server is not None:
+                self._server.close()
+                if not isinstance(self.address, tuple):
+                    try:
+                        os.remove(self.address)
+                    except OSError:
+                        pass
+
+            self.connection.close()
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+        finally:
+            self._finished.set()
+
+    def _accept(self):
+        while not self._stopping.is_set():
+            ready = select.select([self._server, self._wakeup_r], [], [])[0]
+            if self._wakeup_r in ready:
+                break
+
+            try:
+                sock, _peer = self._server.accept()
+            except socket.error as exc:
+                _logger.warning('Failed accepting a client: %s', exc)
+                continue
+
+            client = _Client(sock, 'client-{0}'.format(next(self._client_ids)))
+            with self._lock:
+                self._clients.add(client)
+
+            thread = threading.Thread(
+                target=self._serve_client, args=(client, ),
+                name='win_pyxs-broker-{0}'.format(client.name)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _serve_client(self, client):
+        _logger.debug('%s connected', client.name)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    packet = _read_packet(client.sock)
+                except (socket.error, ValueError, pyxs.PyXSError) as exc:
+                    _logger.warning(
+                        'Bad request from %s: %s', client.name, exc
+                    )
+                    break
+                if packet is None:
+                    break
+                self._handle(client, packet)
+        finally:
+            self._disconnect(client)
+            _logger.debug('%s disconnected', client.name)
+
+    def _handle(self, client, packet):
+        if packet.op == Op.WATCH:
+            self._watch(client, packet)
+        elif packet.op == Op.UNWATCH:
+            self._unwatch(client, packet)
+        elif packet.op == Op.TRANSACTION_START:
+            self._forward(client, packet, self._transaction_started)
+        else:
+            if packet.op == Op.TRANSACTION_END:
+                client.transactions.discard(packet.tx_id)
+            self._forward(client, packet)
+
+    def _forward(self, client, packet, handler=None):
+        """
+        Send a request to the backend with a new rq_id. The reply is sent to
+        client (if any) or passed to handler.
+        """
+        with self._lock:
+            # Backend rq_ids are 1..2**32-1: 0 is used by watch events
+            rq_id = next(self._rq_ids) % 0xffffffff + 1
+            entry = self._requests[rq_id] = (client, packet.rq_id, handler)
+
+        try:
+            with self._send_lock:
+                self.connection.send(
+                    Packet(packet.op, packet.payload, rq_id, packet.tx_id)
+                )
+        except Exception as exc:  # pylint: disable=W0703
+            with self._lock:
+                self._requests.pop(rq_id, None)
+            _logger.warning('Backend failed sending %s: %s', packet, exc)
+            code = errno.ENOSYS if isinstance(exc, NotImplementedError) \
+                else errno.EIO
+            self._complete(entry, _error(packet.rq_id, code, packet.tx_id))
+
+    def _internal(self, op, payload, tx_id=0):
+        """
+        Send a request made by the broker itself, ignoring the reply.
+        """
+        if not self._stopping.is_set():
+            self._forward(None, Packet(op, payload, 0, tx_id))
+
+    def _complete(self, entry, reply):
+        client, rq_id, handler = entry
+        if handler is not None:
+            handler(client, rq_id, reply)
+        elif client is not None:
+            client.send(Packet(reply.op, reply.payload, rq_id, reply.tx_id))
+
+    def _read_backend(self):
+        try:
+            while not self._stopping.is_set():
+                ready = select.select(
+                    [self.connection, self._wakeup_r], [], []
+                )[0]
+                if self._wakeup_r in ready:
+                    break
+                self._dispatch(self.connection.recv())
+        except Exception:  # pylint: disable=W0703
+            if not self._stopping.is_set():
+                _logger.exception('The backend connection failed')
+                # Nothing more can be answered so disconnect the clients
+                # rather than leave them waiting
+                self._shutdown()
+
+    def _dispatch(self, packet):
+        if packet.op == Op.WATCH_EVENT:
+            self._fan_out(packet)
+            return
+
+        with self._lock:
+            entry = self._requests.pop(packet.rq_id, None)
+        if entry is None:
+            _logger.debug('Dropped reply to unknown request %s', packet)
+            return
+        self._complete(entry, packet)
+
+    def _transaction_started(self, client, rq_id, reply):
+        if reply.op == Op.TRANSACTION_START:
+            try:
+                tx_id = int(reply.payload.rstrip(NUL))
+            except ValueError:
+                tx_id = None
+            if tx_id is not None:
+                client.transactions.add(tx_id)
+                if client.closed:
+                    # The client has gone so nobody can end it
+                    client.transactions.discard(tx_id)
+                    self._internal(Op.TRANSACTION_END, b'F' + NUL, tx_id)
+        client.send(Packet(reply.op, reply.payload, rq_id, reply.tx_id))
+
+    def _watch(self, client, packet):
+        path, token = _split_watch(packet.payload)
+        with self._lock:
+            if (path, token) in client.watches:
+                client.send(_error(packet.rq_id, errno.EEXIST))
+                return
+            client.watches.add((path, token))
+
+            watch = self._watches.get(path)
+            new = watch is None
+            if new:
+                backend_token = 'win_pyxs-broker-{0}'.format(
+                    next(self._watch_ids)
+                ).encode('ascii')
+                watch = _SharedWatch(path, backend_token)
+                self._watches[path] = self._tokens[backend_token] = watch
+
+            if watch.active:
+                watch.subscribers.add((client, token))
+            else:
+                watch.waiting.append((client, packet.rq_id, token))
+
+        if new:
+            self._forward(
+                None,
+                Packet(Op.WATCH, path + NUL + watch.token + NUL, 0),
+                functools.partial(self._watch_added, watch)
+            )
+        elif watch.active:
+            # xenstored fires every new watch once
+            client.send(Packet(Op.WATCH, b'OK' + NUL, packet.rq_id))
+            client.send(Packet(Op.WATCH_EVENT, path + NUL + token + NUL, 0))
+
+    def _watch_added(self, watch, _client, _rq_id, reply):
+        with self._lock:
+            waiting, watch.waiting = watch.waiting, []
+            if reply.op == Op.ERROR:
+                self._drop_watch(watch)
+                for client, _rq_id, token in waiting:
+                    client.watches.discard((watch.path, token))
+            else:
+                watch.active = True
+                watch.subscribers.update(
+                    (client, token) for client, _rq_id, token in waiting
+                    if not client.closed
+                )
+                unused = not watch.subscribers
+                if unused:
+                    self._drop_watch(watch)
+
+        for client, rq_id, _token in waiting:
+            client.send(Packet(reply.op, reply.payload, rq_id))
+        if reply.op != Op.ERROR and unused:
+            self._unwatch_backend(watch)
+
+    def _drop_watch(self, watch):
+        if self._watches.get(watch.path) is watch:
+            del self._watches[watch.path]
+        self._tokens.pop(watch.token, None)
+
+    def _unwatch_backend(self, watch):
+        self._internal(Op.UNWATCH, watch.path + NUL + watch.token + NUL)
+
+    def _remove_subscriber(self, client, path, token):
+        """
+        Stop sending the events of a watch to client. Returns the shared
+        watch if it is no longer used & must be removed from the backend.
+        Called with _lock held.
+        """
+        client.watches.discard((path, token))
+        watch = self._watches.get(path)
+        if watch is None:
+            return None
+
+        watch.subscribers.discard((client, token))
+        watch.waiting = [
+            waiting for waiting in watch.waiting
+            if waiting[0] is not client or waiting[2] != token
+        ]
+        if watch.active and not watch.subscribers:
+            self._drop_watch(watch)
+            return watch
+        return None
+
+    def _unwatch(self, client, packet):
+        path, token = _split_watch(packet.payload)
+        with self._lock:
+            if (path, token) not in client.watches:
+                client.send(_error(packet.rq_id, errno.ENOENT))
+                return
+            unused = self._remove_subscriber(client, path, token)
+
+        client.send(Packet(Op.UNWATCH, b'OK' + NUL, packet.rq_id))
+        if unused is not None:
+            self._unwatch_backend(unused)
+
+    def _fan_out(self, packet):
+        path, token = _split_watch(packet.payload)
+        with self._lock:
+            watch = self._tokens.get(token)
+            if watch is None:
+                return
+            targets = list(watch.subscribers) + [
+                (client, client_token)
+                for client, _rq_id, client_token in watch.waiting
+            ]
+
+        for client, client_token in targets:
+            client.send(Packet(
+                Op.WATCH_EVENT, path + NUL + client_token + NUL, 0
+            ))
+
+    def _disconnect(self, client):
+        client.close()
+        with self._lock:
+            self._clients.discard(client)
+            unused = [
+                self._remove_subscriber(client, path, token)
+                for path, token in list(client.watches)
+            ]
+            transactions = list(client.transactions)
+            client.transactions.clear()
+
+        for watch in unused:
+            if watch is not None:
+                self._unwatch_backend(watch)
+        for tx_id in transactions:
+            self._internal(Op.TRANSACTION_END, b'F' + NUL, tx_id)
+
+
+class _SocketTransport(object):
+    """
+    A stream socket to a XenStoreBroker.
+    """
+
+    def __init__(self, address):
+        self.sock = _new_socket(address)
+        try:
+            self.sock.connect(address)
+        except socket.error as exc:
+            self.sock.close()
+            raise ConnectionError(
+                'error connecting to {0!r}: {1}'.format(address, exc.args)
+            )
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        data = _recv_exactly(self.sock, size)
+        if data is None:
+            raise socket.error(errno.ECONNRESET, 'The broker has gone')
+        return data
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class XenBusConnectionBroker(pyxs.connection.PacketConnection):
+    """
+    A pyxs connection to a XenStoreBroker (python -m win_pyxs serve) which
+    shares its backend connection with other processes.
+
+    :param address: The address the broker listens on. Defaults to
+        default_address().
+    """
+
+    def __init__(self, address=None):
+        self.address = parse_address(address) if address is not None \
+            else default_address()
+        self.path = self.address
+
+    @classmethod
+    def probe(cls, address=None):
+        """
+        Check that a broker is listening, raising pyxs.PyXSError if not.
+        """
+        _SocketTransport(
+            parse_address(address) if address is not None
+            else default_address()
+        ).close()
+
+    def create_transport(self):
+        return _SocketTransport(self.address)
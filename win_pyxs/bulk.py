@@ -0,0 +1,380 @@
+"""
+win_pyxs.bulk contains helpers which issue many xenstore requests through a
+pyxs.Client at once. Each request is still a separate packet but they are
+kept in flight together so that, with a connection which can handle several
+requests in parallel (such as XenBusConnectionWinPV with sessions > 1), the
+round trips overlap rather than being paid one after another.
+"""
+
+__all__ = [
+    'TreeNode',
+    'TreeStats',
+    'iter_tree',
+    'read_tree',
+    'tree_speedup',
+    'BatchResult',
+    'read_many',
+    'write_many',
+]
+
+from collections import OrderedDict, deque, namedtuple
+import errno
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import pyxs
+from pyxs._internal import NUL, Op, Packet, next_rq_id
+from pyxs.client import RVar
+from pyxs.exceptions import UnexpectedPacket
+from pyxs.helpers import check_path, error
+
+#: A node returned by read_tree: the value stored at the node & a dict
+#: mapping the name of each child to its TreeNode.
+TreeNode = namedtuple('TreeNode', 'value children')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class TreeStats(object):
+    """
+    Counters filled in by iter_tree/read_tree when passed as stats.
+    """
+
+    def __init__(self):
+        self.nodes = 0
+        self.requests = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return 'TreeStats(nodes={0}, requests={1}, elapsed={2:.3f})'.format(
+            self.nodes, self.requests, self.elapsed
+        )
+
+
+def _join(path, child):
+    if path.endswith(b'/'):
+        return path + child
+    return path + b'/' + child
+
+
+def _missing(exc):
+    return bool(exc.args) and exc.args[0] == errno.ENOENT
+
+
+def _removed(client, path):
+    """
+    Return whether path no longer exists, checked by listing its parent.
+    Used when reading a node fails without ENOENT, which is how a missing
+    node can be reported by WMI.
+    """
+    parent, sep, name = path.rpartition(b'/')
+    if not sep:
+        return False
+
+    try:
+        return name not in client.list(parent or b'/')
+    except pyxs.PyXSError as exc:
+        if _missing(exc):
+            return True
+        # The whole subtree may have gone
+        return bool(parent) and _removed(client, parent)
+
+
+def _read_node(client, path, list_children):
+    """
+    Read the value & (optionally) the children of a single node. Returns
+    None if the node was removed before it could be read.
+    """
+    try:
+        value = client.read(path)
+        children = client.list(path) if list_children else []
+    except pyxs.PyXSError as exc:
+        if _missing(exc) or _removed(client, path):
+            return None
+        raise
+
+    return value, children
+
+
+def _walker(client, tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        path, depth, list_children = task
+        try:
+            results.put((path, depth, _read_node(client, path, list_children)))
+        except Exception as exc:  # pylint: disable=W0703
+            results.put((path, depth, exc))
+
+
+def iter_tree(client, path, max_depth=None, workers=8, stats=None):
+    """
+    Walk the subtree rooted at path & yield a (path, value) pair for every
+    node in it. Nodes are yielded as soon as they have been read so the order
+    is only guaranteed to be parent-before-child.
+
+    :param client: A connected pyxs.Client.
+    :param path: The bytes path of the root of the subtree.
+    :param max_depth: If given, nodes more than this many levels below path
+        are not read (0 reads only path itself).
+    :param workers: The number of nodes to read concurrently. With 1 the
+        tree is walked serially in the calling thread.
+    :param stats: An optional TreeStats to record the number of nodes &
+        requests along with the time taken.
+    """
+    stats = stats if stats is not None else TreeStats()
+    started = _clock()
+    path = path.rstrip(b'/') or b'/'
+
+    def _want_children(depth):
+        return max_depth is None or depth < max_depth
+
+    if workers <= 1:
+        pending = deque([(path, 0)])
+        while pending:
+            node_path, depth = pending.popleft()
+            list_children = _want_children(depth)
+            node = _read_node(client, node_path, list_children)
+            stats.requests += 2 if list_children else 1
+            if node is None:
+                continue
+
+            value, children = node
+            stats.nodes += 1
+            stats.elapsed = _clock() - started
+            yield node_path, value
+
+            for child in children:
+                pending.append((_join(node_path, child), depth + 1))
+
+        stats.elapsed = _clock() - started
+        return
+
+    # The frontier of nodes still to be read is held here rather than in the
+    # task queue so that the walkers never block while adding work. At most
+    # workers * 2 nodes are queued for (or being read by) the walkers.
+    frontier = deque([(path, 0)])
+    limit = workers * 2
+    tasks, results = Queue(limit), Queue()
+    threads = [
+        threading.Thread(target=_walker, args=(client, tasks, results))
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    in_flight = 0
+    try:
+        while frontier or in_flight:
+            while frontier and in_flight < limit:
+                node_path, depth = frontier.popleft()
+                list_children = _want_children(depth)
+                tasks.put((node_path, depth, list_children))
+                stats.requests += 2 if list_children else 1
+                in_flight += 1
+
+            node_path, depth, node = results.get()
+            in_flight -= 1
+            if isinstance(node, Exception):
+                raise node
+            if node is None:
+                continue
+
+            value, children = node
+            stats.nodes += 1
+            stats.elapsed = _clock() - started
+            yield node_path, value
+
+            for child in children:
+                frontier.append((_join(node_path, child), depth + 1))
+    finally:
+        stats.elapsed = _clock() - started
+        for _ in threads:
+            tasks.put(None)
+
+
+def read_tree(client, path, max_depth=None, workers=8, stats=None):
+    """
+    Read the subtree rooted at path into a TreeNode. The arguments are the
+    same as for iter_tree. Returns None if path does not exist.
+    """
+    path = path.rstrip(b'/') or b'/'
+    nodes = {}
+    for node_path, value in iter_tree(
+        client, path, max_depth=max_depth, workers=workers, stats=stats
+    ):
+        nodes[node_path] = TreeNode(value, {})
+
+    for node_path, node in nodes.items():
+        if node_path == path:
+            continue
+        parent, _sep, name = node_path.rpartition(b'/')
+        nodes[parent or b'/'].children[name] = node
+
+    return nodes.get(path)
+
+
+def tree_speedup(client, path, max_depth=None, workers=8):
+    """
+    Read the subtree rooted at path both serially & with the given number of
+    workers & report how long each took. Returns a dict containing the
+    number of nodes, the serial & parallel timings in seconds and the
+    speedup of the parallel walk over the serial one.
+    """
+    serial, parallel = TreeStats(), TreeStats()
+    read_tree(client, path, max_depth=max_depth, workers=1, stats=serial)
+    read_tree(
+        client, path, max_depth=max_depth, workers=workers, stats=parallel
+    )
+
+    return {
+        'nodes': parallel.nodes,
+        'serial': serial.elapsed,
+        'parallel': parallel.elapsed,
+        'speedup': serial.elapsed / parallel.elapsed
+        if parallel.elapsed else float('inf'),
+    }
+
+
+class BatchResult(object):
+    """
+    The outcome of read_many/write_many. values maps each path which
+    succeeded to the reply payload (the value for reads, b'OK' for writes)
+    & errors maps each path which failed to the exception which would have
+    been raised by the equivalent pyxs.Client call.
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.errors = OrderedDict()
+        self.duplicates = 0
+
+    def __repr__(self):
+        return 'BatchResult(values={0}, errors={1}, duplicates={2})'.format(
+            len(self.values), len(self.errors), self.duplicates
+        )
+
+    @property
+    def ok(self):
+        """
+        True if every request in the batch succeeded.
+        """
+        return not self.errors
+
+
+def _send_batch(router, packets):
+    """
+    Send all of the packets through the router without waiting for any
+    replies. If the connection has a send_many method the whole batch is
+    handed to it at once. Returns a dict of rq_id -> RVar for the packets
+    which were sent & a dict of rq_id -> exception for those which were not.
+    """
+    rvars, failures = {}, {}
+    send_many = getattr(router.connection, 'send_many', None)
+
+    if send_many is None:
+        for packet in packets:
+            try:
+                rvars[packet.rq_id] = router.send(packet)
+            except (pyxs.PyXSError, NotImplementedError) as exc:
+                router.rvars.pop(packet.rq_id, None)
+                failures[packet.rq_id] = exc
+        return rvars, failures
+
+    with router.send_lock:
+        # As in Router.send the RVars must be registered before sending as
+        # the replies can arrive before send_many returns
+        for packet in packets:
+            rvars[packet.rq_id] = router.rvars[packet.rq_id] = RVar()
+
+        try:
+            failures = send_many(packets)
+        except (pyxs.PyXSError, NotImplementedError) as exc:
+            failures = dict((packet.rq_id, exc) for packet in packets)
+
+        for rq_id in failures:
+            router.rvars.pop(rq_id, None)
+            rvars.pop(rq_id, None)
+
+    return rvars, failures
+
+
+def _execute_batch(client, op, payloads, result):
+    packets = OrderedDict()
+    for path, payload in payloads.items():
+        try:
+            check_path(path)
+            packets[path] = Packet(
+                op, payload, rq_id=next_rq_id(), tx_id=client.tx_id
+            )
+        except pyxs.PyXSError as exc:
+            result.errors[path] = exc
+
+    rvars, failures = _send_batch(client.router, list(packets.values()))
+
+    for path, packet in packets.items():
+        if packet.rq_id in failures:
+            result.errors[path] = failures[packet.rq_id]
+            continue
+
+        reply = rvars[packet.rq_id].get()
+        if reply.op == Op.ERROR:
+            result.errors[path] = error(reply.payload[:-1])
+        elif reply.op != op or reply.tx_id != client.tx_id:
+            result.errors[path] = UnexpectedPacket(reply)
+        else:
+            result.values[path] = reply.payload.rstrip(NUL)
+
+    return result
+
+
+def read_many(client, paths):
+    """
+    Read several paths at once. Duplicate paths are only read once & all of
+    the requests are sent before waiting for any of the replies. A failure to
+    read one path is recorded in the result rather than raised.
+
+    :param client: A connected pyxs.Client.
+    :param paths: An iterable of bytes paths.
+    :returns: A BatchResult.
+    """
+    result = BatchResult()
+    payloads = OrderedDict()
+    for path in paths:
+        if path in payloads:
+            result.duplicates += 1
+        else:
+            payloads[path] = path + NUL
+
+    return _execute_batch(client, Op.READ, payloads, result)
+
+
+def write_many(client, mapping):
+    """
+    Write several values at once. mapping may be a dict or an iterable of
+    (path, value) pairs; if a path appears more than once only the last
+    value is written. All of the requests are sent before waiting for any of
+    the replies & a failure to write one path is recorded in the result
+    rather than raised.
+
+    :param client: A connected pyxs.Client.
+    :param mapping: The bytes paths & values to write.
+    :returns: A BatchResult.
+    """
+    result = BatchResult()
+    payloads = OrderedDict()
+    items = mapping.items() if hasattr(mapping, 'items') else mapping
+    for path, value in items:
+        if path in payloads:
+            result.duplicates += 1
+        payloads[path] = path + NUL + value
+
+    return _execute_batch(client, Op.WRITE, payloads, result)
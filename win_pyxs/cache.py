@@ -0,0 +1,236 @@
+"""
+win_pyxs.cache contains a bounded read-through cache which can be used by the
+connection classes to avoid repeating xenstore reads for values which rarely
+change (such as vm, domid or device/vif/0/mac).
+"""
+
+__all__ = ['ReadCache']
+
+from collections import OrderedDict
+import threading
+import time
+
+import six
+
+from pyxs._internal import Op
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def _parent(path):
+    """
+    Return the parent of a xenstore path or None for a top-level path. Both
+    absolute & relative paths are supported & either str or bytes may be used.
+    """
+    separator = b'/' if isinstance(path, bytes) else '/'
+    head, sep, _tail = path.rpartition(separator)
+    if not sep:
+        return None
+    if not head:
+        # The parent of an absolute top-level path is the root
+        return None if path == separator else separator
+    return head
+
+
+def _to_bytes(path):
+    if isinstance(path, six.text_type):
+        return path.encode('utf-8')
+    return path
+
+
+def _ancestors(path):
+    parent = _parent(path)
+    while parent is not None:
+        yield parent
+        parent = _parent(parent)
+
+
+def _in_subtree(path, root):
+    if path == root:
+        return True
+    separator = b'/' if isinstance(root, bytes) else '/'
+    if root == separator:
+        return path.startswith(separator)
+    return path.startswith(root + separator)
+
+
+class _Entry(object):
+    __slots__ = ['payload', 'missing', 'expires']
+
+    def __init__(self, payload, missing, expires):
+        self.payload = payload
+        self.missing = missing
+        self.expires = expires
+
+
+class ReadCache(object):
+    """
+    A bounded LRU cache of the results of Op.READ & Op.DIRECTORY requests.
+
+    :param max_entries: The maximum number of results to store. The least
+        recently used result is discarded once this is exceeded.
+    :param ttl: The number of seconds a result is cached for when no prefix in
+        prefix_ttls matches the path. None means results never expire.
+    :param prefix_ttls: A dict mapping path prefixes to the TTL to use for
+        paths starting with that prefix (either str or bytes). The longest
+        matching prefix wins.
+    :param negative_ttl: The number of seconds a failed lookup (e.g. a missing
+        key) is remembered for. Set to 0 to disable negative caching.
+
+    Keys are cached exactly as they appear in the request so a value read
+    using a relative path is not invalidated by a write to the equivalent
+    absolute path. Writes & removes through the owning connection invalidate
+    the key, its subtree (for removes) & the directory listings of its
+    ancestors.
+    """
+
+    def __init__(
+        self, max_entries=1024, ttl=1.0, prefix_ttls=None, negative_ttl=1.0,
+        clock=_clock
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        # Longest prefixes first so the first match is the most specific
+        # Connections pass bytes paths so prefixes are compared as bytes
+        self.prefix_ttls = sorted(
+            ((_to_bytes(prefix), ttl)
+             for prefix, ttl in (prefix_ttls or {}).items()),
+            key=lambda item: -len(item[0])
+        )
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Incremented by every invalidation. Results which were requested
+        # before an invalidation are not stored because they may be stale.
+        self.epoch = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ttl_for(self, path):
+        path = _to_bytes(path)
+        for prefix, ttl in self.prefix_ttls:
+            if path.startswith(prefix):
+                return ttl
+        return self.ttl
+
+    def get(self, op, path):
+        """
+        Return the cached entry for an op & path or None if there is no
+        unexpired entry. The entry has a payload attribute & a missing
+        attribute which is True when the lookup previously failed.
+        """
+        key = (op, path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None \
+                    and entry.expires <= self.clock():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._move_to_end(key)
+            if entry.missing:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, op, path, payload, epoch=None):
+        """
+        Store the payload of a successful lookup. If epoch is given & there
+        have been invalidations since it was read the payload is discarded.
+        """
+        self._store(op, path, payload, False, self._ttl_for(path), epoch)
+
+    def put_missing(self, op, path, epoch=None):
+        """
+        Remember that a lookup failed so it is not repeated until the
+        negative_ttl expires.
+        """
+        if self.negative_ttl:
+            self._store(op, path, None, True, self.negative_ttl, epoch)
+
+    def _store(self, op, path, payload, missing, ttl, epoch):
+        if ttl is not None and ttl <= 0:
+            return
+
+        expires = None if ttl is None else self.clock() + ttl
+        key = (op, path)
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+
+            self._entries[key] = _Entry(payload, missing, expires)
+            self._move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _move_to_end(self, key):
+        try:
+            self._entries.move_to_end(key)
+        except AttributeError:  # Python 2 OrderedDict
+            self._entries[key] = self._entries.pop(key)
+
+    def invalidate(self, path, recursive=False):
+        """
+        Invalidate the cached results for a path which has been written to
+        (or removed, in which case recursive should be True to also drop the
+        whole subtree). The directory listings of all ancestors are dropped
+        as the write may have created them or changed their children.
+        """
+        ancestors = set(_ancestors(path))
+        with self._lock:
+            self.epoch += 1
+            self.invalidations += 1
+
+            for key in list(self._entries):
+                op, cached_path = key
+                if recursive:
+                    stale = _in_subtree(cached_path, path)
+                else:
+                    stale = cached_path == path
+
+                if not stale and cached_path in ancestors:
+                    stale = (
+                        op == Op.DIRECTORY or self._entries[key].missing
+                    )
+
+                if stale:
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Drop every cached result.
+        """
+        with self._lock:
+            self.epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the cache counters as a dict so they can be logged or exported
+        when tuning the cache.
+        """
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,208 @@
+"""
+win_pyxs.detect works out which of the connection classes can be used on
+this machine. The backends are probed at the same time (so a missing GPLPV
+device does not delay finding WinPV, or the other way round) & the one found
+is remembered, both for the rest of the process & in a cache file shared
+with other processes (see win_pyxs.utils.cache_path). Later calls to
+connect() go straight to that backend.
+
+Usage::
+
+    import pyxs
+    import win_pyxs
+
+    with pyxs.Client(router=pyxs.Router(win_pyxs.connect())) as client:
+        client.read(b'vm')
+"""
+
+__all__ = [
+    'BACKENDS',
+    'connect',
+    'connection_class',
+    'detect_backend',
+    'forget_backend',
+    'probe_backends',
+]
+
+import logging
+import threading
+import time
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+from pyxs import PyXSError
+
+from .exceptions import BackendNotFoundError
+from .utils import read_cache, remove_cache, write_cache
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_logger = logging.getLogger(__name__)
+
+#: The names of the backends which can be detected
+BACKENDS = ('gplpv', 'winpv')
+
+#: How long (in seconds) to wait for any backend to be found
+PROBE_TIMEOUT = 10
+
+#: The name of the cache file the detected backend is stored in
+BACKEND_CACHE = 'win_pyxs-backend.json'
+_BACKEND_CACHE_VERSION = 1
+
+# The backend detected by this process
+_BACKEND = None
+
+
+def connection_class(backend):
+    """
+    Return the connection class of a backend ('gplpv' or 'winpv').
+    """
+    if backend == 'gplpv':
+        from .gplpv import XenBusConnectionGPLPV
+        return XenBusConnectionGPLPV
+    if backend == 'winpv':
+        from .winpv import XenBusConnectionWinPV
+        return XenBusConnectionWinPV
+    raise ValueError('Unknown backend: {0!r}'.format(backend))
+
+
+def _load_backend():
+    cached = read_cache(BACKEND_CACHE)
+    if isinstance(cached, dict) \
+            and cached.get('version') == _BACKEND_CACHE_VERSION \
+            and cached.get('backend') in BACKENDS:
+        return str(cached['backend'])
+    return None
+
+
+def _save_backend(backend):
+    write_cache(BACKEND_CACHE, {
+        'version': _BACKEND_CACHE_VERSION,
+        'backend': backend,
+    })
+
+
+def _forget_backend():
+    remove_cache(BACKEND_CACHE)
+
+
+def _probe(backend, results):
+    try:
+        connection_class(backend).probe()
+    except Exception as exc:  # pylint: disable=W0703
+        results.put((backend, exc))
+    else:
+        results.put((backend, None))
+
+
+def probe_backends(backends=BACKENDS, timeout=PROBE_TIMEOUT):
+    """
+    Probe the backends from separate threads & return the name of the first
+    one which is available. Raises BackendNotFoundError if none are found
+    within timeout seconds. A probe which is still running then is left to
+    finish in the background.
+    """
+    results = Queue()
+    for backend in backends:
+        thread = threading.Thread(
+            target=_probe, args=(backend, results),
+            name='win_pyxs-probe-' + backend
+        )
+        thread.daemon = True
+        thread.start()
+
+    deadline = _clock() + timeout
+    errors = {}
+    while len(errors) < len(backends):
+        try:
+            backend, error = results.get(
+                timeout=max(deadline - _clock(), 0)
+            )
+        except Empty:
+            break
+
+        if error is None:
+            _logger.debug('Found the %s backend', backend)
+            return backend
+
+        _logger.debug('The %s backend is not available: %s', backend, error)
+        errors[backend] = error
+
+    raise BackendNotFoundError('No xenstore backend found ({0})'.format(
+        ', '.join(
+            '{0}: {1}'.format(
+                backend, errors.get(backend, 'timed out after {0}s'.format(
+                    timeout
+                ))
+            ) for backend in backends
+        )
+    ))
+
+
+def detect_backend(timeout=PROBE_TIMEOUT, cache=True):
+    """
+    Return the name of the backend to use on this machine. The result of an
+    earlier call (in this process or, if cache is True, another one) is
+    reused, otherwise the backends are probed with probe_backends().
+    """
+    global _BACKEND
+
+    if cache:
+        backend = _BACKEND or _load_backend()
+        if backend is not None:
+            _BACKEND = backend
+            return backend
+
+    backend = _BACKEND = probe_backends(timeout=timeout)
+    if cache:
+        _save_backend(backend)
+    return backend
+
+
+def forget_backend():
+    """
+    Forget the backend found by detect_backend() so that the next call
+    probes again.
+    """
+    global _BACKEND
+
+    _BACKEND = None
+    _forget_backend()
+
+
+def connect(backend=None, timeout=PROBE_TIMEOUT, cache=True, **kwargs):
+    """
+    Return a connected xenstore connection for use with pyxs.Router.
+
+    :param backend: 'gplpv' or 'winpv' to use that backend, otherwise it is
+        detected with detect_backend().
+    :param timeout: How long to wait for a backend to be detected.
+    :param cache: Whether to reuse (& store) the detected backend.
+    :param kwargs: Passed to the connection class.
+    """
+    if backend not in (None, 'auto'):
+        connection = connection_class(backend)(**kwargs)
+        connection.connect()
+        return connection
+
+    known = _BACKEND or (cache and _load_backend())
+    backend = detect_backend(timeout=timeout, cache=cache)
+    connection = connection_class(backend)(**kwargs)
+    try:
+        connection.connect()
+    except PyXSError:
+        if not known:
+            raise
+
+        # The drivers may have changed since the backend was detected
+        _logger.info('Cached %s backend failed, detecting again', backend)
+        forget_backend()
+        backend = detect_backend(timeout=timeout, cache=cache)
+        connection = connection_class(backend)(**kwargs)
+        connection.connect()
+
+    _logger.debug('Using %s', connection.__class__.__name__)
+    return connection
@@ -9,6 +9,9 @@ __all__ = [
     'UnknownSessionError',
     'GPLPVDeviceOpenError',
     'GPLPVDriverError',
+    'BackendNotFoundError',
+    'CircuitOpenError',
+    'StreamCorruptError',
 ]
 
 from pyxs import PyXSError
@@ -33,11 +36,40 @@ class UnknownSessionError(WinPyXSError):
 class GPLPVDeviceOpenError(WinPyXSError):
     """
     Exception raised by the GPLPV connection when opening the device fails.
+    The Windows error code is available as winerror (None if it is not
+    known).
     """
 
+    def __init__(self, message, winerror=None):
+        super(GPLPVDeviceOpenError, self).__init__(message)
+        self.winerror = winerror
+
 
 class GPLPVDriverError(WinPyXSError):
     """
     Exception raised by the GPLPV connection when it fails to learn the device
     path used by the driver.
     """
+
+
+class BackendNotFoundError(WinPyXSError):
+    """
+    Exception raised by win_pyxs.connect() when neither the GPLPV nor the
+    WinPV drivers can be found.
+    """
+
+
+class CircuitOpenError(WinPyXSError):
+    """
+    Exception raised by the WinPV connection when it does not try to connect
+    to WMI because recent attempts have all failed (see
+    win_pyxs.supervisor.CircuitBreaker).
+    """
+
+
+class StreamCorruptError(WinPyXSError):
+    """
+    Exception raised by win_pyxs.stream when a chunked value cannot be read
+    back as it was written: its manifest is invalid, a chunk cannot be
+    decoded or the length or checksum of the data does not match.
+    """
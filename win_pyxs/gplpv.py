@@ -8,128 +8,99 @@ from __future__ import print_function
 
 __all__ = ['XenBusConnectionGPLPV']
 
-import ctypes
-from ctypes.wintypes import BOOL
-from ctypes.wintypes import HWND
-from ctypes.wintypes import DWORD
-from ctypes.wintypes import WORD
-from ctypes.wintypes import ULONG
-from ctypes.wintypes import BYTE
+from collections import deque
+import errno
 import logging
 import socket
 import sys
+import threading
 
 sys.coinit_flags = 0
 
 import six
-from win32file import CreateFile, CloseHandle, ReadFile, WriteFile
-from win32file import (
-    FILE_GENERIC_READ, FILE_GENERIC_WRITE, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
-)
 
 import pyxs.connection
-from pyxs._internal import NUL
+from pyxs._internal import NUL, Op, Packet
+from pyxs.exceptions import ConnectionError
 
 from .exceptions import GPLPVDeviceOpenError, GPLPVDriverError
+from .metrics import ConnectionMetrics
+from .trace import PacketTracer
+from .utils import (
+    LazyModule, LazyVar, read_cache, remove_cache, write_cache
+)
+
+# ctypes & pywin32 are only imported once a connection is used
+ctypes = LazyModule('ctypes')
+wintypes = LazyModule('ctypes.wintypes')
+win32file = LazyModule('win32file')
 
 _WIN_DEVICE_PATH = None
 
+# A xenstore packet is a fixed size header followed by at most 4096 bytes of
+# payload so a buffer of this size can hold any packet read from the device
+XENSTORE_PAYLOAD_MAX = 4096
+READ_BUFFER_SIZE = Packet._struct.size + XENSTORE_PAYLOAD_MAX
 
-class XenBusConnectionGPLPV(pyxs.connection.PacketConnection):
-    """
-    A pyxs.PacketConnection which communicates with xenstore over the PCI
-    device exposed by the GPLPV drivers on Windows. The interface of this
-    driver is very similar to the ones on Linux (direct reads/writes to a
-    file-like object) so we reuse most of the PacketConnection class and leave
-    the implementation detail to the XenBusTransportGPLPV.
-    """
+# The size of the ring buffer the reader thread parses packets from
+RING_BUFFER_SIZE = READ_BUFFER_SIZE * 4
 
-    def create_transport(self):  # pylint disable=R0201
-        """
-        Initialises a new instance of XenBusTransportGPLPV to communicate with
-        xenstore using the GPLPV drivers on Windows.
-        """
-        return XenBusTransportGPLPV()
+# How long close() waits for the reader thread to exit
+READER_JOIN_TIMEOUT = 5
 
-    def recv(self):
-        """
-        This version of recv simply wraps the version from the superclass to
-        ensure that a second recv on the XenBusTransportGPLPV is performed
-        even for packets where no data actually needed to be read from
-        xenstore. Because the read is of 0 length no actual access to the
-        device will be performed but the sends and recvs will tally up
-        correctly which is important to ensure we do not cause a deadlock when
-        reading the file.
-        """
-        packet = super(XenBusConnectionGPLPV, self).recv()
-        if not packet.payload:
-            self.transport.recv(0)
-        return packet
+ERROR_OPERATION_ABORTED = 995
+ERROR_IO_PENDING = 997
 
+_kernel32 = LazyVar(lambda: ctypes.WinDLL('kernel32', use_last_error=True))
 
-class XenBusTransportGPLPV(object):
-    """
-    A transport for pyxs which communicates with xenstore using the PCI device
-    exposed by the GPLPV drivers for Windows. The PCI device is a file-like
-    object which can only be written to/read from using Windows APIs. Despite
-    the alternate APIs the goal is to keep things as similar as possible to the
-    equivalent transports in pyxs. The major limitation preventing this is that
-    it is not possible to use select on the file-like objects used here (as
-    select on Windows can only be used on sockets) so a less-optimal way
-    involving a socketpair has been used instead.
-    """
 
-    def __init__(self):
-        global _WIN_DEVICE_PATH
+def _define_overlapped():
+    class OVERLAPPED(ctypes.Structure):
+        _fields_ = [
+            ('Internal', ctypes.c_void_p),
+            ('InternalHigh', ctypes.c_void_p),
+            ('Offset', wintypes.DWORD),
+            ('OffsetHigh', wintypes.DWORD),
+            ('hEvent', wintypes.HANDLE),
+        ]
 
-        self._logger = logging.getLogger(
-            __name__ + '.' + self.__class__.__name__
-        )
+    return OVERLAPPED
 
-        self.fd = None
-        self.notify = False
 
-        # A socket pair which can be used to mimic the default pyxs behaviour
-        # of returning a fileno which can be slected on to check when data is
-        # available
-        self.r_terminator, self.w_terminator = socket.socketpair()
+_OVERLAPPED = LazyVar(_define_overlapped)
 
-        # Once the windows device path is learned once reuse it otherwise
-        # ctypes.POINTER() for the same structure leaks memory. Although
-        # this can be reclaimed with ctypes._reset_cache() this is poking
-        # at the internals of ctypes which doesn't seem to be a good idea.
-        if _WIN_DEVICE_PATH:
-            self.path = _WIN_DEVICE_PATH
-            self._logger.debug(
-                'Reused already-discovered device path: %s', self.path
-            )
-        else:
-            self.path = self._get_device_path()
-            _WIN_DEVICE_PATH = self.path
-            self._logger.debug('Discovered device path: %s', self.path)
 
-        self._open_device()
+DIGCF_PRESENT = 2
+DIGCF_DEVICEINTERFACE = 16
+ERROR_INSUFFICIENT_BUFFER = 122
+ERROR_NO_MORE_ITEMS = 259
 
-    def _get_device_path(self):
-        # Determine self.path using some magic Windows code which is derived
-        # from:
-        #   http://pydoc.net/Python/pyserial/2.6/serial.tools.list_ports_windows/.
-        # The equivalent C from The GPLPV driver source can be found in
-        # get_xen_interface_path() of shutdownmon:
-        #   http://xenbits.xensource.com/ext/win-pvdrivers/file/896402519f15/shutdownmon/shutdownmon.c
+ERROR_FILE_NOT_FOUND = 2
+ERROR_PATH_NOT_FOUND = 3
+
+# The errors opening a cached device path which mean that the path is stale
+# (rather than e.g. that the device is in use or access was denied)
+_STALE_PATH_ERRORS = (ERROR_FILE_NOT_FOUND, ERROR_PATH_NOT_FOUND)
+
+#: The name of the cache file (see win_pyxs.utils.cache_path) the device
+#: path is stored in so that other processes can skip discovering it
+DEVICE_PATH_CACHE = 'win_pyxs-gplpv-device.json'
+_DEVICE_PATH_CACHE_VERSION = 1
+
+
+class _SetupAPI(object):
+    """
+    The structures & SetupAPI prototypes used to discover the device path.
+    These are only defined once per process (see _setupapi) as every
+    ctypes.POINTER() of a new structure class is cached by ctypes forever.
+    """
 
-        DIGCF_PRESENT = 2
-        DIGCF_DEVICEINTERFACE = 16
-        NULL = None
-        ERROR_SUCCESS = 0
-        ERROR_INSUFFICIENT_BUFFER = 122
-        ERROR_NO_MORE_ITEMS = 259
+    def __init__(self):
+        from ctypes.wintypes import BOOL, BYTE, DWORD, HWND, ULONG, WORD
 
         HDEVINFO = ctypes.c_void_p
         PCTSTR = ctypes.c_char_p
-        CHAR = ctypes.c_char
         PDWORD = ctypes.POINTER(DWORD)
-        LPDWORD = ctypes.POINTER(DWORD)
         PULONG = ctypes.POINTER(ULONG)
 
         # Return code checkers
@@ -215,80 +186,705 @@ class XenBusTransportGPLPV(object):
         SetupDiDestroyDeviceInfoList.argtypes = [HDEVINFO]
         SetupDiDestroyDeviceInfoList.restype = BOOL
 
-        # Do stuff
-        GUID_XENBUS_IFACE = GUID(
+        self.GUID = GUID
+        self.SP_DEVINFO_DATA = SP_DEVINFO_DATA
+        self.SP_DEVICE_INTERFACE_DATA = SP_DEVICE_INTERFACE_DATA
+        self.SetupDiGetClassDevs = SetupDiGetClassDevs
+        self.SetupDiEnumDeviceInterfaces = SetupDiEnumDeviceInterfaces
+        self.SetupDiGetDeviceInterfaceDetail = SetupDiGetDeviceInterfaceDetail
+        self.SetupDiDestroyDeviceInfoList = SetupDiDestroyDeviceInfoList
+
+        self.GUID_XENBUS_IFACE = GUID(
             0x14ce175a, 0x3ee2, 0x4fae,
             (BYTE * 8)(0x92, 0x52, 0x0, 0xdb, 0xd8, 0x4f, 0x1, 0x8e)
         )
 
-        handle = SetupDiGetClassDevs(
-            ctypes.byref(GUID_XENBUS_IFACE), NULL, NULL,
-            DIGCF_PRESENT | DIGCF_DEVICEINTERFACE
-        )
+        # SP_DEVICE_INTERFACE_DETAIL_DATA_A structures keyed by the buffer
+        # size reported by SetupDiGetDeviceInterfaceDetail
+        self._detail_data = {}
 
-        sdid = SP_DEVICE_INTERFACE_DATA()
-        sdid.cbSize = ctypes.sizeof(sdid)
-        if not SetupDiEnumDeviceInterfaces(
-            handle, NULL, ctypes.byref(GUID_XENBUS_IFACE), 0,
-            ctypes.byref(sdid)
-        ):
-            if ctypes.GetLastError() != ERROR_NO_MORE_ITEMS:
-                raise GPLPVDriverError(str(ctypes.WinError()))
+    def detail_data(self, size):
+        """
+        Return a SP_DEVICE_INTERFACE_DETAIL_DATA_A structure class with room
+        for a DevicePath of size - sizeof(DWORD) characters.
+        """
+        structure = self._detail_data.get(size)
+        if structure is None:
+            DWORD = wintypes.DWORD
+
+            class SP_DEVICE_INTERFACE_DETAIL_DATA_A(ctypes.Structure):
+                _fields_ = [
+                    ('cbSize', DWORD),
+                    ('DevicePath', ctypes.c_char * (
+                        size - ctypes.sizeof(DWORD)
+                    )),
+                ]
+
+                def __str__(self):
+                    return "DevicePath:%s" % (self.DevicePath, )
+
+            structure = self._detail_data[size] = \
+                SP_DEVICE_INTERFACE_DETAIL_DATA_A
+        return structure
+
+
+_setupapi = LazyVar(_SetupAPI)
+
+
+def _load_device_path():
+    """
+    Return the device path stored by another process or None.
+    """
+    cached = read_cache(DEVICE_PATH_CACHE)
+    if isinstance(cached, dict) \
+            and cached.get('version') == _DEVICE_PATH_CACHE_VERSION:
+        path = cached.get('path')
+        if path and isinstance(path, six.string_types):
+            return str(path)
+    return None
+
+
+def _save_device_path(path):
+    write_cache(DEVICE_PATH_CACHE, {
+        'version': _DEVICE_PATH_CACHE_VERSION,
+        'path': path,
+    })
+
+
+def _forget_device_path():
+    remove_cache(DEVICE_PATH_CACHE)
+
+
+class _OverlappedDevice(object):
+    """
+    A handle opened with FILE_FLAG_OVERLAPPED. Synchronous I/O on a handle is
+    serialised by Windows so a read blocked waiting for xenstore would stop
+    any request being written. Reads & writes are instead issued as
+    overlapped I/O, each with their own OVERLAPPED structure & event, & then
+    waited for. The ReadFile & WriteFile calls are made through ctypes so the
+    data can be read directly into (& written from) existing buffers.
+
+    The file offset is tracked in the OVERLAPPED structures. The GPLPV device
+    ignores it but it allows a regular file to stand in for the device.
+    """
 
-        buf_len = DWORD()
-        if not SetupDiGetDeviceInterfaceDetail(
-            handle, ctypes.byref(sdid), NULL, 0, ctypes.byref(buf_len), NULL
+    def __init__(self, handle):
+        self.handle = handle
+        self._read_overlapped = self._new_overlapped()
+        self._write_overlapped = self._new_overlapped()
+
+    @staticmethod
+    def _new_overlapped():
+        overlapped = _OVERLAPPED()()
+        overlapped.hEvent = _kernel32().CreateEventW(None, True, False, None)
+        if not overlapped.hEvent:
+            raise ctypes.WinError(ctypes.get_last_error())
+        return overlapped
+
+    def _call(self, func, buf, size, overlapped):
+        handle = wintypes.HANDLE(int(self.handle))
+        count = wintypes.DWORD()
+        if not func(handle, buf, size, None, ctypes.byref(overlapped)):
+            error = ctypes.get_last_error()
+            if error != ERROR_IO_PENDING:
+                raise ctypes.WinError(error)
+
+        if not _kernel32().GetOverlappedResult(
+            handle, ctypes.byref(overlapped), ctypes.byref(count), True
         ):
-            if ctypes.GetLastError() != ERROR_INSUFFICIENT_BUFFER:
-                raise GPLPVDriverError(str(ctypes.WinError()))
+            raise ctypes.WinError(ctypes.get_last_error())
 
-        # We didn't know how big to make the structure until buf_len is
-        # assigned...
-        class SP_DEVICE_INTERFACE_DETAIL_DATA_A(ctypes.Structure):
-            _fields_ = [
-                ('cbSize', DWORD),
-                ('DevicePath', CHAR * (buf_len.value - ctypes.sizeof(DWORD))),
-            ]
+        position = (overlapped.OffsetHigh << 32 | overlapped.Offset) \
+            + count.value
+        overlapped.Offset = position & 0xffffffff
+        overlapped.OffsetHigh = position >> 32
 
-            def __str__(self):
-                return "DevicePath:%s" % (self.DevicePath, )
+        return count.value
+
+    def read_into(self, view):
+        """
+        Read from the device into a writable buffer (such as a slice of a
+        memoryview over a bytearray) & return the number of bytes read.
+        """
+        buf = (ctypes.c_char * len(view)).from_buffer(view)
+        return self._call(
+            _kernel32().ReadFile, buf, len(view), self._read_overlapped
+        )
 
-        sdidd = SP_DEVICE_INTERFACE_DETAIL_DATA_A()
-        sdidd.cbSize = ctypes.sizeof(
-            ctypes.POINTER(SP_DEVICE_INTERFACE_DETAIL_DATA_A)
+    def write(self, data, start=0):
+        """
+        Write data[start:] to the device without copying it & return the
+        number of bytes written. data must be a bytes object.
+        """
+        address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        return self._call(
+            _kernel32().WriteFile, ctypes.c_void_p(address + start),
+            len(data) - start, self._write_overlapped
         )
-        if not SetupDiGetDeviceInterfaceDetail(
-            handle, ctypes.byref(sdid), ctypes.byref(sdidd), buf_len, NULL,
-            NULL
-        ):
-            raise GPLPVDriverError(str(ctypes.WinError()))
 
-        path = "" + sdidd.DevicePath
+    def cancel(self):
+        """
+        Cancel any pending I/O so that a blocked read_into fails with
+        ERROR_OPERATION_ABORTED.
+        """
+        _kernel32().CancelIoEx(wintypes.HANDLE(int(self.handle)), None)
+
+    def close(self):
+        win32file.CloseHandle(self.handle)
+        for overlapped in (self._read_overlapped, self._write_overlapped):
+            _kernel32().CloseHandle(overlapped.hEvent)
+
+
+class _PacketRing(object):
+    """
+    A fixed size ring buffer holding the bytes read from the device which
+    have not yet been parsed into packets. Reads are made directly into the
+    free space of the ring & complete packets are then framed using the
+    length in their header.
+
+    The payload of each packet framed is a memoryview: of the ring itself if
+    the payload is contiguous, which is only valid until the ring is next
+    written to, otherwise of a copy. Packets which are kept must be copied
+    with _copied().
+    """
+
+    def __init__(self, capacity=RING_BUFFER_SIZE):
+        self.capacity = capacity
+        self._view = memoryview(bytearray(capacity))
+        self._start = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def writable(self):
+        """
+        Return a memoryview of the largest contiguous free region.
+        """
+        if not self._length:
+            self._start = 0
+
+        end = self._start + self._length
+        if end >= self.capacity:
+            return self._view[end - self.capacity:self._start]
+        return self._view[end:]
+
+    def commit(self, count):
+        """
+        Record that count bytes have been written to the writable region.
+        """
+        self._length += count
+
+    def _slice(self, offset, size):
+        """
+        Return a memoryview of size bytes starting offset bytes into the
+        data, copying them only if they wrap around the end of the ring.
+        """
+        start = (self._start + offset) % self.capacity
+        end = start + size
+        if end <= self.capacity:
+            return self._view[start:end]
+
+        data = bytearray(size)
+        split = self.capacity - start
+        data[:split] = self._view[start:]
+        data[split:] = self._view[:end - self.capacity]
+        return memoryview(data)
+
+    def packets(self):
+        """
+        Yield every complete packet in the ring, removing it from the ring.
+        """
+        header_size = Packet._struct.size
+        while self._length >= header_size:
+            op, rq_id, tx_id, size = Packet._struct.unpack(
+                self._slice(0, header_size)
+            )
+            if size > XENSTORE_PAYLOAD_MAX:
+                raise OSError(
+                    errno.EIO, 'Invalid xenstore packet size: {0}'.format(size)
+                )
+
+            if self._length < header_size + size:
+                break
+
+            payload = self._slice(header_size, size)
+            self._start = (self._start + header_size + size) % self.capacity
+            self._length -= header_size + size
+
+            yield Packet(op, payload, rq_id, tx_id)
+
+
+def _copied(packet):
+    """
+    Return packet with its payload copied out of the _PacketRing as bytes.
+    """
+    if isinstance(packet.payload, memoryview):
+        return packet._replace(payload=packet.payload.tobytes())
+    return packet
+
+
+class XenBusConnectionGPLPV(pyxs.connection.PacketConnection):
+    """
+    A pyxs.PacketConnection which communicates with xenstore over the PCI
+    device exposed by the GPLPV drivers on Windows. The interface of this
+    driver is very similar to the ones on Linux (direct reads/writes to a
+    file-like object) so we reuse most of the PacketConnection class and leave
+    the implementation detail to the XenBusTransportGPLPV.
+
+    Replies are read from the device by a background thread so any number of
+    requests can be in flight at once & unsolicited WATCH_EVENT packets are
+    delivered, which means pyxs watches work over this connection.
+
+    A win_pyxs.writebehind.WriteBehind can be passed as write_behind to
+    buffer & coalesce WRITE requests, which are then answered without waiting
+    for the device. A win_pyxs.scheduler.RequestScheduler can be passed as
+    scheduler to limit the requests in flight on the device & choose which
+    are written first by priority class.
+
+    Requests, latencies & the queue depth are recorded in metrics (a
+    win_pyxs.metrics.ConnectionMetrics, created if not given). Every packet
+    is recorded by tracer (a win_pyxs.trace.PacketTracer, created if not
+    given).
+    """
 
-        SetupDiDestroyDeviceInfoList(handle)
+    def __init__(
+        self, metrics=None, tracer=None, write_behind=None, scheduler=None
+    ):
+        super(XenBusConnectionGPLPV, self).__init__()
+
+        self.metrics = metrics if metrics is not None else ConnectionMetrics()
+        self.metrics.gauge('queue_depth', self._queue_depth)
+        self._connects = 0
+
+        self.tracer = tracer if tracer is not None else PacketTracer()
+
+        self.write_behind = write_behind
+        if write_behind is not None:
+            self.metrics.gauge('writes_avoided', lambda: write_behind.avoided)
+
+        self.scheduler = scheduler
+
+    def _queue_depth(self):
+        transport = self.transport
+        depth = 0 if transport is None else transport.queue_depth()
+        if self.scheduler is not None:
+            depth += len(self.scheduler)
+        return depth
+
+    @classmethod
+    def probe(cls):
+        """
+        Check that the GPLPV device can be opened, raising GPLPVDriverError
+        or GPLPVDeviceOpenError if not. The device path is kept so that a
+        connection made afterwards does not need to discover it again.
+        """
+        XenBusTransportGPLPV().close()
 
+    def create_transport(self):  # pylint disable=R0201
+        """
+        Initialises a new instance of XenBusTransportGPLPV to communicate with
+        xenstore using the GPLPV drivers on Windows.
+        """
+        transport = XenBusTransportGPLPV(
+            metrics=self.metrics, tracer=self.tracer
+        )
+        if self.write_behind is not None or self.scheduler is not None:
+            transport.intercept = self._intercept
+
+        if self._connects:
+            self.metrics.increment('reconnects')
+        self._connects += 1
+
+        return transport
+
+    def connect(self):
+        super(XenBusConnectionGPLPV, self).connect()
+        if self.scheduler is not None:
+            self.scheduler.attach(self._send_scheduled, metrics=self.metrics)
+        if self.write_behind is not None:
+            self.write_behind.attach(self._send_writes)
+
+    def _send_writes(self, packets):
+        """
+        Send the writes flushed by the WriteBehind. Returns a dict mapping the
+        rq_id of each packet which could not be sent to the exception.
+        """
+        failures = {}
+        for packet in packets:
+            try:
+                self.send(packet)
+            except ConnectionError as exc:
+                failures[packet.rq_id] = exc
+        return failures
+
+    def _intercept(self, packet):
+        """
+        Called by the transport with each reply. Returns True if the reply was
+        to a write flushed by the WriteBehind.
+        """
+        if self.scheduler is not None:
+            self.scheduler.completed(packet)
+        return self.write_behind is not None \
+            and self.write_behind.completed(packet)
+
+    def _send_scheduled(self, packets):
+        """
+        Write the requests released by the scheduler. Their senders have
+        already returned so a request which cannot be written, for whatever
+        reason, is answered with an EIO error.
+        """
+        for packet in packets:
+            try:
+                if not self.is_connected:
+                    raise ConnectionError("not connected")
+                self._write(packet)
+            except Exception as exc:  # pylint: disable=W0703
+                self.scheduler.completed(packet)
+                transport = self.transport
+                if transport is not None:
+                    if not isinstance(exc, ConnectionError):
+                        transport._logger.exception(
+                            'Failed writing a scheduled request:'
+                        )
+                    transport.deliver(Packet(
+                        Op.ERROR, b'EIO' + NUL, packet.rq_id, packet.tx_id
+                    ))
+
+    def close(self, silent=True):
+        """
+        Flush any buffered writes, send any scheduled requests & close the
+        device.
+        """
+        if self.write_behind is not None and self.is_connected:
+            self.write_behind.detach()
+        if self.scheduler is not None:
+            self.scheduler.detach()
+        super(XenBusConnectionGPLPV, self).close(silent)
+
+    def _connection_error(self, exc, action):
+        if exc.args and exc.args[0] in [
+            errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE
+        ]:
+            self.close()
+
+        return ConnectionError(
+            "error while {0} {1!r}: {2}".format(action, self.path, exc.args)
+        )
+
+    def send(self, packet):
+        """
+        Send a packet to xenstore. The header & payload are written to the
+        device together & the rq_id is registered with the transport so that
+        the reply can be matched to it. With a scheduler the packet is queued
+        & written when it is its turn.
+        """
+        if not self.is_connected:
+            raise ConnectionError("not connected")
+
+        self.tracer.sent(packet)
+        self.metrics.request_sent(packet)
+        if self.write_behind is not None:
+            payload = self.write_behind.submit(packet)
+            if payload is not None:
+                self.transport.deliver(
+                    Packet(packet.op, payload, packet.rq_id, packet.tx_id)
+                )
+                return
+
+        if self.scheduler is not None:
+            self.scheduler.submit(packet)
+        else:
+            self._write(packet)
+
+    def _write(self, packet):
+        header = Packet._struct.pack(
+            packet.op, packet.rq_id, packet.tx_id, packet.size
+        )
+        try:
+            self.transport.send(header + packet.payload, rq_id=packet.rq_id)
+        except OSError as exc:
+            self.metrics.request_failed(packet)
+            self.tracer.failed(packet)
+            raise self._connection_error(exc, 'writing to')
+
+    def recv(self):
+        """
+        Return the next packet parsed by the transport's reader thread. Watch
+        events are returned before replies.
+        """
+        if not self.is_connected:
+            raise ConnectionError("not connected")
+
+        try:
+            packet = self.transport.recv_packet()
+        except OSError as exc:
+            self.tracer.dump_on_error()
+            raise self._connection_error(exc, 'reading from')
+
+        self.metrics.reply_received(packet)
+        self.tracer.received(packet)
+        return packet
+
+
+class XenBusTransportGPLPV(object):
+    """
+    A transport for pyxs which communicates with xenstore using the PCI device
+    exposed by the GPLPV drivers for Windows. The PCI device is a file-like
+    object which can only be written to/read from using Windows APIs. Despite
+    the alternate APIs the goal is to keep things as similar as possible to the
+    equivalent transports in pyxs. The major limitation preventing this is that
+    it is not possible to use select on the file-like objects used here (as
+    select on Windows can only be used on sockets) so a less-optimal way
+    involving a socketpair has been used instead.
+
+    A reader thread continuously reads from the device into a ring buffer &
+    parses complete packets from it. Replies are matched against the rq_ids
+    which have been sent & watch events are queued separately. One byte is
+    written to the socketpair for each packet so that fileno() becomes
+    readable whenever recv_packet() has something to return.
+    """
+
+    def __init__(self, metrics=None, tracer=None):
+        global _WIN_DEVICE_PATH
+
+        self._logger = logging.getLogger(
+            __name__ + '.' + self.__class__.__name__
+        )
+
+        self.metrics = metrics
+        self.tracer = tracer
+        self.path = None
+        self.device = None
+        self.closing = False
+        self.error = None
+
+        # Called with each reply before it is queued. If it returns True the
+        # reply is not returned by recv_packet() (see
+        # win_pyxs.writebehind.WriteBehind.completed()). The payload of the
+        # reply is a memoryview which is only valid during the call, so the
+        # replies it consumes are never copied out of the ring.
+        self.intercept = None
+
+        self._ring = _PacketRing()
+        self._replies = deque()
+        self._events = deque()
+
+        # The rq_ids of the requests which are waiting for a reply
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+        # A socket pair which can be used to mimic the default pyxs behaviour
+        # of returning a fileno which can be slected on to check when data is
+        # available
+        self.r_terminator, self.w_terminator = socket.socketpair()
+
+        # Discovering the device path is slow so once it is known it is kept
+        # for the rest of this process & for other processes
+        self._open_cached_device()
+        if self.device is None:
+            self.path = self._get_device_path()
+            self._logger.debug('Discovered device path: %s', self.path)
+            self.device = self._open_device()
+            _WIN_DEVICE_PATH = self.path
+            _save_device_path(self.path)
+
+        self._reader = threading.Thread(
+            target=self._read_packets, name='XenBusTransportGPLPV-reader'
+        )
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _open_cached_device(self):
+        """
+        Open the device using a path discovered earlier in this process or
+        by another process (see DEVICE_PATH_CACHE). Discovery is only needed
+        if there is no cached path or it no longer exists, e.g. after the
+        drivers were reinstalled. Other errors opening the device (such as
+        ERROR_SHARING_VIOLATION or ERROR_ACCESS_DENIED) are raised & the
+        cached path is kept.
+        """
+        global _WIN_DEVICE_PATH
+
+        cached = [(_WIN_DEVICE_PATH, 'this process')]
+        if not _WIN_DEVICE_PATH:
+            cached.append((_load_device_path(), 'the cache'))
+
+        for path, source in cached:
+            if not path:
+                continue
+
+            self.path = path
+            try:
+                self.device = self._open_device()
+            except GPLPVDeviceOpenError as exc:
+                if exc.winerror not in _STALE_PATH_ERRORS:
+                    # The device exists so discovering it again will not help
+                    raise
+
+                self._logger.info(
+                    'Device path from %s could not be opened: %s',
+                    source, path
+                )
+                _WIN_DEVICE_PATH = None
+                _forget_device_path()
+                continue
+
+            self._logger.debug('Reused device path from %s: %s', source, path)
+            _WIN_DEVICE_PATH = path
+            return
+
+    def _get_device_path(self):
+        # Determine self.path using some magic Windows code which is derived
+        # from:
+        #   http://pydoc.net/Python/pyserial/2.6/serial.tools.list_ports_windows/.
+        # The equivalent C from The GPLPV driver source can be found in
+        # get_xen_interface_path() of shutdownmon:
+        #   http://xenbits.xensource.com/ext/win-pvdrivers/file/896402519f15/shutdownmon/shutdownmon.c
+        api = _setupapi()
+
+        handle = api.SetupDiGetClassDevs(
+            ctypes.byref(api.GUID_XENBUS_IFACE), None, None,
+            DIGCF_PRESENT | DIGCF_DEVICEINTERFACE
+        )
+        try:
+            sdid = api.SP_DEVICE_INTERFACE_DATA()
+            sdid.cbSize = ctypes.sizeof(sdid)
+            if not api.SetupDiEnumDeviceInterfaces(
+                handle, None, ctypes.byref(api.GUID_XENBUS_IFACE), 0,
+                ctypes.byref(sdid)
+            ):
+                if ctypes.GetLastError() != ERROR_NO_MORE_ITEMS:
+                    raise GPLPVDriverError(str(ctypes.WinError()))
+
+            buf_len = wintypes.DWORD()
+            if not api.SetupDiGetDeviceInterfaceDetail(
+                handle, ctypes.byref(sdid), None, 0, ctypes.byref(buf_len),
+                None
+            ):
+                if ctypes.GetLastError() != ERROR_INSUFFICIENT_BUFFER:
+                    raise GPLPVDriverError(str(ctypes.WinError()))
+
+            # We didn't know how big to make the structure until buf_len is
+            # assigned...
+            detail_data = api.detail_data(buf_len.value)
+            sdidd = detail_data()
+            sdidd.cbSize = ctypes.sizeof(ctypes.POINTER(detail_data))
+            if not api.SetupDiGetDeviceInterfaceDetail(
+                handle, ctypes.byref(sdid), ctypes.byref(sdidd), buf_len,
+                None, None
+            ):
+                raise GPLPVDriverError(str(ctypes.WinError()))
+
+            path = sdidd.DevicePath
+        finally:
+            api.SetupDiDestroyDeviceInfoList(handle)
+
+        if not isinstance(path, str):
+            path = path.decode('mbcs')
         return path
 
     def _open_device(self):
         try:
-            self.fd = CreateFile(
-                self.path, FILE_GENERIC_READ | FILE_GENERIC_WRITE, 0, None,
-                OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, None
+            handle = win32file.CreateFile(
+                self.path,
+                win32file.FILE_GENERIC_READ | win32file.FILE_GENERIC_WRITE, 0,
+                None, win32file.OPEN_EXISTING,
+                win32file.FILE_ATTRIBUTE_NORMAL
+                | win32file.FILE_FLAG_OVERLAPPED, None
             )
         except Exception as exc:
             self._logger.exception('Exception opening GPLPV device:')
             six.raise_from(
                 GPLPVDeviceOpenError(
-                    "Error while opening {0!r}".format(self.path)
+                    "Error while opening {0!r}".format(self.path),
+                    winerror=getattr(exc, 'winerror', None)
                 ), exc
             )
 
+        return _OverlappedDevice(handle)
+
+    def _read_packets(self):
+        """
+        The body of the reader thread. Runs until the device is closed or a
+        read fails, in which case the error is raised by recv_packet().
+        """
+        try:
+            while not self.closing:
+                count = self.device.read_into(self._ring.writable())
+                if not count:
+                    raise OSError(errno.ECONNRESET, 'Device returned EOF')
+
+                self._ring.commit(count)
+                for packet in self._ring.packets():
+                    self._dispatch(packet)
+        except Exception as exc:  # pylint: disable=W0703
+            if self.closing:
+                return
+
+            self._logger.exception('Failed reading from GPLPV device:')
+            self.error = exc
+
+            # Wake up the reader of the socketpair so that it sees the error
+            self.w_terminator.sendall(NUL)
+
+    def _dispatch(self, packet):
+        # The payload is only copied out of the ring if the packet is queued
+        if packet.op == Op.WATCH_EVENT:
+            self._events.append(_copied(packet))
+            self.w_terminator.sendall(NUL)
+            return
+
+        with self._lock:
+            try:
+                self._in_flight.remove(packet.rq_id)
+            except KeyError:
+                self._logger.warning(
+                    'Dropping reply to unknown request: %s', _copied(packet)
+                )
+                if self.metrics is not None:
+                    self.metrics.increment('dropped_replies')
+                if self.tracer is not None:
+                    self.tracer.dropped(packet)
+                return
+
+        if self.intercept is not None and self.intercept(packet):
+            if self.metrics is not None:
+                self.metrics.reply_received(packet)
+            if self.tracer is not None:
+                self.tracer.received(packet)
+            return
+
+        self.deliver(_copied(packet))
+
+    def deliver(self, packet):
+        """
+        Queue a reply for recv_packet(). This is also used for replies made
+        without the device, such as those to buffered writes.
+        """
+        if self.metrics is not None:
+            self.metrics.reply_ready(packet)
+        self._replies.append(packet)
+        self.w_terminator.sendall(NUL)
+
     def fileno(self):
         return self.r_terminator.fileno()
 
+    def queue_depth(self):
+        """
+        Return the number of packets read from the device which are waiting
+        for recv_packet().
+        """
+        return len(self._replies) + len(self._events)
+
     def close(self, silent=True):  # pylint disable=W0613
-        CloseHandle(self.fd)
-        self.fd = None
+        self.closing = True
+        self.device.cancel()
+        self._reader.join(READER_JOIN_TIMEOUT)
+
+        self.device.close()
+        self.device = None
 
         self.r_terminator.shutdown(socket.SHUT_RDWR)
 
@@ -297,39 +893,41 @@ class XenBusTransportGPLPV(object):
 
         self.r_terminator = self.w_terminator = None
 
-    def recv(self, size):
-        self._logger.debug('recv: %d', size)
-
-        chunks = []
-        while size:
-            (err, read) = ReadFile(self.fd, size, None)
-            if err:
-                raise OSError(err)
-
-            chunks.append(read)
-            size -= len(read)
-
-        received = 0
-        while received < 1:
-            data = self.r_terminator.recv(1)
-            received += len(data)
-        self._logger.debug('recv: read 1 byte from socket, returning data')
-
-        return b"".join(chunks)
+    def recv_packet(self):
+        """
+        Return the next packet read from the device, consuming the byte
+        written to the socketpair when it was queued. Watch events are
+        returned before replies.
+        """
+        self.r_terminator.recv(1)
 
-    def send(self, data):
-        self._logger.debug('send: %d', len(data))
+        if self._events:
+            return self._events.popleft()
+        if self._replies:
+            return self._replies.popleft()
 
-        size = len(data)
-        while size:
-            err, lwrite = WriteFile(self.fd, data[-size:], None)
-            if err:
-                raise OSError(err)
+        raise self.error or OSError(errno.ECONNRESET, 'Reader stopped')
 
-            size -= lwrite
+    def send(self, data, rq_id=None):
+        """
+        Write data to the device. If rq_id is given the reply to it will be
+        returned by recv_packet() rather than dropped as unexpected.
+        """
+        if not isinstance(data, bytes):
+            data = bytes(data)
 
-        if self.notify:
-            self._logger.debug('send: notifying router')
-            self.w_terminator.sendall(NUL + NUL)
+        if rq_id is not None:
+            # Registered first as the reply may be read before write returns
+            with self._lock:
+                self._in_flight.add(rq_id)
 
-        self.notify = not self.notify
+        try:
+            with self._write_lock:
+                written = 0
+                while written < len(data):
+                    written += self.device.write(data, written)
+        except Exception:
+            if rq_id is not None:
+                with self._lock:
+                    self._in_flight.discard(rq_id)
+            raise
@@ -0,0 +1,320 @@
+"""
+win_pyxs.metrics contains the instrumentation shared by the connection
+classes: per-operation request counts & latency histograms, byte counts,
+named counters (such as WMI retries), gauges (such as queue depth) & named
+histograms with labels (such as the scheduler queueing delay). The
+current values can be read with ConnectionMetrics.snapshot() or exported
+in the Prometheus text format with ConnectionMetrics.to_prometheus().
+"""
+
+__all__ = ['ConnectionMetrics', 'Histogram', 'LATENCY_BUCKETS']
+
+from bisect import bisect_left
+import threading
+import time
+
+from pyxs._internal import Op
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#: The upper bounds (in seconds) of the default latency histogram buckets
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Header (4 x uint32) size of every packet on the wire
+_HEADER_SIZE = 16
+
+_OP_NAMES = dict((value, name) for name, value in zip(Op._fields, Op))
+
+
+def op_name(op):
+    """
+    Return the name of an Op value (e.g. 'READ').
+    """
+    return _OP_NAMES.get(op, str(op))
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket bounds. Observations are counted in the
+    first bucket whose bound they do not exceed (or the implicit +Inf
+    bucket) so each observation is a bisect & an increment.
+    """
+
+    __slots__ = ['bounds', 'counts', 'count', 'sum']
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return a list of (upper bound, cumulative count) pairs ending with
+        the +Inf bucket.
+        """
+        result, total = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': self.cumulative(),
+        }
+
+
+class _OpMetrics(object):
+    __slots__ = ['requests', 'errors', 'latency', 'service']
+
+    def __init__(self, bounds):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram(bounds)
+        self.service = Histogram(bounds)
+
+
+class _InFlight(object):
+    """
+    A request which has been sent & whose reply has not been received yet.
+    """
+
+    __slots__ = ['op', 'sent', 'ready']
+
+    def __init__(self, op, sent):
+        self.op = op
+        self.sent = sent
+        self.ready = False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+        for name, value in labels
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ConnectionMetrics(object):
+    """
+    Metrics for a single connection. The connection reports each request
+    when it is sent, when its reply is available (service latency: the WMI
+    call or the device round trip) & when the reply is returned by recv()
+    (latency: what the pyxs.Router sees). The gap between the two is time
+    spent queued in the connection waiting for the Router.
+
+    :param buckets: The upper bounds of the latency histogram buckets.
+    :param clock: The function used to read the time in seconds.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, clock=_clock):
+        self.buckets = tuple(buckets)
+        self.clock = clock
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self._ops = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def _op(self, op):
+        metrics = self._ops.get(op)
+        if metrics is None:
+            metrics = self._ops[op] = _OpMetrics(self.buckets)
+        return metrics
+
+    def request_sent(self, packet):
+        """
+        Record a request packet which is about to be sent.
+        """
+        now = self.clock()
+        with self._lock:
+            self._op(packet.op).requests += 1
+            self.bytes_sent += _HEADER_SIZE + packet.size
+            self._started[packet.rq_id] = _InFlight(packet.op, now)
+
+    def request_failed(self, packet):
+        """
+        Forget a request which could not be sent. No reply will be recorded.
+        """
+        with self._lock:
+            self._op(packet.op).errors += 1
+            self._started.pop(packet.rq_id, None)
+
+    def reply_ready(self, packet):
+        """
+        Record that the reply to a request is available to recv().
+        """
+        now = self.clock()
+        with self._lock:
+            started = self._started.get(packet.rq_id)
+            if started is not None and not started.ready:
+                started.ready = True
+                self._op(started.op).service.observe(now - started.sent)
+
+    def reply_received(self, packet):
+        """
+        Record a packet returned by recv(). Watch events are counted as
+        received bytes only.
+        """
+        now = self.clock()
+        with self._lock:
+            self.bytes_received += _HEADER_SIZE + packet.size
+            started = self._started.pop(packet.rq_id, None)
+            if started is None:
+                return
+
+            metrics = self._op(started.op)
+            metrics.latency.observe(now - started.sent)
+            if not started.ready:
+                metrics.service.observe(now - started.sent)
+            if packet.op == Op.ERROR:
+                metrics.errors += 1
+
+    def increment(self, name, amount=1):
+        """
+        Add amount to the named counter (e.g. 'wmi_connect_retries').
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def observe(self, name, value, **labels):
+        """
+        Add value to the named histogram with the given labels (e.g. the
+        queueing delay of a request in a scheduler class), which uses the
+        latency buckets.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        """
+        Register a function returning the current value of a gauge (e.g.
+        the queue depth). It is called whenever a snapshot is taken.
+        """
+        self._gauges[name] = func
+
+    def snapshot(self):
+        """
+        Return the current values of all of the metrics as a dict.
+        """
+        gauges = dict((name, func()) for name, func in self._gauges.items())
+        with self._lock:
+            gauges['in_flight'] = len(self._started)
+            histograms = {}
+            for (name, labels), histogram in self._histograms.items():
+                data = histogram.snapshot()
+                data['labels'] = dict(labels)
+                histograms.setdefault(name, []).append(data)
+            return {
+                'ops': dict(
+                    (op_name(op), {
+                        'requests': metrics.requests,
+                        'errors': metrics.errors,
+                        'latency': metrics.latency.snapshot(),
+                        'service': metrics.service.snapshot(),
+                    }) for op, metrics in self._ops.items()
+                ),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'counters': dict(self._counters),
+                'gauges': gauges,
+                'histograms': histograms,
+            }
+
+    def to_prometheus(self, prefix='win_pyxs', labels=None):
+        """
+        Return the metrics in the Prometheus text exposition format.
+
+        :param prefix: The prefix of every metric name.
+        :param labels: An optional dict of labels added to every sample
+            (e.g. {'backend': 'winpv'}).
+        """
+        snapshot = self.snapshot()
+        common = sorted((labels or {}).items())
+        lines = []
+
+        def _metric(name, kind, samples):
+            name = prefix + '_' + name
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for suffix, extra, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(
+                    name, suffix, _format_labels(common + extra),
+                    _format_value(value)
+                ))
+
+        ops = sorted(snapshot['ops'].items())
+        _metric('requests_total', 'counter', [
+            ('', [('op', op)], values['requests']) for op, values in ops
+        ])
+        _metric('request_errors_total', 'counter', [
+            ('', [('op', op)], values['errors']) for op, values in ops
+        ])
+        for histogram in ('latency', 'service'):
+            samples = []
+            for op, values in ops:
+                data = values[histogram]
+                samples.extend(
+                    ('_bucket', [('op', op), ('le', _format_value(bound))],
+                     count) for bound, count in data['buckets']
+                )
+                samples.append(('_sum', [('op', op)], data['sum']))
+                samples.append(('_count', [('op', op)], data['count']))
+            _metric(
+                'request_{0}_seconds'.format(histogram), 'histogram', samples
+            )
+
+        _metric('bytes_sent_total', 'counter', [
+            ('', [], snapshot['bytes_sent'])
+        ])
+        _metric('bytes_received_total', 'counter', [
+            ('', [], snapshot['bytes_received'])
+        ])
+        for name, histograms in sorted(snapshot['histograms'].items()):
+            samples = []
+            for data in sorted(
+                histograms, key=lambda data: sorted(data['labels'].items())
+            ):
+                extra = sorted(data['labels'].items())
+                samples.extend(
+                    ('_bucket', extra + [('le', _format_value(bound))], count)
+                    for bound, count in data['buckets']
+                )
+                samples.append(('_sum', extra, data['sum']))
+                samples.append(('_count', extra, data['count']))
+            _metric(name, 'histogram', samples)
+        for name, value in sorted(snapshot['counters'].items()):
+            _metric(name + '_total', 'counter', [('', [], value)])
+        for name, value in sorted(snapshot['gauges'].items()):
+            _metric(name, 'gauge', [('', [], value)])
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,323 @@
+"""
+win_pyxs.scheduler contains a scheduler which the connection classes can use
+to decide the order requests are sent to xenstore in, so that latency
+critical requests (such as heartbeat writes) are not queued behind the
+thousands of requests made by a bulk job (such as an inventory sweep).
+
+The connection only lets max_in_flight requests into flight at once & the
+rest wait in the scheduler. Every request belongs to a priority class with a
+weight & while several classes have requests waiting they are sent in
+proportion to their weights (smooth weighted round robin), so a busy class
+gets its share but cannot starve the others. Requests of the same class are
+sent in the order they were sent to the connection, so requests which depend
+on each other (such as those in a transaction) should use the same class.
+
+The class of a request is the one returned by classify (a function passed
+the packet which returns a class name or None) or else the one set with
+priority() by the thread sending it or else default. The time each request
+spends waiting is recorded in the 'scheduler_queue_seconds' histogram of the
+connection's metrics labelled by class.
+
+Usage::
+
+    from win_pyxs import XenBusConnectionWinPV
+    from win_pyxs.scheduler import BULK, RequestScheduler
+
+    scheduler = RequestScheduler(max_in_flight=8)
+    connection = XenBusConnectionWinPV(sessions=4, scheduler=scheduler)
+
+    with scheduler.priority(BULK):
+        read_many(client, paths)
+"""
+
+__all__ = ['BULK', 'CONTROL', 'DEFAULT_WEIGHTS', 'RequestScheduler']
+
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_logger = logging.getLogger(__name__)
+
+#: The class of requests which have to be answered quickly
+CONTROL = 'control'
+
+#: The class of requests made by bulk jobs
+BULK = 'bulk'
+
+#: While both classes have requests waiting, 8 control requests are sent for
+#: every bulk one
+DEFAULT_WEIGHTS = {CONTROL: 8, BULK: 1}
+
+#: The metrics histogram the queueing delay is recorded in
+QUEUE_HISTOGRAM = 'scheduler_queue_seconds'
+
+
+class _Class(object):
+    """
+    The queue & counters of a priority class.
+    """
+
+    __slots__ = ['name', 'weight', 'queue', 'current', 'sent', 'max_delay']
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.queue = deque()
+        # The smooth weighted round robin counter
+        self.current = 0
+        self.sent = 0
+        self.max_delay = 0.0
+
+
+class RequestScheduler(object):
+    """
+    A queue of requests waiting to be sent by a connection. A
+    RequestScheduler belongs to a single connection, which attaches to it
+    when it connects. Requests are sent from a background thread & the
+    connection tells the scheduler when each one is answered.
+
+    :param weights: A dict mapping the name of each class to its weight (a
+        positive int). Defaults to DEFAULT_WEIGHTS.
+    :param default: The class of requests which are not otherwise
+        classified.
+    :param max_in_flight: The number of requests sent which may be waiting
+        for their replies at once.
+    :param classify: An optional function passed each request packet which
+        returns the name of its class or None for the usual rules.
+    """
+
+    def __init__(
+        self, weights=None, default=CONTROL, max_in_flight=8, classify=None,
+        clock=_clock
+    ):
+        weights = DEFAULT_WEIGHTS if weights is None else weights
+        if default not in weights:
+            raise ValueError('Unknown default class {0!r}'.format(default))
+        if any(weight < 1 for weight in weights.values()):
+            raise ValueError('Weights must be at least 1')
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+
+        self.default = default
+        self.max_in_flight = max_in_flight
+        self.classify = classify
+        self.clock = clock
+
+        self._classes = dict(
+            (name, _Class(name, weight)) for name, weight in weights.items()
+        )
+        # Ordered so that ties are always broken the same way
+        self._order = [
+            self._classes[name] for name in sorted(self._classes)
+        ]
+
+        # rq_id -> class of the requests sent & not answered yet
+        self._in_flight = {}
+        self._queued = 0
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._local = threading.local()
+
+        # The function sending a list of items for the attached connection
+        self._dispatch = None
+        self._thread = None
+        self._stopping = False
+        self.metrics = None
+
+    def __len__(self):
+        return self._queued
+
+    @contextmanager
+    def priority(self, name):
+        """
+        Return a context manager which puts the requests sent by the calling
+        thread inside it in the class name (unless classify says otherwise).
+        """
+        if name not in self._classes:
+            raise ValueError('Unknown class {0!r}'.format(name))
+
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = name
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def class_of(self, packet):
+        """
+        Return the name of the class packet belongs to.
+        """
+        if self.classify is not None:
+            name = self.classify(packet)
+            if name is not None:
+                if name not in self._classes:
+                    raise ValueError('Unknown class {0!r}'.format(name))
+                return name
+
+        return getattr(self._local, 'priority', None) or self.default
+
+    def attach(self, dispatch, metrics=None):
+        """
+        Start sending with dispatch, which is passed a list of the items
+        given to submit(). Every item sent must be passed to completed() once
+        answered, including those dispatch fails to send (which must still be
+        answered as the sender has already returned), so dispatch should not
+        raise: the items of a batch it raises for are never answered. The
+        queueing delay is recorded in metrics (a
+        win_pyxs.metrics.ConnectionMetrics) if given.
+        """
+        with self._lock:
+            self._dispatch = dispatch
+            self._stopping = False
+            self.metrics = metrics
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(
+                target=self._run, name='win_pyxs-scheduler'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def detach(self):
+        """
+        Send the requests still waiting straight away & stop sending. Called
+        when the connection closes.
+        """
+        with self._lock:
+            self._stopping = True
+            thread, self._thread = self._thread, None
+            self._ready.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        with self._lock:
+            self._dispatch = None
+            self._in_flight.clear()
+
+    def submit(self, packet, item=None):
+        """
+        Queue a request to be sent. item (by default the packet) is what is
+        passed to dispatch when it is its turn.
+        """
+        queued = self._classes[self.class_of(packet)]
+        with self._lock:
+            queued.queue.append(
+                (packet.rq_id, packet if item is None else item, self.clock())
+            )
+            self._queued += 1
+            self._ready.notify()
+
+    def completed(self, packet):
+        """
+        Record the reply to a request, letting another one into flight.
+        Returns False if packet is not the reply to a request sent by the
+        scheduler.
+        """
+        with self._lock:
+            if self._in_flight.pop(packet.rq_id, None) is None:
+                return False
+            self._ready.notify()
+        return True
+
+    def _next(self):
+        """
+        Pick the class the next request is sent from (smooth weighted round
+        robin between the classes with requests waiting).
+        """
+        waiting = [queued for queued in self._order if queued.queue]
+        if not waiting:
+            return None
+
+        total = 0
+        chosen = None
+        for queued in waiting:
+            queued.current += queued.weight
+            total += queued.weight
+            if chosen is None or queued.current > chosen.current:
+                chosen = queued
+        chosen.current -= total
+
+        for queued in self._order:
+            if not queued.queue:
+                queued.current = 0
+        return chosen
+
+    def _take(self, limit):
+        """
+        Take up to limit requests off the queues, returning their
+        (rq_id, item) pairs.
+        """
+        now = self.clock()
+        batch = []
+        while len(batch) < limit:
+            queued = self._next()
+            if queued is None:
+                break
+
+            rq_id, item, since = queued.queue.popleft()
+            self._queued -= 1
+            self._in_flight[rq_id] = queued.name
+            queued.sent += 1
+
+            delay = now - since
+            queued.max_delay = max(queued.max_delay, delay)
+            if self.metrics is not None:
+                self.metrics.observe(
+                    QUEUE_HISTOGRAM, delay, **{'class': queued.name}
+                )
+            batch.append((rq_id, item))
+
+        return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopping and (
+                    not self._queued
+                    or len(self._in_flight) >= self.max_in_flight
+                ):
+                    self._ready.wait()
+
+                dispatch = self._dispatch
+                if self._stopping:
+                    batch = self._take(self._queued)
+                else:
+                    batch = self._take(
+                        self.max_in_flight - len(self._in_flight)
+                    )
+
+            if batch:
+                try:
+                    dispatch([item for _rq_id, item in batch])
+                except Exception:  # pylint: disable=W0703
+                    _logger.exception('Failed sending scheduled requests')
+                    with self._lock:
+                        for rq_id, _item in batch:
+                            self._in_flight.pop(rq_id, None)
+
+            if dispatch is None or self._stopping:
+                break
+
+    def stats(self):
+        """
+        Return the number of requests waiting, sent & the longest queueing
+        delay of each class as a dict so they can be logged or exported.
+        """
+        with self._lock:
+            return {
+                'in_flight': len(self._in_flight),
+                'classes': dict(
+                    (queued.name, {
+                        'weight': queued.weight,
+                        'queued': len(queued.queue),
+                        'sent': queued.sent,
+                        'max_delay': queued.max_delay,
+                    }) for queued in self._order
+                ),
+            }
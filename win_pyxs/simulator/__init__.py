@@ -0,0 +1,171 @@
+"""
+win_pyxs.simulator contains an in-process xenstore simulator which allows the
+real connection classes to be exercised (& benchmarked) without a Windows
+guest. It is made up of an in-memory xenstore tree (XenStore) & two adapters
+in front of it: a fake of the XenProjectXenStoreBase/XenProjectXenStoreSession
+WMI object model used by XenBusConnectionWinPV and a fake xenbus device which
+speaks the binary xenstore protocol to XenBusConnectionGPLPV. Each adapter
+takes a Faults to add latency, jitter & failures to its calls.
+
+Usage::
+
+    from win_pyxs.simulator import Simulator
+
+    with Simulator() as sim:
+        from win_pyxs import XenBusConnectionWinPV
+        with pyxs.Client(router=pyxs.Router(XenBusConnectionWinPV())) as client:
+            client.write(b'data/key', b'value')
+        assert sim.store.read('data/key') == 'value'
+
+On platforms without pywin32 & WMI stand-ins for those modules are added to
+sys.modules so that win_pyxs.winpv & win_pyxs.gplpv can be imported.
+"""
+
+__all__ = [
+    'Faults',
+    'FakeXenBusDevice',
+    'InjectedFailure',
+    'Simulator',
+    'WMIProvider',
+    'XenStore',
+    'XenStoreError',
+]
+
+import threading
+
+from .device import FakeXenBusDevice
+from .faults import Faults, InjectedFailure
+from .fakewmi import WMIProvider
+from .platform import install_modules
+from .store import XenStore, XenStoreError
+
+#: The device path reported to XenBusTransportGPLPV by the simulator
+DEVICE_PATH = r'\\?\simulated#xenbus'
+
+
+class Simulator(object):
+    """
+    Redirects XenBusConnectionWinPV & XenBusConnectionGPLPV to an in-memory
+    XenStore while installed. Connections created while the simulator is
+    installed share its store, so a value written through one backend can be
+    read through the other.
+
+    :param store: The XenStore to use. A new one is created by default.
+    :param wmi_faults: Faults applied to every WMI method call.
+    :param device_faults: Faults applied to every request sent to the fake
+        GPLPV device.
+    :param device_chunk: If given, reads from the fake GPLPV device return at
+        most this many bytes at a time.
+    :param strict_apartments: If True WMI objects fail when used from a
+        thread other than the one which obtained them (see WMIProvider).
+    """
+
+    def __init__(
+        self, store=None, wmi_faults=None, device_faults=None,
+        device_chunk=None, strict_apartments=False
+    ):
+        self.store = store if store is not None else XenStore()
+        self.wmi = WMIProvider(
+            self.store, faults=wmi_faults,
+            strict_apartments=strict_apartments
+        )
+        self.device_faults = device_faults or Faults()
+        self.device_chunk = device_chunk
+
+        #: Every FakeXenBusDevice opened while the simulator was installed
+        self.devices = []
+
+        self._saved = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    @property
+    def installed(self):
+        return self._saved is not None
+
+    def open_device(self):
+        """
+        Return a new FakeXenBusDevice connected to the store.
+        """
+        device = FakeXenBusDevice(
+            self.store, faults=self.device_faults, chunk=self.device_chunk
+        )
+        with self._lock:
+            self.devices.append(device)
+        return device
+
+    def install(self):
+        """
+        Patch win_pyxs.winpv & win_pyxs.gplpv to use the simulator.
+        """
+        if self.installed:
+            return
+
+        install_modules()
+
+        # Imported here as they need the modules installed above
+        from .. import detect, gplpv, winpv
+
+        simulator = self
+        transport = gplpv.XenBusTransportGPLPV
+
+        def _get_device_path(_transport):
+            return DEVICE_PATH
+
+        def _open_device(_transport):
+            return simulator.open_device()
+
+        def _no_cache(*_args):
+            return None
+
+        self._saved = [
+            (winpv, 'wmi', winpv.wmi),
+            (gplpv, '_WIN_DEVICE_PATH', gplpv._WIN_DEVICE_PATH),
+            (transport, '_get_device_path', transport.__dict__[
+                '_get_device_path'
+            ]),
+            (transport, '_open_device', transport.__dict__['_open_device']),
+        ]
+        # The simulated device path & backend must not end up in (or come
+        # from) the cache files shared with real connections
+        for module, name in (
+            (gplpv, '_load_device_path'),
+            (gplpv, '_save_device_path'),
+            (gplpv, '_forget_device_path'),
+            (detect, '_load_backend'),
+            (detect, '_save_backend'),
+            (detect, '_forget_backend'),
+        ):
+            self._saved.append((module, name, getattr(module, name)))
+            setattr(module, name, _no_cache)
+        self._saved.append((detect, '_BACKEND', detect._BACKEND))
+        detect._BACKEND = None
+        # Sessions of the simulated WMI are only used by its own connections
+        self._saved.append((winpv, '_SESSION_USERS', winpv._SESSION_USERS))
+        winpv._SESSION_USERS = {}
+
+        winpv.wmi = self.wmi.module()
+        winpv._wmi_namespace.reset()
+        gplpv._WIN_DEVICE_PATH = None
+        transport._get_device_path = _get_device_path
+        transport._open_device = _open_device
+
+    def uninstall(self):
+        """
+        Undo install(). Connections which are still open keep using the
+        simulator until they are closed.
+        """
+        saved, self._saved = self._saved, None
+        for owner, name, value in reversed(saved or []):
+            setattr(owner, name, value)
+
+        if saved:
+            from .. import winpv
+
+            winpv._wmi_namespace.reset()
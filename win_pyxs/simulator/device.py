@@ -0,0 +1,190 @@
+"""
+A fake of the GPLPV xenbus device. Requests written to it are parsed from
+the xenstore wire format & executed against a XenStore by a server thread,
+which writes the replies (& any watch events) back over a socketpair. The
+reader thread of XenBusTransportGPLPV therefore sees exactly the byte stream
+it would get from the driver.
+"""
+
+__all__ = ['FakeXenBusDevice', 'execute_request']
+
+import errno
+import socket
+import threading
+
+from pyxs._internal import NUL, Op, Packet
+
+from .faults import Faults, InjectedFailure
+from .store import XenStoreError
+
+#: The largest payload a xenstore packet can carry
+XENSTORE_PAYLOAD_MAX = 4096
+
+
+def _error(packet, code):
+    payload = errno.errorcode[code].encode('ascii') + NUL
+    return Packet(Op.ERROR, payload, packet.rq_id, packet.tx_id)
+
+
+def execute_request(store, packet):
+    """
+    Execute a request packet against a XenStore & return the reply packet.
+    Watches are not handled here as they need a way to send events.
+    """
+    fields = packet.payload.split(NUL)
+    path = fields[0].decode('utf-8')
+
+    try:
+        if packet.op == Op.READ:
+            payload = store.read(path).encode('utf-8')
+        elif packet.op == Op.WRITE:
+            value = packet.payload[len(fields[0]) + 1:]
+            store.write(path, value.decode('utf-8'))
+            payload = b'OK\x00'
+        elif packet.op == Op.MKDIR:
+            store.mkdir(path)
+            payload = b'OK\x00'
+        elif packet.op == Op.RM:
+            store.rm(path)
+            payload = b'OK\x00'
+        elif packet.op == Op.DIRECTORY:
+            payload = b''.join(
+                name.encode('utf-8') + NUL for name in store.directory(path)
+            )
+        elif packet.op == Op.GET_DOMAIN_PATH:
+            payload = '/local/domain/{0}'.format(path).encode('utf-8') + NUL
+        else:
+            return _error(packet, errno.ENOSYS)
+    except XenStoreError as exc:
+        return _error(packet, exc.errno)
+
+    # As with xenstored a reply which does not fit in a packet is an error
+    if len(payload) > XENSTORE_PAYLOAD_MAX:
+        return _error(packet, errno.E2BIG)
+
+    return Packet(packet.op, payload, packet.rq_id, packet.tx_id)
+
+
+def _recv_exactly(sock, size):
+    view = memoryview(bytearray(size))
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return view.tobytes()
+
+
+class FakeXenBusDevice(object):
+    """
+    Implements the interface XenBusTransportGPLPV uses for its device
+    (read_into, write, cancel & close) on top of a socketpair.
+
+    :param store: The XenStore requests are executed against.
+    :param faults: Optional Faults applied to every request. A failed
+        request gets an EIO error reply.
+    :param chunk: If given, reads return at most this many bytes to exercise
+        the handling of partial reads.
+    """
+
+    def __init__(self, store, faults=None, chunk=None):
+        self.store = store
+        self.faults = faults or Faults()
+        self.chunk = chunk
+
+        self.requests = 0
+        self._watches = {}
+
+        self._client, self._server = socket.socketpair()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._serve, name='FakeXenBusDevice'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def read_into(self, view):
+        if self.chunk:
+            view = view[:self.chunk]
+        return self._client.recv_into(view)
+
+    def write(self, data, start=0):
+        self._client.sendall(memoryview(data)[start:])
+        return len(data) - start
+
+    def cancel(self):
+        try:
+            self._client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.cancel()
+        self._client.close()
+        self._thread.join()
+        self._server.close()
+
+    def _send(self, packet):
+        header = Packet._struct.pack(
+            packet.op, packet.rq_id, packet.tx_id, packet.size
+        )
+        with self._send_lock:
+            self._server.sendall(header + packet.payload)
+
+    def _watch_event(self, path, token):
+        payload = path.encode('utf-8') + NUL + token.encode('utf-8') + NUL
+        self._send(Packet(Op.WATCH_EVENT, payload, 0))
+
+    def _serve(self):
+        header_size = Packet._struct.size
+        try:
+            while True:
+                header = _recv_exactly(self._server, header_size)
+                if header is None:
+                    break
+
+                op, rq_id, tx_id, size = Packet._struct.unpack(header)
+                payload = _recv_exactly(self._server, size) if size else b''
+                if payload is None:
+                    break
+
+                self.requests += 1
+                self._handle(Packet(op, payload, rq_id, tx_id))
+        except socket.error:
+            pass
+        finally:
+            for (path, token) in list(self._watches):
+                self.store.remove_watch(
+                    path, token, self._watches.pop((path, token))
+                )
+
+    def _handle(self, packet):
+        try:
+            self.faults.apply(Op._fields[list(Op).index(packet.op)])
+        except InjectedFailure:
+            self._send(_error(packet, errno.EIO))
+            return
+
+        if packet.op not in (Op.WATCH, Op.UNWATCH):
+            self._send(execute_request(self.store, packet))
+            return
+
+        path, token = [
+            field.decode('utf-8') for field in packet.payload.split(NUL)[:2]
+        ]
+        key = (path, token)
+        if packet.op == Op.UNWATCH:
+            callback = self._watches.pop(key, None)
+            if callback is None:
+                self._send(_error(packet, errno.ENOENT))
+                return
+            self.store.remove_watch(path, token, callback)
+            self._send(Packet(Op.UNWATCH, b'OK\x00', packet.rq_id))
+        elif key in self._watches:
+            self._send(_error(packet, errno.EEXIST))
+        else:
+            # The reply must be sent before the initial event fires
+            self._send(Packet(Op.WATCH, b'OK\x00', packet.rq_id))
+            self._watches[key] = self._watch_event
+            self.store.add_watch(path, token, self._watch_event)
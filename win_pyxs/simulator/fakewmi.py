@@ -0,0 +1,277 @@
+"""
+A fake of the WMI object model exposed by the WinPV drivers
+(XenProjectXenStoreBase & XenProjectXenStoreSession) backed by a XenStore.
+"""
+
+__all__ = [
+    'WMIProvider',
+    'XenProjectXenStoreBase',
+    'XenProjectXenStoreSession',
+    'x_wmi',
+]
+
+import errno
+import itertools
+import re
+import threading
+import types
+
+from .faults import Faults, InjectedFailure
+from .store import XenStoreError
+
+_SESSION_ID_RE = re.compile(r'SessionId\s*=\s*(\d+)')
+_SESSION_NAME_RE = re.compile(r'\bId\s*=\s*"((?:[^"\\]|\\.)*)"')
+
+
+# The HRESULTs the provider fails calls with
+WBEM_E_FAILED = 0x80041001
+WBEM_E_NOT_FOUND = 0x80041002
+
+
+class _ComError(object):
+    """
+    Stands in for the pywintypes.com_error of a failed WMI call.
+    """
+
+    def __init__(self, hresult):
+        self.hresult = hresult - (1 << 32)  # Signed, like pywintypes
+        self.excepinfo = None
+
+
+class x_wmi(Exception):  # pylint: disable=C0103
+    """
+    Stands in for wmi.x_wmi, the exception raised by the wmi module when a
+    WMI call fails. Like the real one it keeps the com_error of a failed
+    method call.
+    """
+
+    def __init__(self, info='', com_error=None):
+        super(x_wmi, self).__init__(info)
+        self.info = info
+        self.com_error = com_error
+
+
+def _text(value):
+    # Like the real provider accept either text or bytes (without a NUL)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value.rstrip(u'\x00')
+
+
+class _Children(object):
+    """
+    The object returned by GetChildren.
+    """
+
+    def __init__(self, names):
+        self.childNodes = names  # pylint: disable=C0103
+        self.NoOfChildNodes = len(names)  # pylint: disable=C0103
+
+
+class _ApartmentBound(object):
+    """
+    Wraps a WMI object so that calling its methods from a thread other than
+    the one which obtained it fails, as it does for a COM object used outside
+    its apartment without being marshalled.
+    """
+
+    def __init__(self, provider, wrapped):
+        self._provider = provider
+        self._wrapped = wrapped
+        self._thread = threading.current_thread()
+
+    def __repr__(self):
+        return repr(self._wrapped)
+
+    def __getattr__(self, name):
+        value = getattr(self._wrapped, name)
+        if not callable(value):
+            return value
+
+        def _call(*args, **kwargs):
+            if threading.current_thread() is not self._thread:
+                with self._provider.lock:
+                    self._provider.wrong_thread_calls += 1
+                raise x_wmi(
+                    'RPC_E_WRONG_THREAD: {0} called outside its '
+                    'apartment'.format(name)
+                )
+            return value(*args, **kwargs)
+        return _call
+
+
+class XenProjectXenStoreSession(object):
+    """
+    A fake XenProjectXenStoreSession. Every method call goes through the
+    provider's Faults & raises x_wmi when it fails, as the real object does.
+    """
+
+    def __init__(self, provider, session_id, name):
+        self.provider = provider
+        self.SessionId = session_id  # pylint: disable=C0103
+        self.Id = name  # pylint: disable=C0103
+        self.ended = False
+
+    def __repr__(self):
+        return 'XenProjectXenStoreSession(SessionId={0}, Id={1!r})'.format(
+            self.SessionId, self.Id
+        )
+
+    def _call(self, name, func, *args):
+        try:
+            self.provider.faults.apply(name)
+            if self.ended:
+                raise x_wmi('Session {0} has ended'.format(self.SessionId))
+            return func(*args)
+        except (InjectedFailure, XenStoreError) as exc:
+            missing = getattr(exc, 'errno', None) == errno.ENOENT
+            raise x_wmi(
+                '{0} failed: {1}'.format(name, exc),
+                _ComError(WBEM_E_NOT_FOUND if missing else WBEM_E_FAILED)
+            )
+
+    def GetValue(self, path):  # pylint: disable=C0103
+        return (self._call('GetValue', self.provider.store.read, _text(path)),)
+
+    def SetValue(self, path, value):  # pylint: disable=C0103
+        self._call(
+            'SetValue', self.provider.store.write, _text(path), _text(value)
+        )
+        return ()
+
+    def RemoveValue(self, path):  # pylint: disable=C0103
+        self._call('RemoveValue', self.provider.store.rm, _text(path))
+        return ()
+
+    def GetChildren(self, path):  # pylint: disable=C0103
+        names = self._call(
+            'GetChildren', self.provider.store.directory, _text(path)
+        )
+        return (_Children(names),)
+
+    def EndSession(self):  # pylint: disable=C0103
+        self._call('EndSession', self.provider.end_session, self.SessionId)
+        return ()
+
+
+class XenProjectXenStoreBase(object):
+    """
+    A fake XenProjectXenStoreBase which creates sessions.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def AddSession(self, Id):  # pylint: disable=C0103
+        try:
+            self.provider.faults.apply('AddSession')
+        except InjectedFailure as exc:
+            raise x_wmi(str(exc))
+        return (self.provider.add_session(Id).SessionId,)
+
+
+class _Namespace(object):
+    """
+    The object returned by wmi.WMI(moniker="//./root/wmi").
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def XenProjectXenStoreBase(self):  # pylint: disable=C0103
+        return [self.provider.bind(self.provider.base)]
+
+    def XenProjectXenStoreSession(self):  # pylint: disable=C0103
+        with self.provider.lock:
+            sessions = list(self.provider.sessions.values())
+        return [self.provider.bind(session) for session in sessions]
+
+    def query(self, wql):
+        match = _SESSION_ID_RE.search(wql)
+        name = _SESSION_NAME_RE.search(wql)
+        with self.provider.lock:
+            if match is not None:
+                session = self.provider.sessions.get(int(match.group(1)))
+                return [] if session is None \
+                    else [self.provider.bind(session)]
+            sessions = sorted(
+                self.provider.sessions.values(),
+                key=lambda session: session.SessionId
+            )
+        if name is not None:
+            value = re.sub(r'\\(.)', r'\1', name.group(1))
+            sessions = [session for session in sessions if session.Id == value]
+        return [self.provider.bind(session) for session in sessions]
+
+
+class WMIProvider(object):
+    """
+    Holds the state of the fake WMI provider: the XenStore the sessions
+    operate on & the sessions which currently exist.
+
+    :param store: The win_pyxs.simulator.XenStore to use.
+    :param faults: Optional Faults applied to every WMI method call. This
+        includes connecting via WMI() so connection retries can be tested.
+    :param strict_apartments: If True the objects returned can only be used
+        from the thread which obtained them (every other call raises x_wmi &
+        is counted in wrong_thread_calls), like COM objects which have not
+        been marshalled between apartments.
+    """
+
+    def __init__(self, store, faults=None, strict_apartments=False):
+        self.store = store
+        self.faults = faults or Faults()
+        self.connect_faults = Faults()
+        self.strict_apartments = strict_apartments
+        self.wrong_thread_calls = 0
+
+        self.base = XenProjectXenStoreBase(self)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+        self.connects = 0
+        self.sessions_added = 0
+
+    def add_session(self, name):
+        with self.lock:
+            session = XenProjectXenStoreSession(self, next(self._ids), name)
+            self.sessions[session.SessionId] = session
+            self.sessions_added += 1
+        return session
+
+    def end_session(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.ended = True
+
+    def bind(self, wmi_object):
+        """
+        Return wmi_object, bound to the calling thread with strict_apartments.
+        """
+        if self.strict_apartments:
+            return _ApartmentBound(self, wmi_object)
+        return wmi_object
+
+    def WMI(self, moniker=None, find_classes=True, **_kwargs):  # pylint: disable=C0103
+        """
+        The equivalent of wmi.WMI(). connect_faults are applied here.
+        """
+        try:
+            self.connect_faults.apply('WMI')
+        except InjectedFailure as exc:
+            raise x_wmi(str(exc))
+
+        with self.lock:
+            self.connects += 1
+        return self.bind(_Namespace(self))
+
+    def module(self):
+        """
+        Return a module object which can be used in place of the wmi module.
+        """
+        module = types.ModuleType('wmi')
+        module.WMI = self.WMI
+        module.x_wmi = x_wmi
+        return module
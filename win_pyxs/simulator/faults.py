@@ -0,0 +1,65 @@
+"""
+Latency, jitter & failure injection for the simulated backends.
+"""
+
+__all__ = ['Faults', 'InjectedFailure']
+
+import random
+import threading
+import time
+
+
+class InjectedFailure(Exception):
+    """
+    Raised by Faults.apply() when a call has been chosen to fail.
+    """
+
+
+class Faults(object):
+    """
+    Describes how a simulated call should misbehave. Every call to apply()
+    sleeps for latency plus a uniformly distributed amount up to jitter and
+    then fails with probability failure_rate.
+
+    :param latency: The minimum delay of each call in seconds.
+    :param jitter: The maximum extra delay of each call in seconds.
+    :param failure_rate: The probability (0 to 1) of a call failing.
+    :param seed: Seed for the random number generator so that runs can be
+        repeated.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.calls = 0
+        self.failures = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Faults(latency={0}, jitter={1}, failure_rate={2})'.format(
+            self.latency, self.jitter, self.failure_rate
+        )
+
+    def apply(self, name='call'):
+        """
+        Delay & possibly fail the named call.
+        """
+        with self._lock:
+            self.calls += 1
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            fail = self.failure_rate and \
+                self._random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if fail:
+            raise InjectedFailure('Injected failure of {0}'.format(name))
@@ -0,0 +1,76 @@
+"""
+Minimal stand-ins for the Windows-only modules imported by win_pyxs
+(pythoncom, win32file & wmi) so that the connection modules can be imported
+on other platforms. They only provide what win_pyxs uses; every real call is
+redirected to the simulator by Simulator.install().
+"""
+
+__all__ = ['fake_modules', 'install_modules']
+
+import importlib
+import sys
+import types
+
+from .fakewmi import x_wmi
+
+
+def _unavailable(name):
+    def _call(*_args, **_kwargs):
+        raise OSError('{0} is not available outside of Windows'.format(name))
+    _call.__name__ = name
+    return _call
+
+
+def _pythoncom():
+    module = types.ModuleType('pythoncom')
+    module.COINIT_APARTMENTTHREADED = 2
+    module.COINIT_MULTITHREADED = 0
+    module.CoInitialize = lambda: None
+    module.CoInitializeEx = lambda flags: None
+    module.CoUninitialize = lambda: None
+    return module
+
+
+def _win32file():
+    module = types.ModuleType('win32file')
+    module.FILE_GENERIC_READ = 0x120089
+    module.FILE_GENERIC_WRITE = 0x120116
+    module.OPEN_EXISTING = 3
+    module.FILE_ATTRIBUTE_NORMAL = 0x80
+    module.FILE_FLAG_OVERLAPPED = 0x40000000
+    module.CreateFile = _unavailable('CreateFile')
+    module.CloseHandle = lambda handle: None
+    return module
+
+
+def _wmi():
+    module = types.ModuleType('wmi')
+    module.WMI = _unavailable('WMI')
+    module.x_wmi = x_wmi
+    return module
+
+
+def fake_modules():
+    """
+    Return a dict of module name -> stand-in module.
+    """
+    return {
+        'pythoncom': _pythoncom(),
+        'win32file': _win32file(),
+        'wmi': _wmi(),
+    }
+
+
+def install_modules():
+    """
+    Add a stand-in to sys.modules for each Windows-only module which cannot
+    be imported. Returns the names of the modules which were added.
+    """
+    installed = []
+    for name, module in fake_modules().items():
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            sys.modules[name] = module
+            installed.append(name)
+    return installed
@@ -0,0 +1,194 @@
+"""
+An in-memory xenstore tree used by the simulated backends.
+"""
+
+__all__ = ['XenStore', 'XenStoreError']
+
+import errno
+import os
+import threading
+
+
+class XenStoreError(Exception):
+    """
+    Raised by XenStore operations. The first argument is the errno value,
+    the same as the pyxs.PyXSError raised for an Op.ERROR reply.
+    """
+
+    def __init__(self, code):
+        super(XenStoreError, self).__init__(code, os.strerror(code))
+
+    @property
+    def errno(self):
+        return self.args[0]
+
+
+class XenStore(object):
+    """
+    A thread-safe in-memory xenstore. Paths are str; relative paths are
+    resolved against the home of the simulated domain
+    (/local/domain/<domid>). Writing a path creates any missing parents with
+    empty values as xenstored does.
+
+    Watches can be registered with a callback which is called with the
+    changed path & the watch token whenever the watched path or anything
+    below it is written or removed.
+
+    :param domid: The domain id of the simulated guest.
+    :param values: An optional dict of path -> value to populate the store.
+    """
+
+    def __init__(self, domid=0, values=None):
+        self.domid = domid
+        self.home = '/local/domain/{0}'.format(domid)
+
+        self._values = {'/': ''}
+        self._children = {'/': {}}
+        self._watches = {}
+        self._lock = threading.RLock()
+
+        self.write('vm', '/vm/00000000-0000-0000-0000-{0:012d}'.format(domid))
+        self.write('domid', str(domid))
+        for path, value in (values or {}).items():
+            self.write(path, value)
+
+    def resolve(self, path):
+        """
+        Return the absolute form of a path.
+        """
+        if path.startswith('/'):
+            return path.rstrip('/') or '/'
+        return self.home + '/' + path
+
+    @staticmethod
+    def _split(path):
+        head, _sep, name = path.rpartition('/')
+        return head or '/', name
+
+    def _require(self, path):
+        if path not in self._values:
+            raise XenStoreError(errno.ENOENT)
+
+    def read(self, path):
+        """
+        Return the value stored at path.
+        """
+        path = self.resolve(path)
+        with self._lock:
+            self._require(path)
+            return self._values[path]
+
+    def exists(self, path):
+        with self._lock:
+            return self.resolve(path) in self._values
+
+    def directory(self, path):
+        """
+        Return the names of the children of path in the order they were
+        created.
+        """
+        path = self.resolve(path)
+        with self._lock:
+            self._require(path)
+            return list(self._children[path])
+
+    def _create(self, path):
+        created = []
+        while path not in self._values:
+            created.append(path)
+            path = self._split(path)[0]
+
+        for node in reversed(created):
+            parent, name = self._split(node)
+            self._values[node] = ''
+            self._children[node] = {}
+            self._children[parent][name] = None
+
+    def write(self, path, value):
+        """
+        Store value at path, creating path & its parents if needed.
+        """
+        path = self.resolve(path)
+        with self._lock:
+            self._create(path)
+            self._values[path] = value
+        self._fire(path)
+
+    def mkdir(self, path):
+        """
+        Create path (& its parents) with an empty value if it is missing.
+        """
+        path = self.resolve(path)
+        with self._lock:
+            if path in self._values:
+                return
+            self._create(path)
+        self._fire(path)
+
+    def rm(self, path):
+        """
+        Remove path & everything below it. Removing a missing path is only
+        an error if its parent is missing too.
+        """
+        path = self.resolve(path)
+        with self._lock:
+            if path not in self._values:
+                self._require(self._split(path)[0])
+                return
+
+            pending = [path]
+            while pending:
+                node = pending.pop()
+                pending.extend(
+                    node.rstrip('/') + '/' + name
+                    for name in self._children.pop(node)
+                )
+                del self._values[node]
+
+            parent, name = self._split(path)
+            self._children[parent].pop(name, None)
+        self._fire(path)
+
+    def add_watch(self, path, token, callback):
+        """
+        Call callback(changed_path, token) whenever path or anything below
+        it changes. As with xenstored the watch fires once straight away.
+        """
+        key = (self.resolve(path), token)
+        with self._lock:
+            self._watches.setdefault(key, []).append(
+                (callback, not path.startswith('/'))
+            )
+        callback(path, token)
+
+    def remove_watch(self, path, token, callback):
+        key = (self.resolve(path), token)
+        with self._lock:
+            callbacks = self._watches.get(key, [])
+            for entry in callbacks:
+                if entry[0] == callback:
+                    callbacks.remove(entry)
+                    break
+            else:
+                raise XenStoreError(errno.ENOENT)
+
+            if not callbacks:
+                del self._watches[key]
+
+    def _fire(self, path):
+        with self._lock:
+            matches = [
+                (watched, token, list(callbacks))
+                for (watched, token), callbacks in self._watches.items()
+                if path == watched or path.startswith(watched.rstrip('/') + '/')
+                or watched.startswith(path.rstrip('/') + '/')
+            ]
+
+        prefix = self.home + '/'
+        for _watched, token, callbacks in matches:
+            for callback, relative in callbacks:
+                # Watches set on relative paths see relative paths
+                if relative and path.startswith(prefix):
+                    callback(path[len(prefix):], token)
+                else:
+                    callback(path, token)
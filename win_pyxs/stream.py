@@ -0,0 +1,425 @@
+"""
+win_pyxs.stream stores values larger than a xenstore packet (such as
+inventory JSON or logs) as a series of chunk keys. The value written to path
+is split into path/0, path/1... & described by path/manifest, which is
+written last so that a reader never sees a manifest for chunks which have not
+all been written.
+
+Chunks are base64 encoded (xenstore values have to be text) & the data can
+optionally be compressed with zlib first. The manifest records the length &
+a checksum of the data so that a value which was overwritten while it was
+being read (or damaged some other way) is detected.
+
+Neither side holds the whole value in memory: ChunkWriter is a file-like
+object which writes each chunk as soon as it is full & read_stream() is a
+generator which yields the data a chunk at a time. Both keep up to window
+requests in flight at once so that, with a connection which handles several
+requests in parallel (such as XenBusConnectionWinPV with sessions > 1), the
+round trips overlap rather than being paid one after another.
+
+Usage::
+
+    with open('inventory.json', 'rb') as stream:
+        write_stream(client, b'data/inventory', stream, compress=True)
+
+    for data in read_stream(client, b'data/inventory'):
+        output.write(data)
+"""
+
+__all__ = [
+    'CHUNK_SIZE',
+    'ChunkWriter',
+    'read_manifest',
+    'read_stream',
+    'write_stream',
+]
+
+import base64
+import binascii
+from collections import deque
+import hashlib
+import json
+import zlib
+
+import pyxs
+from pyxs._internal import NUL, Op, Packet, next_rq_id
+from pyxs.exceptions import UnexpectedPacket
+from pyxs.helpers import check_path, error
+
+from .exceptions import StreamCorruptError
+
+#: The number of bytes of (possibly compressed) data stored in each chunk.
+#: Base64 encoded this is 3072 characters, leaving room for the path in a
+#: 4096 byte packet.
+CHUNK_SIZE = 2304
+
+#: The number of requests kept in flight by default
+WINDOW = 8
+
+MANIFEST = b'manifest'
+
+_MANIFEST_VERSION = 1
+
+_PAYLOAD_MAX = 4096
+
+
+def _chunk_path(path, index):
+    return path + b'/' + str(index).encode('ascii')
+
+
+class _Pipeline(object):
+    """
+    Sends requests through the router of a pyxs.Client, keeping up to window
+    of them in flight, & returns the reply payloads in the order the
+    requests were sent.
+    """
+
+    def __init__(self, client, window):
+        self.client = client
+        self.window = max(window, 1)
+        self._in_flight = deque()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def send(self, op, payload):
+        """
+        Send a request. Returns the payloads of the requests which had to be
+        completed to stay within the window (the oldest first).
+        """
+        completed = []
+        while len(self._in_flight) >= self.window:
+            completed.append(self.next())
+
+        router = self.client.router
+        packet = Packet(op, payload, next_rq_id(), self.client.tx_id)
+        try:
+            rvar = router.send(packet)
+        except Exception:
+            router.rvars.pop(packet.rq_id, None)
+            raise
+        self._in_flight.append((op, rvar))
+        return completed
+
+    def next(self):
+        """
+        Wait for the oldest request in flight & return its reply payload,
+        raising the error the equivalent pyxs.Client call would.
+        """
+        op, rvar = self._in_flight.popleft()
+        reply = rvar.get()
+        if reply.op == Op.ERROR:
+            raise error(reply.payload[:-1])
+        if reply.op != op or reply.tx_id != self.client.tx_id:
+            raise UnexpectedPacket(reply)
+        return reply.payload.rstrip(NUL)
+
+    def drain(self):
+        """
+        Wait for every request in flight & return their reply payloads. If
+        any failed the first error is raised once all have completed.
+        """
+        payloads, failure = [], None
+        while self._in_flight:
+            try:
+                payloads.append(self.next())
+            except pyxs.PyXSError as exc:
+                failure = failure or exc
+        if failure is not None:
+            raise failure
+        return payloads
+
+
+class ChunkWriter(object):
+    """
+    A file-like object which writes the data written to it to path as chunk
+    keys. The value is only complete (& visible to read_stream()) once the
+    writer is closed; leaving a with block because of an exception abandons
+    it instead.
+
+    :param client: A connected pyxs.Client.
+    :param path: The bytes path of the value.
+    :param compress: Whether to compress the data with zlib.
+    :param checksum: The name of the hashlib algorithm used for the checksum
+        of the data or None for no checksum.
+    :param chunk_size: The number of bytes stored in each chunk.
+    :param window: The number of chunk writes kept in flight.
+    """
+
+    def __init__(
+        self, client, path, compress=False, checksum='sha256',
+        chunk_size=CHUNK_SIZE, window=WINDOW
+    ):
+        check_path(path)
+        encoded = (chunk_size + 2) // 3 * 4
+        if len(_chunk_path(path, 10 ** 9)) + encoded + 1 > _PAYLOAD_MAX:
+            raise ValueError(
+                'Chunks of {0} bytes under {1!r} do not fit in a '
+                'packet'.format(chunk_size, path)
+            )
+
+        self.client = client
+        self.path = path
+        self.chunk_size = chunk_size
+        self.checksum = checksum
+
+        self._compressor = zlib.compressobj() if compress else None
+        self._hash = hashlib.new(checksum) if checksum else None
+        self._buffer = bytearray()
+        self._pipeline = _Pipeline(client, window)
+        self._started = False
+
+        #: The number of chunks written & bytes of data written so far
+        self.chunks = 0
+        self.size = 0
+        self.closed = False
+        self.manifest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _start(self):
+        # Hide the previous value before any of its chunks are overwritten
+        self._started = True
+        manifest = self.path + b'/' + MANIFEST
+        try:
+            self.client.delete(manifest)
+        except pyxs.PyXSError:
+            # WinPV does not say why a removal failed
+            try:
+                self.client.read(manifest)
+            except pyxs.PyXSError:
+                return
+            raise
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to a closed ChunkWriter')
+        if not self._started:
+            self._start()
+
+        data = bytes(data)
+        self.size += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+        self._buffer += self._compress(data)
+        self._write_chunks()
+        return len(data)
+
+    def _compress(self, data):
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data)
+
+    def _write_chunks(self, final=False):
+        chunk_size = self.chunk_size
+        offset = 0
+        while len(self._buffer) - offset >= chunk_size \
+                or (final and offset < len(self._buffer)):
+            chunk = bytes(self._buffer[offset:offset + chunk_size])
+            offset += len(chunk)
+            self._pipeline.send(
+                Op.WRITE,
+                _chunk_path(self.path, self.chunks) + NUL
+                + base64.b64encode(chunk)
+            )
+            self.chunks += 1
+        del self._buffer[:offset]
+
+    def _remove_stale_chunks(self):
+        """
+        Remove the chunks of a previous, longer value.
+        """
+        try:
+            names = self.client.list(self.path)
+        except pyxs.PyXSError:
+            return
+
+        for name in names:
+            if name.isdigit() and int(name) >= self.chunks:
+                self._pipeline.send(Op.RM, self.path + b'/' + name + NUL)
+        self._pipeline.drain()
+
+    def close(self):
+        """
+        Write the remaining data & the manifest. Returns the manifest (a
+        dict).
+        """
+        if self.closed:
+            return self.manifest
+        if not self._started:
+            self._start()
+
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+        self._write_chunks(final=True)
+
+        try:
+            self._pipeline.drain()
+        except pyxs.PyXSError:
+            self.closed = True
+            raise
+
+        manifest = {
+            'version': _MANIFEST_VERSION,
+            'chunks': self.chunks,
+            'size': self.size,
+            'encoding': 'base64',
+            'compression': 'zlib' if self._compressor is not None else None,
+            'checksum': None,
+        }
+        if self._hash is not None:
+            manifest['checksum'] = '{0}:{1}'.format(
+                self.checksum, self._hash.hexdigest()
+            )
+
+        self._remove_stale_chunks()
+        self.client.write(
+            self.path + b'/' + MANIFEST,
+            json.dumps(
+                manifest, sort_keys=True, separators=(',', ':')
+            ).encode('ascii')
+        )
+
+        self.closed = True
+        self.manifest = manifest
+        return manifest
+
+    def abort(self):
+        """
+        Stop writing without writing the manifest, so the value is left
+        unreadable. The chunks already written are not removed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._pipeline.drain()
+        except pyxs.PyXSError:
+            pass
+
+
+def write_stream(client, path, stream, **kwargs):
+    """
+    Write everything read from stream (a file-like object opened in binary
+    mode or an iterable of bytes) to path as chunk keys. The keyword
+    arguments are passed to ChunkWriter. Returns the manifest.
+    """
+    with ChunkWriter(client, path, **kwargs) as writer:
+        if hasattr(stream, 'read'):
+            while True:
+                data = stream.read(writer.chunk_size)
+                if not data:
+                    break
+                writer.write(data)
+        else:
+            for data in stream:
+                writer.write(data)
+
+    return writer.manifest
+
+
+def read_manifest(client, path):
+    """
+    Return the manifest of the value at path as a dict. Raises
+    pyxs.PyXSError with ENOENT if there is no (complete) value at path.
+    """
+    value = client.read(path + b'/' + MANIFEST)
+    try:
+        manifest = json.loads(value.decode('ascii'))
+    except ValueError as exc:
+        raise StreamCorruptError(
+            'Invalid manifest for {0!r}: {1}'.format(path, exc)
+        )
+
+    if not isinstance(manifest, dict) \
+            or manifest.get('version') != _MANIFEST_VERSION \
+            or manifest.get('encoding') != 'base64' \
+            or manifest.get('compression') not in (None, 'zlib') \
+            or not isinstance(manifest.get('chunks'), int):
+        raise StreamCorruptError(
+            'Unsupported manifest for {0!r}: {1!r}'.format(path, manifest)
+        )
+    return manifest
+
+
+def read_stream(client, path, window=WINDOW, verify=True):
+    """
+    Read the value written to path by ChunkWriter (or write_stream()) &
+    yield its data as bytes, one piece per chunk. With verify the length &
+    checksum of the data are checked once the last chunk has been read &
+    StreamCorruptError is raised if they do not match, so nothing should be
+    done with the data which cannot be undone before the generator is
+    exhausted.
+
+    :param client: A connected pyxs.Client.
+    :param path: The bytes path of the value.
+    :param window: The number of chunk reads kept in flight.
+    :param verify: Whether to check the length & checksum of the data.
+    """
+    manifest = read_manifest(client, path)
+
+    decompressor = zlib.decompressobj() \
+        if manifest['compression'] == 'zlib' else None
+    digest = None
+    if verify and manifest.get('checksum'):
+        algorithm, _sep, digest = manifest['checksum'].partition(':')
+        try:
+            checksum = hashlib.new(algorithm)
+        except ValueError:
+            raise StreamCorruptError(
+                'Unknown checksum for {0!r}: {1}'.format(path, algorithm)
+            )
+
+    state = {'size': 0}
+
+    def _process(payload):
+        try:
+            data = base64.b64decode(payload)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+        except (binascii.Error, TypeError, zlib.error) as exc:
+            raise StreamCorruptError(
+                'Invalid chunk in {0!r}: {1}'.format(path, exc)
+            )
+
+        state['size'] += len(data)
+        if digest is not None:
+            checksum.update(data)
+        return data
+
+    pipeline = _Pipeline(client, window)
+    for index in range(manifest['chunks']):
+        for payload in pipeline.send(
+            Op.READ, _chunk_path(path, index) + NUL
+        ):
+            yield _process(payload)
+    while len(pipeline):
+        yield _process(pipeline.next())
+
+    if decompressor is not None:
+        data = decompressor.flush()
+        state['size'] += len(data)
+        if digest is not None:
+            checksum.update(data)
+        if data:
+            yield data
+
+    if verify:
+        if state['size'] != manifest.get('size'):
+            raise StreamCorruptError(
+                '{0!r} is {1} bytes rather than {2}'.format(
+                    path, state['size'], manifest.get('size')
+                )
+            )
+        if digest is not None and checksum.hexdigest() != digest:
+            raise StreamCorruptError(
+                'The checksum of {0!r} does not match'.format(path)
+            )
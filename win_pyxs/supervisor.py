@@ -0,0 +1,264 @@
+"""
+win_pyxs.supervisor contains the reconnect supervisor used by
+XenBusConnectionWinPV when connecting to WMI & re-creating sessions.
+
+Failed attempts are retried after an exponentially growing, jittered delay
+until an overall deadline passes. If several connects in a row give up the
+circuit breaker opens & further connects fail immediately with
+CircuitOpenError until a cool-down has passed, rather than every session
+waiting out its own deadline while WMI is unavailable. The breaker is only
+shared by the users of one supervisor (each XenBusConnectionWinPV creates
+its own unless one is passed to it); to have several connections back off
+together give their supervisors the same CircuitBreaker. Listeners can be
+added to be told (with a SupervisorEvent) when the connection is retrying,
+has recovered, has lost its session etc.
+"""
+
+__all__ = [
+    'Backoff',
+    'CircuitBreaker',
+    'ReconnectSupervisor',
+    'SupervisorEvent',
+    'RETRYING',
+    'RECOVERED',
+    'GAVE_UP',
+    'CIRCUIT_OPEN',
+    'CIRCUIT_CLOSED',
+    'SESSION_LOST',
+    'REPLAYED',
+]
+
+from collections import namedtuple
+import logging
+import random
+import threading
+import time
+
+from .exceptions import CircuitOpenError
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_logger = logging.getLogger(__name__)
+
+#: SupervisorEvent kinds: an attempt failed & will be retried after delay
+#: seconds, an attempt succeeded after earlier failures, no more attempts
+#: will be made, the circuit breaker opened or closed, a session was found
+#: to have gone & a request was replayed on a new session
+RETRYING = 'retrying'
+RECOVERED = 'recovered'
+GAVE_UP = 'gave_up'
+CIRCUIT_OPEN = 'circuit_open'
+CIRCUIT_CLOSED = 'circuit_closed'
+SESSION_LOST = 'session_lost'
+REPLAYED = 'replayed'
+
+#: An event passed to the listeners of a ReconnectSupervisor. attempt,
+#: delay & error are None when they do not apply to the kind of event.
+SupervisorEvent = namedtuple('SupervisorEvent', 'kind attempt delay error')
+
+
+class Backoff(object):
+    """
+    Exponential backoff: the delay before retry n (counting from 0) is
+    initial * multiplier ** n, up to maximum, less a random fraction (up to
+    jitter) of itself so that clients which failed together do not all
+    retry together.
+    """
+
+    def __init__(
+        self, initial=0.1, maximum=2.0, multiplier=2.0, jitter=0.5,
+        random=random.random
+    ):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.random = random
+
+    def delay(self, retry):
+        delay = min(self.initial * self.multiplier ** retry, self.maximum)
+        return delay * (1 - self.jitter * self.random())
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures. While open check()
+    raises CircuitOpenError until reset_timeout seconds have passed, after
+    which one attempt is let through (half-open): its success closes the
+    breaker & its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, clock=_clock):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened is None:
+            return self.CLOSED
+        if self.clock() - self._opened >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def check(self):
+        """
+        Raise CircuitOpenError unless an attempt may be made.
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+
+            remaining = max(
+                self.reset_timeout - (self.clock() - self._opened), 0
+            )
+        raise CircuitOpenError(
+            'Not reconnecting to WMI for {0:.1f}s after {1} failures'.format(
+                remaining, self.failures
+            )
+        )
+
+    def success(self):
+        """
+        Record a success. Returns True if the breaker was open.
+        """
+        with self._lock:
+            was_open = self._opened is not None
+            self.failures = 0
+            self._opened = None
+            self._trial = False
+            return was_open
+
+    def failure(self):
+        """
+        Record a failure. Returns True if this opened the breaker.
+        """
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._opened is not None:
+                # A failed half-open attempt starts a new cool-down
+                self._opened = self.clock()
+                return False
+            if self.failures >= self.failure_threshold:
+                self._opened = self.clock()
+                return True
+            return False
+
+
+class ReconnectSupervisor(object):
+    """
+    Runs connection attempts with retries, a deadline & a circuit breaker.
+
+    :param backoff: The Backoff giving the delay between attempts.
+    :param deadline: The number of seconds after which run() stops retrying.
+    :param breaker: The CircuitBreaker used by every run() of this
+        supervisor, which can be shared with other supervisors.
+    """
+
+    def __init__(
+        self, backoff=None, deadline=30.0, breaker=None, clock=_clock,
+        sleep=time.sleep
+    ):
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.deadline = deadline
+        self.breaker = breaker if breaker is not None else CircuitBreaker(
+            clock=clock
+        )
+        self.clock = clock
+        self.sleep = sleep
+
+        # The number of run() calls which are currently retrying
+        self._retrying = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def degraded(self):
+        """
+        True while an attempt is being retried or the breaker is not closed.
+        """
+        return bool(self._retrying) \
+            or self.breaker.state != CircuitBreaker.CLOSED
+
+    def add_listener(self, listener):
+        """
+        Call listener with every SupervisorEvent. Listeners are called from
+        whichever thread the event happened in & must not block.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def emit(self, kind, attempt=None, delay=None, error=None):
+        event = SupervisorEvent(kind, attempt, delay, error)
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:  # pylint: disable=W0703
+                _logger.exception('Supervisor listener %r failed', listener)
+
+    def run(self, func, retries=None, exceptions=(Exception, )):
+        """
+        Call func until it returns without raising one of exceptions & return
+        its result. After each failure it is retried (up to retries times if
+        given) following a backoff delay, unless that would pass the
+        deadline, in which case the last exception is raised. Raises
+        CircuitOpenError without calling func if the breaker is open.
+        """
+        self.breaker.check()
+
+        deadline = self.clock() + self.deadline
+        attempt, retrying = 0, False
+        try:
+            while True:
+                try:
+                    result = func()
+                except exceptions as exc:
+                    delay = self.backoff.delay(attempt)
+                    attempt += 1
+
+                    if (retries is not None and attempt > retries) \
+                            or self.clock() + delay > deadline:
+                        self.emit(GAVE_UP, attempt, None, exc)
+                        if self.breaker.failure():
+                            self.emit(CIRCUIT_OPEN, attempt, None, exc)
+                        raise
+
+                    if not retrying:
+                        retrying = True
+                        with self._lock:
+                            self._retrying += 1
+                    self.emit(RETRYING, attempt, delay, exc)
+                    self.sleep(delay)
+                    continue
+
+                if self.breaker.success():
+                    self.emit(CIRCUIT_CLOSED, attempt)
+                if attempt:
+                    self.emit(RECOVERED, attempt)
+                return result
+        finally:
+            if retrying:
+                with self._lock:
+                    self._retrying -= 1
@@ -0,0 +1,248 @@
+"""
+win_pyxs.trace contains a packet tracer used by the connection classes in
+place of logging every packet. Each packet sent or received is stored as a
+fixed-size binary record in a preallocated ring buffer, so tracing can be
+left on under load & the most recent packets are always available when
+something goes wrong. The buffer can be written to a file with
+PacketTracer.dump() & read back with load(), or decoded from the command
+line:
+
+    python -m win_pyxs.trace trace.bin
+"""
+
+from __future__ import print_function
+
+__all__ = [
+    'PacketTracer',
+    'TraceRecord',
+    'load',
+    'SEND',
+    'RECV',
+    'OK',
+    'ERROR',
+    'FAILED',
+    'DROPPED',
+]
+
+from collections import namedtuple
+import argparse
+import struct
+import threading
+import time
+
+from pyxs._internal import Op
+
+from .metrics import op_name
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#: Record kinds
+SEND, RECV = 1, 2
+
+#: Record outcomes: the packet was sent/received normally, the reply was an
+#: Op.ERROR, sending raised an exception or the reply was not expected
+OK, ERROR, FAILED, DROPPED = 0, 1, 2, 3
+
+_KIND_NAMES = {SEND: 'send', RECV: 'recv'}
+_OUTCOME_NAMES = {
+    OK: 'ok', ERROR: 'error', FAILED: 'failed', DROPPED: 'dropped'
+}
+
+# kind, op, outcome, rq_id, tx_id, payload size, seconds since the tracer
+# was created
+_RECORD = struct.Struct('<BBBxIIId')
+
+# magic, version, record size, record count, wall clock time at which the
+# tracer was created
+_HEADER = struct.Struct('<4sHHId')
+_MAGIC = b'WPXT'
+_VERSION = 1
+
+#: A decoded trace record. time is seconds since the epoch.
+TraceRecord = namedtuple(
+    'TraceRecord', 'kind op outcome rq_id tx_id size time'
+)
+
+
+class PacketTracer(object):
+    """
+    A bounded ring buffer of packet records. Once capacity records have
+    been stored the oldest are overwritten.
+
+    :param capacity: The number of records to keep.
+    :param sample: Record the packets of 1 in every sample requests (chosen
+        by rq_id so both the request & its reply are kept). Watch events
+        are always recorded. 0 disables tracing.
+    :param dump_path: If given the buffer is written to this file whenever
+        a send fails (see failed()).
+    """
+
+    def __init__(self, capacity=1024, sample=1, dump_path=None):
+        self.capacity = capacity
+        self.sample = sample
+        self.dump_path = dump_path
+
+        self._buffer = bytearray(capacity * _RECORD.size)
+        self._next = 0
+        self._lock = threading.Lock()
+
+        self._started = _clock()
+        self._wall_started = time.time()
+
+    def __len__(self):
+        return min(self._next, self.capacity)
+
+    @property
+    def enabled(self):
+        return self.sample > 0 and self.capacity > 0
+
+    def record(self, kind, packet, outcome=OK):
+        """
+        Record a packet if it is sampled.
+        """
+        sample = self.sample
+        if sample <= 0 or (sample > 1 and packet.rq_id % sample
+                           and packet.op != Op.WATCH_EVENT):
+            return
+
+        elapsed = _clock() - self._started
+        with self._lock:
+            offset = (self._next % self.capacity) * _RECORD.size
+            self._next += 1
+            _RECORD.pack_into(
+                self._buffer, offset, kind, packet.op, outcome,
+                packet.rq_id, packet.tx_id, packet.size, elapsed
+            )
+
+    def sent(self, packet):
+        self.record(SEND, packet)
+
+    def received(self, packet):
+        self.record(RECV, packet, ERROR if packet.op == Op.ERROR else OK)
+
+    def dropped(self, packet):
+        self.record(RECV, packet, DROPPED)
+
+    def failed(self, packet):
+        """
+        Record a request which could not be sent & dump the buffer to
+        dump_path if one was given.
+        """
+        self.record(SEND, packet, FAILED)
+        self.dump_on_error()
+
+    def dump_on_error(self):
+        """
+        Called by the connections when an exception is raised. Dumps the
+        buffer to dump_path if one was given.
+        """
+        if self.dump_path is not None:
+            self.dump(self.dump_path)
+
+    def _raw_records(self):
+        with self._lock:
+            if self._next <= self.capacity:
+                count = self._next
+                data = self._buffer[:count * _RECORD.size]
+            else:
+                # The oldest record is the next one to be overwritten
+                count = self.capacity
+                split = (self._next % self.capacity) * _RECORD.size
+                data = self._buffer[split:] + self._buffer[:split]
+        return count, bytes(data)
+
+    def records(self):
+        """
+        Return the stored records as TraceRecords, oldest first.
+        """
+        count, data = self._raw_records()
+        return _decode(count, data, self._wall_started)
+
+    def dump(self, path_or_file):
+        """
+        Write the stored records to a file (a path or a binary file object)
+        in the format read by load().
+        """
+        count, data = self._raw_records()
+        header = _HEADER.pack(
+            _MAGIC, _VERSION, _RECORD.size, count, self._wall_started
+        )
+
+        if hasattr(path_or_file, 'write'):
+            path_or_file.write(header + data)
+            return
+
+        with open(path_or_file, 'wb') as dump_file:
+            dump_file.write(header + data)
+
+    def clear(self):
+        with self._lock:
+            self._next = 0
+
+
+def _decode(count, data, wall_started):
+    records = []
+    for index in range(count):
+        kind, op, outcome, rq_id, tx_id, size, elapsed = \
+            _RECORD.unpack_from(data, index * _RECORD.size)
+        records.append(TraceRecord(
+            kind, op, outcome, rq_id, tx_id, size, wall_started + elapsed
+        ))
+    return records
+
+
+def load(path_or_file):
+    """
+    Read a file written by PacketTracer.dump() & return its TraceRecords.
+    """
+    if hasattr(path_or_file, 'read'):
+        data = path_or_file.read()
+    else:
+        with open(path_or_file, 'rb') as dump_file:
+            data = dump_file.read()
+
+    magic, version, record_size, count, wall_started = \
+        _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION \
+            or record_size != _RECORD.size:
+        raise ValueError('Not a win_pyxs packet trace')
+
+    return _decode(count, data[_HEADER.size:], wall_started)
+
+
+def format_record(record, previous=None):
+    """
+    Return a line of text describing a TraceRecord. If the record is the
+    reply to previous (the matching send) the round trip time is included.
+    """
+    stamp = time.strftime('%H:%M:%S', time.localtime(record.time))
+    line = '{0}.{1:06d} {2:<4} {3:<16} rq_id={4:<8} tx_id={5:<4} ' \
+        'size={6:<5} {7}'.format(
+            stamp, int(record.time % 1 * 1e6), _KIND_NAMES.get(record.kind),
+            op_name(record.op), record.rq_id, record.tx_id, record.size,
+            _OUTCOME_NAMES.get(record.outcome)
+        )
+    if previous is not None:
+        line += ' ({0:.1f}us)'.format((record.time - previous.time) * 1e6)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Decode a win_pyxs packet trace'
+    )
+    parser.add_argument('path', help='The file written by PacketTracer.dump')
+    args = parser.parse_args()
+
+    sends = {}
+    for record in load(args.path):
+        previous = None
+        if record.kind == SEND:
+            sends[record.rq_id] = record
+        elif record.op != Op.WATCH_EVENT:
+            previous = sends.pop(record.rq_id, None)
+        print(format_record(record, previous))
+
+
+if __name__ == '__main__':
+    main()
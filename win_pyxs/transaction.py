@@ -0,0 +1,167 @@
+"""
+win_pyxs.transaction emulates xenstore transactions for
+XenBusConnectionWinPV, as the WMI interface of the WinPV drivers has no
+equivalent of Op.TRANSACTION_START & Op.TRANSACTION_END.
+
+Transactions are optimistic: writes & removes are buffered in the
+Transaction (so they cost nothing until the commit) & reads made inside it
+see the buffered changes. The value (or child list) of every node the
+transaction looked at in xenstore is remembered. When the transaction is
+committed those nodes are read again & if any of them changed the commit
+fails with EAGAIN, as it does with xenstored, otherwise the buffered changes
+are written out in order.
+
+Blind writes (of nodes the transaction never read) are not checked: the
+result is the same as if the transactions involved had run one after the
+other. Commits are serialised within a process but, unlike with xenstored,
+the changes are not applied atomically: another process (or a request made
+outside a transaction) can see some of them before the rest are written.
+"""
+
+__all__ = ['Transaction']
+
+import threading
+
+from .watch import _in_subtree, _join, _separator
+
+
+def _child_name(path, descendant):
+    """
+    Return the name of the child of path which descendant is in.
+    """
+    separator = _separator(path)
+    return descendant[len(path.rstrip(separator)) + 1:].split(separator)[0]
+
+
+class Transaction(object):
+    """
+    The buffered changes & read set of one emulated transaction.
+
+    The methods taking a reader use it (see win_pyxs.watch.snapshot()) to
+    look at xenstore when the buffered changes do not decide the answer.
+    """
+
+    def __init__(self, tx_id):
+        self.tx_id = tx_id
+        self.lock = threading.Lock()
+
+        # The (path, value) changes in the order they were made. A value of
+        # None removes the path & its subtree.
+        self.mutations = []
+
+        # The values & child lists seen in xenstore, checked by conflicts()
+        self._reads = {}
+        self._listings = {}
+
+    def _read_through(self, reader, path):
+        value = reader.read(path)
+        self._reads.setdefault(path, value)
+        return value
+
+    def _buffered(self, path):
+        """
+        Return (True, value) if the buffered changes decide the value of
+        path (None if it has been removed) or (False, created) if xenstore
+        must be read, where created is whether a buffered write below path
+        implicitly creates it.
+        """
+        created = False
+        for changed, value in reversed(self.mutations):
+            if value is not None:
+                if changed == path:
+                    return True, value
+                if not created and changed != path \
+                        and _in_subtree(changed, path):
+                    created = True
+            elif _in_subtree(path, changed):
+                # Removed, but recreated (empty) by a later write below it
+                return True, b'' if created else None
+        return False, created
+
+    def read(self, reader, path):
+        """
+        Return the value of path as seen by this transaction or None if it
+        does not exist.
+        """
+        decided, value = self._buffered(path)
+        if decided:
+            return value
+
+        stored = self._read_through(reader, path)
+        if stored is None and value:
+            return b''
+        return stored
+
+    def directory(self, reader, path):
+        """
+        Return the names of the children of path as seen by this transaction
+        or None if path does not exist.
+        """
+        if self.read(reader, path) is None:
+            return None
+
+        children = []
+        removed = any(
+            value is None and _in_subtree(path, changed)
+            for changed, value in self.mutations
+        )
+        if not removed:
+            names = reader.children(path)
+            children = [_join(path, name) for name in names]
+            self._listings.setdefault(path, tuple(sorted(children)))
+            children = [_child_name(path, child) for child in children]
+
+        for changed, value in self.mutations:
+            if changed == path or not _in_subtree(changed, path):
+                if value is None and _in_subtree(path, changed):
+                    children = []
+                continue
+
+            name = _child_name(path, changed)
+            if value is not None:
+                if name not in children:
+                    children.append(name)
+            elif _join(path, name) == changed and name in children:
+                children.remove(name)
+
+        return children
+
+    def write(self, path, value):
+        # An earlier write of the same path is superseded by this one
+        self.mutations = [
+            mutation for mutation in self.mutations
+            if mutation[0] != path or mutation[1] is None
+        ]
+        self.mutations.append((path, value))
+
+    def remove(self, reader, path):
+        """
+        Remove path & its subtree. Returns False if path does not exist.
+        """
+        if self.read(reader, path) is None:
+            return False
+
+        # Changes inside the removed subtree no longer matter
+        self.mutations = [
+            mutation for mutation in self.mutations
+            if not _in_subtree(mutation[0], path)
+        ]
+        self.mutations.append((path, None))
+        return True
+
+    def conflicts(self, reader):
+        """
+        Return the paths read by this transaction which have changed in
+        xenstore since.
+        """
+        changed = [
+            path for path, value in self._reads.items()
+            if reader.read(path) != value
+        ]
+        changed.extend(
+            path for path, children in self._listings.items()
+            if tuple(sorted(
+                _join(path, name) for name in reader.children(path)
+            )) != children
+        )
+        return sorted(set(changed))
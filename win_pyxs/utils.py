@@ -3,6 +3,16 @@ This module contains utility functions used by win_pyxs which should not be
 needed by any client code & are only intended for internal use.
 """
 
+import importlib
+import json
+import os
+import tempfile
+import threading
+
+#: The environment variable which overrides the directory cache files are
+#: kept in (by default the temporary directory of the current user)
+CACHE_DIR_ENV = 'WIN_PYXS_CACHE_DIR'
+
 
 class LazyVar(object):
     """
@@ -21,3 +31,111 @@ class LazyVar(object):
         except AttributeError:
             self.value = self.func()
             return self.value
+
+
+class ThreadLocalLazyVar(LazyVar):
+    """
+    A LazyVar whose value is calculated & stored separately by each thread
+    which calls it. This suits values which can only be used by the thread
+    which created them, such as COM objects.
+    """
+
+    def __init__(self, func):
+        super(ThreadLocalLazyVar, self).__init__(func)
+        self._local = threading.local()
+        self._generation = 0
+
+    def __call__(self):
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.value = self.func()
+            local.generation = self._generation
+        return local.value
+
+    def clear(self):
+        """
+        Forget the value of the calling thread.
+        """
+        self._local.__dict__.pop('generation', None)
+        self._local.__dict__.pop('value', None)
+
+    def reset(self):
+        """
+        Make every thread calculate its value again on its next call.
+        """
+        self._generation += 1
+
+
+class LazyModule(object):
+    """
+    A stand-in for a module which is only imported when one of its
+    attributes is first used. This keeps expensive (or platform specific)
+    imports out of the import of win_pyxs itself. Attributes are looked up on
+    the real module every time so patching the module still works.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __repr__(self):
+        return 'LazyModule({0!r})'.format(self._name)
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+def cache_path(name):
+    """
+    Return the path of the named win_pyxs cache file.
+    """
+    directory = os.environ.get(CACHE_DIR_ENV) or tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def read_cache(name):
+    """
+    Return the JSON value stored in the named cache file or None if it is
+    missing or unreadable.
+    """
+    try:
+        with open(cache_path(name)) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(name, value):
+    """
+    Store a JSON value in the named cache file. The file is replaced
+    atomically so that other processes never read a partial file. Returns
+    False if the cache could not be written, which callers can ignore.
+    """
+    path = cache_path(name)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'w') as cache_file:
+            json.dump(value, cache_file)
+        getattr(os, 'replace', os.rename)(temp_path, path)
+    except (IOError, OSError, TypeError, ValueError):
+        remove_file(temp_path)
+        return False
+    return True
+
+
+def remove_cache(name):
+    remove_file(cache_path(name))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
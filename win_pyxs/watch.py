@@ -0,0 +1,379 @@
+"""
+win_pyxs.watch emulates xenstore watches for XenBusConnectionWinPV. The WMI
+interface of the WinPV drivers has no equivalent of Op.WATCH so instead the
+watched subtrees are polled from a background thread & compared with the
+snapshot taken by the previous poll.
+
+A snapshot only keeps a hash of each node's value & a fingerprint of its
+list of children, so a large subtree can be watched without keeping a copy
+of it. The fingerprints also mean a subtree only has to be searched for
+removed nodes when a child list has actually changed. Watches inside an
+already watched subtree share its poll & each subtree is polled more often
+while it is changing & less often (up to a limit) while it is not.
+"""
+
+__all__ = ['WatchPoller', 'diff', 'snapshot']
+
+import logging
+import threading
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_logger = logging.getLogger(__name__)
+
+
+def _separator(path):
+    return b'/' if isinstance(path, bytes) else '/'
+
+
+def _join(path, child):
+    # Accept either the name of a child or its full path
+    separator = _separator(path)
+    name = child.rsplit(separator, 1)[-1]
+    return path.rstrip(separator) + separator + name
+
+
+def _parent(path):
+    head, sep, _tail = path.rstrip(_separator(path)).rpartition(
+        _separator(path)
+    )
+    return (head or sep) if sep else None
+
+
+def _in_subtree(path, root):
+    if path == root:
+        return True
+    separator = _separator(root)
+    return path.startswith(root.rstrip(separator) + separator)
+
+
+def snapshot(reader, root):
+    """
+    Return a snapshot of the subtree at root: a dict mapping the path of
+    every node to a (value hash, child list fingerprint) pair. The snapshot
+    of a missing node is empty.
+
+    :param reader: An object with a read(path) method returning the value of
+        a node (None if it does not exist) & a children(path) method
+        returning the names of its children.
+    """
+    nodes = {}
+    paths = [root]
+    while paths:
+        path = paths.pop()
+        value = reader.read(path)
+        if value is None:
+            # Missing (or removed since its parent was listed)
+            continue
+
+        children = sorted(
+            _join(path, child) for child in reader.children(path)
+        )
+        nodes[path] = (hash(value), hash(tuple(children)))
+        paths.extend(children)
+
+    return nodes
+
+
+def diff(old, new):
+    """
+    Compare two snapshots of a subtree. Returns a sorted list of the paths
+    which changed & a sorted list of the top of every subtree which was
+    removed. Like xenstored, which reports the node written rather than the
+    parents created for it, only the deepest of the added nodes are
+    included in the changed paths.
+    """
+    changed, added, children_changed = [], [], False
+    for path, (value_hash, fingerprint) in new.items():
+        previous = old.get(path)
+        if previous is None:
+            added.append(path)
+            continue
+
+        if previous[0] != value_hash:
+            changed.append(path)
+        if previous[1] != fingerprint:
+            children_changed = True
+
+    if added:
+        parents = set(_parent(path) for path in added)
+        changed.extend(path for path in added if path not in parents)
+
+    removed = []
+    # A node can only have been removed if its parent's child list changed
+    # or the whole subtree has gone
+    if children_changed or (old and not new):
+        removed = [
+            path for path in old if path not in new
+            and (_parent(path) in new or _parent(path) not in old)
+        ]
+
+    return sorted(changed), sorted(removed)
+
+
+class _Root(object):
+    """
+    A polled subtree.
+    """
+
+    __slots__ = ['snapshot', 'interval', 'due']
+
+    def __init__(self, snapshot, interval, due):
+        self.snapshot = snapshot
+        self.interval = interval
+        self.due = due
+
+
+class WatchPoller(object):
+    """
+    Polls the watched subtrees & reports their changes as watch events. The
+    polling thread is started by the first watch & stopped by stop().
+
+    :param open_reader: A function returning the reader (see snapshot()) the
+        polling thread uses. It is called from the polling thread, which
+        calls the reader's close() method once it stops.
+    :param fire: A function called with the path & token of every watch
+        event (from the thread which adds the watch or the polling thread).
+    :param min_interval: The delay in seconds before a subtree which has
+        just changed is polled again.
+    :param max_interval: Each poll which finds no change doubles the delay
+        before the next one up to this many seconds.
+    :param metrics: An optional win_pyxs.metrics.ConnectionMetrics in which
+        the number of polls is counted (watch_polls).
+    """
+
+    def __init__(
+        self, open_reader, fire, min_interval=0.1, max_interval=2.0,
+        metrics=None, name='win_pyxs-watch-poller'
+    ):
+        self.open_reader = open_reader
+        self.fire = fire
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.metrics = metrics
+        self.name = name
+
+        # Watched path -> set of tokens
+        self._watches = {}
+        # Polled path -> _Root. No root is inside another one.
+        self._roots = {}
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(tokens) for tokens in self._watches.values())
+
+    @property
+    def roots(self):
+        """
+        The paths which are polled.
+        """
+        with self._lock:
+            return sorted(self._roots)
+
+    def _covering_root(self, path):
+        for root in self._roots:
+            if _in_subtree(path, root):
+                return root
+        return None
+
+    def watch(self, reader, path, token):
+        """
+        Add a watch & fire its initial event (as xenstored does). Unless
+        path is inside a subtree which is already polled it is snapshotted
+        immediately using reader (from the calling thread) so that no change
+        made after the watch was added is missed.
+        """
+        taken = None
+        with self._lock:
+            covered = self._covering_root(path) is not None
+        if not covered:
+            taken = snapshot(reader, path)
+
+        with self._lock:
+            self._watches.setdefault(path, set()).add(token)
+            events = []
+            if taken is not None and self._covering_root(path) is None:
+                events = self._add_root(path, taken)
+            self._start()
+            self._wakeup.notify()
+
+        self.fire(path, token)
+        for event in events:
+            self.fire(*event)
+
+    def _add_root(self, path, taken):
+        """
+        Start polling path, which replaces any roots inside it. Returns the
+        events for changes in the replaced roots since they were last
+        polled.
+        """
+        events = []
+        for root in [root for root in self._roots if _in_subtree(root, path)]:
+            inner = dict(
+                (node, value) for node, value in taken.items()
+                if _in_subtree(node, root)
+            )
+            events.extend(self._events(
+                *diff(self._roots.pop(root).snapshot, inner)
+            ))
+
+        self._roots[path] = _Root(
+            taken, self.min_interval, _clock() + self.min_interval
+        )
+        return events
+
+    def unwatch(self, path, token):
+        """
+        Remove a watch. Returns False if there was no such watch.
+        """
+        with self._lock:
+            tokens = self._watches.get(path)
+            if not tokens or token not in tokens:
+                return False
+
+            tokens.discard(token)
+            if tokens:
+                return True
+
+            del self._watches[path]
+            root = self._roots.pop(path, None)
+            if root is not None:
+                # Keep polling the watches which were inside this subtree
+                for watched in sorted(self._watches, key=len):
+                    if _in_subtree(watched, path) \
+                            and self._covering_root(watched) is None:
+                        self._roots[watched] = _Root(dict(
+                            (node, value)
+                            for node, value in root.snapshot.items()
+                            if _in_subtree(node, watched)
+                        ), root.interval, root.due)
+            return True
+
+    def _events(self, changed, removed):
+        """
+        Return the (path, token) events for the changes found by diff().
+        """
+        events = []
+        for watched, tokens in self._watches.items():
+            for path in changed + removed:
+                if _in_subtree(path, watched):
+                    events.extend((path, token) for token in tokens)
+            for path in removed:
+                # Watches inside a removed subtree see their own node go
+                if path != watched and _in_subtree(watched, path):
+                    events.extend((watched, token) for token in tokens)
+        return events
+
+    def _start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the polling thread & forget every watch.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._watches.clear()
+            self._roots.clear()
+            self._wakeup.notify()
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _due(self):
+        """
+        Wait until a root is due to be polled & return the due roots, or
+        None once stop() has been called.
+        """
+        with self._lock:
+            while not self._stopping:
+                now = _clock()
+                due = [
+                    (path, root) for path, root in self._roots.items()
+                    if root.due <= now
+                ]
+                if due:
+                    return due
+
+                wait = min(
+                    [root.due - now for root in self._roots.values()]
+                    or [self.max_interval]
+                )
+                self._wakeup.wait(wait)
+
+        return None
+
+    def _poll(self, reader, path, root):
+        try:
+            taken = snapshot(reader, path)
+        except Exception:  # pylint: disable=W0703
+            _logger.exception('Failed polling watched path %r', path)
+            taken = None
+
+        if self.metrics is not None:
+            self.metrics.increment('watch_polls')
+
+        with self._lock:
+            if self._roots.get(path) is not root:
+                # Unwatched or replaced while it was being polled
+                return []
+
+            events = []
+            if taken is None:
+                root.interval = self.min_interval
+            else:
+                changed, removed = diff(root.snapshot, taken)
+                root.snapshot = taken
+                if changed or removed:
+                    events = self._events(changed, removed)
+                    root.interval = self.min_interval
+                else:
+                    root.interval = min(root.interval * 2, self.max_interval)
+            root.due = _clock() + root.interval
+
+        return events
+
+    def _open_reader(self):
+        """
+        Call open_reader, retrying every max_interval seconds until it
+        succeeds or stop() is called (returning None).
+        """
+        while True:
+            try:
+                return self.open_reader()
+            except Exception:  # pylint: disable=W0703
+                _logger.exception('Failed opening the watch poller reader')
+
+            with self._lock:
+                if not self._stopping:
+                    self._wakeup.wait(self.max_interval)
+                if self._stopping:
+                    return None
+
+    def _run(self):
+        reader = self._open_reader()
+        if reader is None:
+            return
+
+        try:
+            while True:
+                due = self._due()
+                if due is None:
+                    break
+
+                for path, root in due:
+                    for event in self._poll(reader, path, root):
+                        self.fire(*event)
+        finally:
+            reader.close()
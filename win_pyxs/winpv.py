@@ -7,11 +7,17 @@ is only able to implement those which are available.
 
 from __future__ import print_function
 
-__all__ = ['XenBusConnectionWinPV']
+__all__ = ['XenBusConnectionWinPV', 'end_orphaned_sessions']
 
+from collections import deque
+import errno
+import itertools
 import logging
+import select
 import socket
 import sys
+import threading
+import time
 from time import sleep
 
 try:
@@ -21,32 +27,536 @@ except ImportError:
 
 sys.coinit_flags = 0
 
-import pythoncom
 import six
-import wmi
 
 import pyxs
 import pyxs.connection
 from pyxs._internal import Op, Packet, NUL
+from pyxs.exceptions import InvalidPayload
 
-from .exceptions import UnknownSessionError
+from .exceptions import CircuitOpenError, UnknownSessionError
+from .metrics import ConnectionMetrics
+from .supervisor import (
+    CIRCUIT_OPEN, GAVE_UP, RECOVERED, REPLAYED, RETRYING, SESSION_LOST,
+    Backoff, ReconnectSupervisor
+)
+from .trace import PacketTracer
+from .transaction import Transaction
+from .utils import LazyModule, ThreadLocalLazyVar
+from .watch import WatchPoller
+
+# COM & WMI are only imported once a connection is used
+pythoncom = LazyModule('pythoncom')
+wmi = LazyModule('wmi')
+
+XENSTORE_PAYLOAD_MAX = 4096
 
+# Connecting to WMI is retried with exponential backoff from the initial
+# delay up to the (maximum) retry delay until the deadline has passed
+WMI_CONNECT_INITIAL_DELAY = 0.1
 WMI_CONNECT_RETRY_DELAY = 2
+WMI_CONNECT_DEADLINE = 30
 WMI_QUERY_RETRY_DELAY = 0.5
 WMI_QUERY_TEMPLATE = (
     "select * from XenProjectXenStoreSession where SessionId = {id}"
 )
+WMI_NAME_QUERY_TEMPLATE = (
+    'select * from XenProjectXenStoreSession where Id = "{name}"'
+)
+
+# The operations which have an equivalent method on XenProjectXenStoreSession
+_WMI_OPS = (Op.READ, Op.WRITE, Op.RM, Op.DIRECTORY)
+
+# The operations whose results can be stored in a ReadCache
+_CACHED_OPS = (Op.READ, Op.DIRECTORY)
+
+# The operations which are repeated on a new session if the session they
+# were sent on has gone
+_REPLAYABLE_OPS = (Op.READ, Op.DIRECTORY)
+
+# The operations which are emulated (see win_pyxs.watch &
+# win_pyxs.transaction)
+_WATCH_OPS = (Op.WATCH, Op.UNWATCH)
+_TRANSACTION_OPS = (Op.TRANSACTION_START, Op.TRANSACTION_END)
+_EMULATED_OPS = _WATCH_OPS + _TRANSACTION_OPS
+
+# Commits of emulated transactions are serialised within a process so that
+# two transactions cannot both pass their conflict check before either has
+# written its changes
+_COMMIT_LOCK = threading.Lock()
+
+# The range of delays (in seconds) between polls of a watched subtree
+WATCH_POLL_MIN_INTERVAL = 0.1
+WATCH_POLL_MAX_INTERVAL = 2.0
+
+# A path which does not exist & a session which has been removed can both be
+# reported as WBEM_E_NOT_FOUND, so after a request fails with ENOENT the
+# session is looked for at most once per this many seconds (requests failing
+# any other way always look for it)
+SESSION_PROBE_INTERVAL = 1.0
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# The number of users (connections, session workers, copies...) in this
+# process of each XenProjectXenStoreSession by SessionId. A session is only
+# ended by the last of its users to close.
+_SESSION_USERS = {}
+_SESSION_USERS_LOCK = threading.Lock()
+
+
+def _connect_wmi():
+    wmi_session = wmi.WMI(moniker="//./root/wmi", find_classes=False)
+    return wmi_session, wmi_session.XenProjectXenStoreBase()[0]
+
+
+# The WMI namespace & XenProjectXenStoreBase of each thread. Connecting to WMI
+# is slow & COM objects can only be used by the thread (apartment) which
+# created them so they are kept for every session opened by the same thread.
+# A thread must clear() them before calling CoUninitialize.
+_wmi_namespace = ThreadLocalLazyVar(_connect_wmi)
+
+
+def _claim_session(session_id):
+    with _SESSION_USERS_LOCK:
+        _SESSION_USERS[session_id] = _SESSION_USERS.get(session_id, 0) + 1
+
+
+def _release_session(session_id):
+    """
+    Return True if the last user of the session has released it.
+    """
+    with _SESSION_USERS_LOCK:
+        users = _SESSION_USERS.get(session_id, 1) - 1
+        if users > 0:
+            _SESSION_USERS[session_id] = users
+            return False
+        _SESSION_USERS.pop(session_id, None)
+        return True
+
+
+def _name_query(name):
+    escaped = name.replace('\\', '\\\\').replace('"', '\\"')
+    return WMI_NAME_QUERY_TEMPLATE.format(name=escaped)
+
+
+def end_orphaned_sessions(name="PyxsSession"):
+    """
+    End the XenProjectXenStoreSessions named name which are not used by this
+    process, such as those left behind by processes which exited without
+    closing their connection. Returns the SessionIds of the ended sessions.
+
+    Only call this when no other running process uses sessions with the same
+    name: any it has would be ended too (its connections then have to add new
+    sessions).
+    """
+    try:
+        sessions = _wmi_namespace()[0].query(_name_query(name))
+    except Exception as exc:  # WMI can raise all sorts of exceptions
+        _wmi_namespace.clear()
+        six.raise_from(
+            pyxs.PyXSError("Unable to query for WMI sessions"), exc
+        )
+
+    ended = []
+    for session in sessions:
+        with _SESSION_USERS_LOCK:
+            if session.SessionId in _SESSION_USERS:
+                continue
+            try:
+                session.EndSession()
+            except wmi.x_wmi:
+                # Ended by someone else in the meantime
+                continue
+        ended.append(session.SessionId)
+    return ended
+
+
+def _split_payload(payload):
+    """
+    Split a request payload into the path & the remainder (e.g. the value of
+    a WRITE). Payloads may be either bytes (as built by pyxs) or str.
+    """
+    separator = NUL if isinstance(payload, bytes) else '\x00'
+    return payload.split(separator, 1)
+
+
+def _packet_path(packet):
+    """
+    Return the xenstore path which a request packet operates on. This is the
+    first NUL-separated field of the payload for all of the supported ops.
+    """
+    payload = packet.payload
+    end = payload.find(NUL if isinstance(payload, bytes) else '\x00')
+    return payload if end < 0 else payload[:end]
+
+
+def _to_wmi(value):
+    """
+    Convert a path or value from a packet payload to the text WMI expects.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _from_wmi(value):
+    """
+    Convert text returned by WMI to bytes for a reply payload.
+    """
+    if isinstance(value, bytes):
+        return value
+    return (value or u'').encode('utf-8')
+
+
+def _join_children(children):
+    """
+    Build the payload of a DIRECTORY reply from the child names returned by
+    WMI, joining the text & encoding it once rather than child by child.
+    """
+    if not children:
+        return b''
+    if isinstance(children[0], bytes):
+        return NUL.join(children)
+    return u'\x00'.join(children).encode('utf-8')
+
+
+def _reply(packet, payload, op=None):
+    """
+    Build the reply to a request packet. Unlike Packet() the op is not
+    looked up in Op, as it is that of the request (or Op.ERROR), so only
+    the payload limit is checked.
+    """
+    size = len(payload)
+    if size > XENSTORE_PAYLOAD_MAX:
+        raise InvalidPayload(payload)
+    return tuple.__new__(Packet, (
+        packet.op if op is None else op, packet.rq_id, packet.tx_id, size,
+        payload
+    ))
+
+
+class _SessionReader(object):
+    """
+    Reads xenstore nodes through a XenProjectXenStoreSession for
+    win_pyxs.watch.snapshot().
+    """
+
+    def __init__(self, session, close=None):
+        self.session = session
+        self._close = close
+
+    def read(self, path):
+        try:
+            return _from_wmi(self.session.GetValue(_to_wmi(path))[0])
+        except wmi.x_wmi:
+            return None
+
+    def children(self, path):
+        try:
+            children = self.session.GetChildren(_to_wmi(path))[0].childNodes
+        except wmi.x_wmi:
+            return []
+        return [_from_wmi(child) for child in children or []]
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+# The HRESULTs of a WMI call on a path which does not exist:
+# WBEM_E_NOT_FOUND & HRESULT_FROM_WIN32(ERROR_FILE_NOT_FOUND or
+# ERROR_PATH_NOT_FOUND)
+_NOT_FOUND_HRESULTS = frozenset([0x80041002, 0x80070002, 0x80070003])
+
+
+def _wmi_errno(exc):
+    """
+    Return the errno matching a failed WMI call (a wmi.x_wmi): ENOENT if WMI
+    reported that the path does not exist, otherwise EIO.
+    """
+    com_error = getattr(exc, 'com_error', None)
+    if com_error is None:
+        return errno.EIO
+
+    codes = [getattr(com_error, 'hresult', None)]
+    excepinfo = getattr(com_error, 'excepinfo', None)
+    if excepinfo and len(excepinfo) > 5:
+        codes.append(excepinfo[5])
+    for code in codes:
+        if isinstance(code, six.integer_types) \
+                and code & 0xFFFFFFFF in _NOT_FOUND_HRESULTS:
+            return errno.ENOENT
+    return errno.EIO
+
+
+def _error_code(exc):
+    """
+    Return the errno of a pyxs.PyXSError raised for a request, or EIO if it
+    does not have one.
+    """
+    code = exc.args[0] if exc.args else None
+    if isinstance(code, six.integer_types) and code in errno.errorcode:
+        return code
+    return errno.EIO
+
+
+def _error_packet(packet, code=errno.EIO):
+    """
+    Build the Op.ERROR reply xenstore would send for a failed request. The
+    payload is the symbolic errno name terminated by a NUL byte.
+    """
+    payload = errno.errorcode[code].encode('ascii') + NUL
+    return _reply(packet, payload, Op.ERROR)
+
+
+class _ResponseQueue(object):
+    """
+    The responses waiting for recv(). Packets are kept in a deque, which
+    needs no lock to append to or pop from. The socket pair which tells the
+    Router that a response is ready holds a single byte while the queue is
+    not empty, so one wake-up covers any number of responses & a burst of
+    them cannot fill the socket buffer (which would block the sender).
+    """
+
+    __slots__ = ['_packets', '_lock', '_signalled', 'reader', 'writer']
+
+    def __init__(self):
+        self._packets = deque()
+        # Only held when the queue changes between empty & not empty
+        self._lock = threading.Lock()
+        self._signalled = False
+        self.reader, self.writer = socket.socketpair()
+
+    def __len__(self):
+        return len(self._packets)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def put(self, packet):
+        self._packets.append(packet)
+        if not self._signalled:
+            with self._lock:
+                if not self._signalled and self._packets:
+                    self._signalled = True
+                    self.writer.sendall(NUL)
+
+    def get(self):
+        """
+        Return the oldest response, waiting for one if the queue is empty.
+        """
+        packets = self._packets
+        while True:
+            try:
+                packet = packets.popleft()
+                break
+            except IndexError:
+                select.select([self.reader], [], [])
+
+        if not packets:
+            with self._lock:
+                if not packets and self._signalled:
+                    self.reader.recv(1)
+                    self._signalled = False
+                    # put() may have seen the old signal after its append
+                    if packets:
+                        self._signalled = True
+                        self.writer.sendall(NUL)
+        return packet
+
+    def close(self):
+        self.reader.shutdown(socket.SHUT_RDWR)
+        self.reader.close()
+        self.writer.close()
+
+
+class _SessionWorker(threading.Thread):
+    """
+    A thread which owns a single XenProjectXenStoreSession & executes the
+    packets queued for it. WMI objects cannot be shared between COM
+    apartments so each worker initialises COM & creates its session from
+    inside the thread.
+    """
+
+    def __init__(self, connection, index, wmi_connect_retry=20):
+        super(_SessionWorker, self).__init__(
+            name='{0}-{1}'.format(connection.session_name, index)
+        )
+        self.daemon = True
+
+        self.connection = connection
+        self.wmi_connect_retry = wmi_connect_retry
+
+        self.packets = Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.session = None
+        self.session_id = None
+
+    def run(self):
+        pythoncom.CoInitialize()
+        try:
+            try:
+                self.session_id, self.session = \
+                    self.connection._open_xenstore_session(
+                        wmi_connect_retry=self.wmi_connect_retry
+                    )
+            except Exception as exc:  # pylint: disable=W0703
+                self.error = exc
+                return
+            finally:
+                self.ready.set()
+
+            while True:
+                items = self.packets.get()
+                if items is None:
+                    break
+
+                for packet, epoch in items:
+                    try:
+                        response = self.connection._run_or_error(
+                            self, packet, epoch
+                        )
+                    except Exception:  # pylint: disable=W0703
+                        self.connection._logger.exception(
+                            'Worker %s failed executing %s', self.name, packet
+                        )
+                        response = _error_packet(packet)
+
+                    self.connection._deliver(response)
+
+            if _release_session(self.session_id):
+                try:
+                    self.session.EndSession()
+                except wmi.x_wmi:
+                    self.connection._logger.debug(
+                        'Session %s had already gone', self.session_id
+                    )
+        finally:
+            self.session = None
+            _wmi_namespace.clear()
+            pythoncom.CoUninitialize()
+
+    def stop(self, timeout=None):
+        """
+        Ask the worker to finish the packets already queued, end its session
+        and exit.
+        """
+        self.packets.put(None)
+        self.join(timeout)
+
+
+class _ThreadSession(object):
+    """
+    The XenProjectXenStoreSession used by one thread of a connection with
+    thread_sessions=True. COM stays initialised on the thread while it has a
+    _ThreadSession, even if close() (from another thread) ended the session,
+    until release_thread() is called.
+    """
+
+    __slots__ = ['session', 'session_id', 'thread']
+
+    def __init__(self, thread):
+        self.session = None
+        self.session_id = None
+        self.thread = thread
 
 
 class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
     """
     An implementation of a pyxs connection which uses the WMI interface
     provided by the WinPV drivers to communicate with the xenstore.
+
+    By default every WMI call is made synchronously from send() using a single
+    XenProjectXenStoreSession. Passing sessions=N (where N > 1) instead starts
+    N worker threads, each with its own COM apartment & session, so that
+    independent requests are sent to xenstore in parallel. Requests for the
+    same path are always handled by the same worker so they are executed in
+    the order they were sent. Whichever is used a failed request is answered
+    with an Op.ERROR reply, with ENOENT if WMI reported that the path does
+    not exist & EIO otherwise.
+
+    With thread_sessions=True every thread using the connection instead
+    initialises COM & opens a session of its own the first time it sends a
+    request, & the WMI calls are made from that thread. pyxs.Router holds a
+    lock while calling send() so threads which should not wait for each other
+    can use execute(), which returns the reply & shares no lock with other
+    threads. A thread can end its session with release_thread(), otherwise it
+    is ended when the connection is closed.
+
+    WMI has no equivalent of WATCH so watches are emulated by polling the
+    watched subtrees from a background thread with a session of its own (see
+    win_pyxs.watch). Events are delivered within WATCH_POLL_MAX_INTERVAL
+    seconds of a change, or WATCH_POLL_MIN_INTERVAL while the subtree is
+    changing often.
+
+    Transactions are emulated too (see win_pyxs.transaction): writes & removes
+    made inside a transaction are buffered until it is committed, when the
+    commit fails with EAGAIN if anything the transaction read has changed.
+
+    A win_pyxs.cache.ReadCache can be passed as cache to answer repeated READ
+    & DIRECTORY requests without a WMI call. WRITE & RM requests sent through
+    this connection invalidate the affected entries. A
+    win_pyxs.writebehind.WriteBehind can be passed as write_behind to buffer
+    & coalesce WRITE requests, dropping those which do not change the value.
+    As it flushes the writes from a thread of its own it needs sessions > 1
+    or thread_sessions=True.
+    With sessions > 1 a win_pyxs.scheduler.RequestScheduler can be passed as
+    scheduler to limit the requests queued for the workers & choose which
+    are sent first by priority class.
+
+    Connecting to WMI is retried by supervisor (a
+    win_pyxs.supervisor.ReconnectSupervisor, created if not given) with
+    backoff, a deadline & a circuit breaker. Add a listener to it to be told
+    when the connection is degraded. The breaker belongs to the supervisor,
+    so it is shared by the session workers & threads of this connection but
+    not by other connections unless they are given supervisors with the same
+    win_pyxs.supervisor.CircuitBreaker. If a session disappears (e.g. it is
+    removed through WMI) a new one is created & READ & DIRECTORY requests
+    which failed because of it are repeated.
+
+    WMI is connected to once per thread & the connection is shared by every
+    session opened from that thread. With reattach=True an existing session
+    named xs_session_name which is not in use by this process (e.g. one left
+    behind by a process which did not close its connection) is used instead
+    of adding a new one; end_orphaned_sessions() ends such sessions instead.
+    A copy of a connection shares its session until either of them closes.
+
+    close() only ends a session with its live handle from the thread which
+    opened it. COM objects cannot be used from another apartment & nothing
+    can ask the thread which called connect() to do it, so when a
+    pyxs.Router closes the connection (from its own thread) the session has
+    to be found again through a new WMI connection. Session workers
+    (sessions > 1) always end their own sessions so they avoid this cost.
+
+    Requests, latencies, WMI retries & the queue depth are recorded in
+    metrics (a win_pyxs.metrics.ConnectionMetrics, created if not given).
+    Every packet is recorded by tracer (a win_pyxs.trace.PacketTracer,
+    created if not given).
     """
 
-    def __init__(self, xs_session_name="PyxsSession"):
+    def __init__(
+        self, xs_session_name="PyxsSession", sessions=1, cache=None,
+        metrics=None, tracer=None, supervisor=None, reattach=False,
+        thread_sessions=False, write_behind=None, scheduler=None
+    ):
         super(XenBusConnectionWinPV, self).__init__()
 
+        if thread_sessions and sessions > 1:
+            raise ValueError(
+                'thread_sessions cannot be used with sessions > 1'
+            )
+        if scheduler is not None and sessions < 2:
+            # Otherwise requests are made one at a time from send()
+            raise ValueError('scheduler can only be used with sessions > 1')
+        if write_behind is not None and sessions < 2 and not thread_sessions:
+            # The buffered writes are flushed from the thread of the
+            # WriteBehind, which cannot use a session opened by another
+            raise ValueError(
+                'write_behind can only be used with sessions > 1 or '
+                'thread_sessions=True'
+            )
+
         self._logger = logging.getLogger(
             __name__ + '.' + self.__class__.__name__
         )
@@ -54,40 +564,185 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
         self.session = None
         self.session_id = None
         self.session_name = xs_session_name
+        self.reattach = reattach
+
+        # The thread which opened session, which can use it to end it
+        self._session_thread = None
+
+        # SessionId -> when each session was last looked for after a request
+        # failed with ENOENT
+        self._probed = {}
+
+        # With more than one session the WMI calls are made from a pool of
+        # worker threads (one session each) rather than from send() itself
+        self.sessions = sessions
+        self._workers = []
+
+        # With thread_sessions the _ThreadSession of each thread
+        self.thread_sessions = thread_sessions
+        self._local = threading.local()
+        self._thread_owners = []
+        self._thread_owners_lock = threading.Lock()
+
+        # An optional win_pyxs.cache.ReadCache for READ & DIRECTORY results
+        self.cache = cache
 
-        self.response_packets = Queue()
+        self.metrics = metrics if metrics is not None else ConnectionMetrics()
+        self.metrics.gauge('queue_depth', self._queue_depth)
+        self._connects = 0
 
-        # A socket pair which can be used to mimic the default pyxs behaviour
-        # of returning a fileno which can be slected on to check when data is
-        # available
-        self.r_terminator, self.w_terminator = socket.socketpair()
+        self.tracer = tracer if tracer is not None else PacketTracer()
+
+        # An optional win_pyxs.writebehind.WriteBehind for WRITE requests
+        self.write_behind = write_behind
+        if write_behind is not None:
+            self.metrics.gauge('writes_avoided', lambda: write_behind.avoided)
+
+        # An optional win_pyxs.scheduler.RequestScheduler in front of the
+        # session workers
+        self.scheduler = scheduler
+
+        if supervisor is None:
+            supervisor = ReconnectSupervisor(
+                Backoff(WMI_CONNECT_INITIAL_DELAY, WMI_CONNECT_RETRY_DELAY),
+                deadline=WMI_CONNECT_DEADLINE
+            )
+        self.supervisor = supervisor
+        self.supervisor.add_listener(self._supervisor_event)
+
+        # Created by the first WATCH
+        self._watch_poller = None
+        self._watch_lock = threading.Lock()
+        self.metrics.gauge('watches', self._watch_count)
+
+        # Emulated transactions by tx_id
+        self._transactions = {}
+        self._transaction_ids = itertools.count(1)
+        self._transaction_lock = threading.Lock()
+
+        # The responses for recv(), with a socket pair which can be used to
+        # mimic the default pyxs behaviour of returning a fileno which can be
+        # selected on to check when data is available
+        self.response_packets = _ResponseQueue()
 
     def _get_xenstore_session(self, wmi_connect_retry=20):
-        # Create a WMI Session
         try:
-            wmi_session = wmi.WMI(moniker="//./root/wmi", find_classes=False)
-            xenstore_base = wmi_session.XenProjectXenStoreBase()[0]
-        except Exception as exc:  # WMI can raise all sorts of exceptions
-            if wmi_connect_retry > 0:
-                self._logger.error(
-                    'Error connecting to WMI (will retry): %s', exc
-                )
+            self.session_id, session = self._open_xenstore_session(
+                session_id=self.session_id,
+                wmi_connect_retry=wmi_connect_retry
+            )
+        except UnknownSessionError as exc:
+            self.supervisor.emit(SESSION_LOST, error=exc)
+            self.session_id, session = self._open_xenstore_session(
+                wmi_connect_retry=wmi_connect_retry
+            )
+        self._session_thread = threading.current_thread()
+        return session
 
-                sleep(WMI_CONNECT_RETRY_DELAY)
-                return self._get_xenstore_session(
-                    wmi_connect_retry=(wmi_connect_retry - 1)
-                )
+    def _supervisor_event(self, event):
+        """
+        Log & count the events of the supervisor.
+        """
+        if event.kind == RETRYING:
+            self._logger.error(
+                'Error connecting to WMI (will retry in %.2fs): %s',
+                event.delay, event.error
+            )
+            self.metrics.increment('wmi_connect_retries')
+        elif event.kind == GAVE_UP:
+            self._logger.error(
+                'Giving up connecting to WMI after %d attempts',
+                event.attempt
+            )
+        elif event.kind == CIRCUIT_OPEN:
+            self._logger.warning(
+                'Connecting to WMI keeps failing, not retrying for %ss',
+                self.supervisor.breaker.reset_timeout
+            )
+            self.metrics.increment('circuit_opened')
+        elif event.kind == RECOVERED:
+            self._logger.info(
+                'Connected to WMI after %d failed attempts', event.attempt
+            )
+        elif event.kind == SESSION_LOST:
+            self._logger.warning(
+                'The XenProjectXenStoreSession has gone: %s', event.error
+            )
+            self.metrics.increment('sessions_lost')
+        elif event.kind == REPLAYED:
+            self.metrics.increment('replayed_requests')
+
+    def _connect_wmi(self):
+        return _wmi_namespace()
 
+    def _open_xenstore_session(self, session_id=None, wmi_connect_retry=20):
+        """
+        Return the SessionId & XenProjectXenStoreSession of the session with
+        session_id, or of a new (or with reattach, reattached) session. The
+        caller becomes a user of the session & must _release_session() it.
+        """
+        # Create a WMI Session
+        try:
+            wmi_session, xenstore_base = self.supervisor.run(
+                self._connect_wmi, retries=wmi_connect_retry
+            )
+        except CircuitOpenError:
+            raise
+        except Exception as exc:  # WMI can raise all sorts of exceptions
             self._logger.exception('Failed connecting to WMI:')
             six.raise_from(
                 pyxs.PyXSError("Initialising WMI connection failed"), exc
             )
 
-        if self.session_id is None:
+        if session_id is None and self.reattach:
+            session_id, session = self._reattach_session(wmi_session)
+            if session is not None:
+                return session_id, session
+
+        if session_id is None:
             self._logger.debug('Adding a new XenProjectXenStoreSession')
-            self.session_id = xenstore_base.AddSession(Id=self.session_name)[0]
+            try:
+                session_id = xenstore_base.AddSession(Id=self.session_name)[0]
+            except Exception:
+                # The cached WMI connection may be the problem
+                _wmi_namespace.clear()
+                raise
+            self.metrics.increment('sessions_added')
+
+        session = self._lookup_session(wmi_session, session_id)
+        _claim_session(session_id)
+        return session_id, session
+
+    def _reattach_session(self, wmi_session):
+        """
+        Claim an existing session named session_name which is not used by
+        this process. Returns (None, None) if there is none.
+        """
+        try:
+            sessions = wmi_session.query(_name_query(self.session_name))
+        except Exception:  # pylint: disable=W0703
+            self._logger.warning(
+                'Failed finding XenProjectXenStoreSessions named %s',
+                self.session_name, exc_info=True
+            )
+            return None, None
+
+        with _SESSION_USERS_LOCK:
+            for session in sessions:
+                if session.SessionId not in _SESSION_USERS:
+                    _SESSION_USERS[session.SessionId] = 1
+                    break
+            else:
+                return None, None
 
-        wmi_query = WMI_QUERY_TEMPLATE.format(id=self.session_id)
+        self._logger.debug(
+            'Reattached to XenProjectXenStoreSession %s', session.SessionId
+        )
+        self.metrics.increment('sessions_reattached')
+        return session.SessionId, session
+
+    def _lookup_session(self, wmi_session, session_id):
+        wmi_query = WMI_QUERY_TEMPLATE.format(id=session_id)
 
         try:
             sessions = wmi_session.query(wmi_query)
@@ -95,7 +750,8 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
             self._logger.warning((
                 'Failed finding the XenProjectXenStoreSession with '
                 'SessionId=%s (will retry)'
-            ), self.session_id)
+            ), session_id)
+            self.metrics.increment('wmi_query_retries')
             sleep(WMI_QUERY_RETRY_DELAY)
 
             try:
@@ -104,8 +760,9 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
                 self._logger.exception((
                     'Failed finding the XenProjectXenStoreSession with '
                     'SessionId=%s:'
-                ), self.session_id)
+                ), session_id)
 
+                _wmi_namespace.clear()
                 six.raise_from(
                     pyxs.PyXSError("Unable to query for WMI session"), exc
                 )
@@ -114,11 +771,219 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
             return sessions[0]
         except IndexError:
             raise UnknownSessionError(
-                "No session with SessionId={}".format(self.session_id)
+                "No session with SessionId={}".format(session_id)
             )
 
+    def _start_workers(self, wmi_connect_retry=20):
+        """
+        Start one _SessionWorker per session & wait for all of them to have
+        created their XenProjectXenStoreSession. If any worker fails the
+        others are stopped and the error is raised.
+        """
+        workers = [
+            _SessionWorker(self, index, wmi_connect_retry=wmi_connect_retry)
+            for index in range(self.sessions)
+        ]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.ready.wait()
+
+        failed = [worker for worker in workers if worker.error is not None]
+        if failed:
+            for worker in workers:
+                if worker.error is None:
+                    worker.stop()
+            raise failed[0].error
+
+        self._logger.debug('Started %d session workers', len(workers))
+        self._workers = workers
+
+    def _stop_workers(self):
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+    def _queue_depth(self):
+        """
+        Return the number of requests waiting for a session worker (or in
+        the scheduler) plus the number of responses waiting for recv().
+        """
+        depth = sum(worker.packets.qsize() for worker in self._workers)
+        if self.scheduler is not None:
+            depth += len(self.scheduler)
+        if self.response_packets is not None:
+            depth += len(self.response_packets)
+        return depth
+
+    def _watch_count(self):
+        poller = self._watch_poller
+        return len(poller) if poller is not None else 0
+
+    def _open_watch_reader(self):
+        """
+        Open the session used by the watch poller thread.
+        """
+        pythoncom.CoInitialize()
+        try:
+            session_id, session = self._open_xenstore_session()
+        except Exception:
+            _wmi_namespace.clear()
+            pythoncom.CoUninitialize()
+            raise
+
+        def _close():
+            try:
+                if _release_session(session_id):
+                    session.EndSession()
+            except wmi.x_wmi:
+                self._logger.debug('Session %s had already gone', session_id)
+            finally:
+                _wmi_namespace.clear()
+                pythoncom.CoUninitialize()
+
+        return _SessionReader(session, _close)
+
+    def _fire_watch(self, path, token):
+        """
+        Deliver a WATCH_EVENT to recv(). Called by the watch poller.
+        """
+        packet = Packet(Op.WATCH_EVENT, path + NUL + token + NUL, 0)
+        response_packets = self.response_packets
+        if response_packets is not None:
+            response_packets.put(packet)
+
+    def _execute_watch(self, session, packet):
+        """
+        Add or remove an emulated watch.
+        """
+        path, token = packet.payload.split(NUL)[:2]
+        if path.startswith(b'@'):
+            # Special watches (@introduceDomain etc.) cannot be polled for
+            return _error_packet(packet, errno.ENOSYS)
+
+        with self._watch_lock:
+            poller = self._watch_poller
+            if poller is None and packet.op == Op.WATCH:
+                poller = self._watch_poller = WatchPoller(
+                    self._open_watch_reader, self._fire_watch,
+                    min_interval=WATCH_POLL_MIN_INTERVAL,
+                    max_interval=WATCH_POLL_MAX_INTERVAL,
+                    metrics=self.metrics,
+                    name='{0}-watches'.format(self.session_name)
+                )
+
+        if packet.op == Op.WATCH:
+            poller.watch(_SessionReader(session), path, token)
+        elif poller is None or not poller.unwatch(path, token):
+            return _error_packet(packet, errno.ENOENT)
+
+        return _reply(packet, b'OK' + NUL)
+
+    def _execute_transaction(self, session, packet):
+        """
+        Start or end an emulated transaction or execute a request made
+        inside one.
+        """
+        if packet.op == Op.TRANSACTION_START:
+            with self._transaction_lock:
+                tx_id = next(self._transaction_ids)
+                self._transactions[tx_id] = Transaction(tx_id)
+            self.metrics.increment('transactions')
+            return _reply(packet, str(tx_id).encode('ascii') + NUL)
+
+        with self._transaction_lock:
+            transaction = self._transactions.get(packet.tx_id)
+            if packet.op == Op.TRANSACTION_END:
+                self._transactions.pop(packet.tx_id, None)
+        if transaction is None:
+            return _error_packet(packet, errno.ENOENT)
+
+        reader = _SessionReader(session)
+        with transaction.lock:
+            if packet.op == Op.TRANSACTION_END:
+                if packet.payload.rstrip(NUL) == b'T':
+                    return self._commit(session, reader, transaction, packet)
+                result = b'OK'
+            elif packet.op == Op.READ:
+                result = transaction.read(reader, _packet_path(packet))
+            elif packet.op == Op.WRITE:
+                transaction.write(*_split_payload(packet.payload))
+                result = b'OK'
+            elif packet.op == Op.RM:
+                result = b'OK' if transaction.remove(
+                    reader, _packet_path(packet)
+                ) else None
+            elif packet.op == Op.DIRECTORY:
+                result = transaction.directory(reader, _packet_path(packet))
+                if result is not None:
+                    result = NUL.join(result)
+                    if len(result) > XENSTORE_PAYLOAD_MAX:
+                        return _error_packet(packet, errno.E2BIG)
+            else:
+                raise NotImplementedError(
+                    "Unsupported XenStore Action ({x})".format(x=packet.op)
+                )
+
+        if result is None:
+            return _error_packet(packet, errno.ENOENT)
+        return _reply(packet, result)
+
+    def _commit(self, session, reader, transaction, packet):
+        """
+        Check an emulated transaction for conflicts & write out its changes.
+        """
+        with _COMMIT_LOCK:
+            conflicts = transaction.conflicts(reader)
+            if conflicts:
+                self._logger.debug(
+                    'Transaction %d conflicts on %s', transaction.tx_id,
+                    conflicts
+                )
+                self.metrics.increment('transaction_conflicts')
+                return _error_packet(packet, errno.EAGAIN)
+
+            for path, value in transaction.mutations:
+                try:
+                    if value is None:
+                        session.RemoveValue(_to_wmi(path))
+                    else:
+                        session.SetValue(_to_wmi(path), _to_wmi(value))
+                except wmi.x_wmi:
+                    self._logger.exception(
+                        'Failed committing transaction %d', transaction.tx_id
+                    )
+                    return _error_packet(packet, errno.EIO)
+                finally:
+                    if self.cache is not None:
+                        self.cache.invalidate(
+                            path, recursive=(value is None)
+                        )
+
+        return _reply(packet, b'OK')
+
     def __copy__(self):
-        return self.__class__()
+        """
+        Return a new connection with the same settings, sharing the
+        metrics, tracer & supervisor of this one (the gauges of the metrics
+        then report the copy). Once connected it uses the session of this
+        connection (if it has a single one) rather than adding another. The
+        write_behind & scheduler are not copied as each belongs to a single
+        connection.
+        """
+        connection = self.__class__(
+            xs_session_name=self.session_name, sessions=self.sessions,
+            cache=self.cache, metrics=self.metrics, tracer=self.tracer,
+            supervisor=self.supervisor, reattach=self.reattach,
+            thread_sessions=self.thread_sessions
+        )
+        # The events of the supervisor are already logged & counted in the
+        # shared metrics by this connection
+        connection.supervisor.remove_listener(connection._supervisor_event)
+        if not self._workers:
+            connection.session_id = self.session_id
+        return connection
 
     @property
     def is_connected(self):
@@ -126,7 +991,8 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
         Return whether this connection is currently active & connected to
         xenstore via the XenProjectXenStoreSession.
         """
-        return self.session is not None
+        return self.session is not None or bool(self._workers) \
+            or bool(self._thread_owners)
 
     def fileno(self):
         """
@@ -134,41 +1000,290 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
         when selecting on this object it will return when data becomes
         available.
         """
-        return self.r_terminator.fileno()
+        return self.response_packets.fileno()
+
+    @classmethod
+    def probe(cls):
+        """
+        Check that the WMI interface of the WinPV drivers is available,
+        raising pyxs.PyXSError if not. Unlike connect() this does not retry
+        or add a XenProjectXenStoreSession.
+        """
+        pythoncom.CoInitialize()
+        try:
+            try:
+                wmi_session = wmi.WMI(
+                    moniker="//./root/wmi", find_classes=False
+                )
+                bases = wmi_session.XenProjectXenStoreBase()
+            except Exception as exc:  # WMI can raise all sorts of exceptions
+                six.raise_from(
+                    pyxs.PyXSError("Initialising WMI connection failed"), exc
+                )
+
+            if not bases:
+                raise pyxs.PyXSError("No XenProjectXenStoreBase found")
+        finally:
+            pythoncom.CoUninitialize()
 
     def connect(self, wmi_connect_retry=20):
         """
         Connect the WMI session ready for commands to be sent using this
         connection. Because there can be connection issues here this method
-        will retry the connection by default. This can be disabled by passing
+        will retry the connection (with backoff, until the deadline of the
+        supervisor) by default. This can be disabled by passing
         wmi_connect_retry=0 and the number of retries is configurable through
-        this parameter.
+        this parameter. Raises win_pyxs.exceptions.CircuitOpenError without
+        trying if connecting has recently kept failing.
         """
         if self.is_connected:
             return
 
-        if not self.response_packets:
-            self.response_packets = Queue()
+        if self.response_packets is None:
+            self.response_packets = _ResponseQueue()
 
-        if not self.r_terminator or not self.w_terminator:
-            self.r_terminator, self.w_terminator = socket.socketpair()
+        if self.sessions > 1:
+            self._start_workers(wmi_connect_retry=wmi_connect_retry)
+        elif self.thread_sessions:
+            self._thread_session(wmi_connect_retry=wmi_connect_retry)
+        else:
+            self.session = self._get_xenstore_session(
+                wmi_connect_retry=wmi_connect_retry
+            )
 
-        self.session = self._get_xenstore_session(
-            wmi_connect_retry=wmi_connect_retry
-        )
+        if self._connects:
+            self.metrics.increment('reconnects')
+        self._connects += 1
+
+        if self.scheduler is not None:
+            self.scheduler.attach(self._dispatch, metrics=self.metrics)
+        if self.write_behind is not None:
+            self.write_behind.attach(
+                self._send_many, release=self.release_thread
+            )
 
     def send(self, packet):
         """
         Emulates sending a packet to xenstore by calling the equivalent WMI
         method on the XenProjectXenStoreSession WMI object. Only a few
         operations (READ, WRITE, RM, DIRECTORY) because that is all that is
-        available using the WMI interface. Because the result of the WMI call
-        is the equivalent of the packet received from xenstore in the Linux
-        device/socket code this method stores it in a FIFO queue for later
-        to be returned by the recv() method.
+        available using the WMI interface (WATCH & UNWATCH are emulated by
+        polling). Because the result of the WMI call is the equivalent of the
+        packet received from xenstore in the Linux device/socket code this
+        method stores it in a FIFO queue for later to be returned by the
+        recv() method. When using more than one session
+        the packet is instead queued for a worker (through the scheduler if
+        there is one) & the response is stored once the WMI call completes.
+        """
+        self._ensure_connected()
+
+        self.tracer.sent(packet)
+        self.metrics.request_sent(packet)
+        try:
+            item = self._submit(packet)
+            if item is None:
+                return
+
+            if self.scheduler is not None:
+                self.scheduler.submit(packet, item)
+            elif self._workers:
+                self._workers[self._worker_index(packet)].packets.put([item])
+            else:
+                self._deliver(self._run_or_error(self._owner(), *item))
+        except BaseException:
+            self.metrics.request_failed(packet)
+            self.tracer.failed(packet)
+            raise
+
+    def send_many(self, packets):
+        """
+        Send a batch of request packets. This behaves like calling send() for
+        each packet but the batch is handed to the session workers in one go
+        (one queue operation per worker rather than per packet) and a failure
+        to send one packet does not prevent the rest from being sent.
+
+        Returns a dict mapping the rq_id of each packet which could not be
+        sent to the exception raised. No response will be received for these
+        packets.
+        """
+        return self._send_many(packets)
+
+    def _send_many(self, packets):
+        # The WriteBehind flushes through this rather than send_many() so
+        # that wrappers of it (such as the PacketRecorder) only see the
+        # requests made by the application
+        self._ensure_connected()
+
+        failures, batches = {}, {}
+        for packet in packets:
+            self.tracer.sent(packet)
+            self.metrics.request_sent(packet)
+            try:
+                item = self._submit(packet)
+                if item is None:
+                    continue
+
+                if self.scheduler is not None:
+                    self.scheduler.submit(packet, item)
+                elif self._workers:
+                    batches.setdefault(self._worker_index(packet), []) \
+                        .append(item)
+                else:
+                    self._deliver(self._run_or_error(self._owner(), *item))
+            except (pyxs.PyXSError, NotImplementedError) as exc:
+                self.metrics.request_failed(packet)
+                self.tracer.failed(packet)
+                failures[packet.rq_id] = exc
+
+        for index, items in batches.items():
+            self._workers[index].packets.put(items)
+
+        return failures
+
+    def _dispatch(self, items):
+        """
+        Queue the (packet, epoch) work items released by the scheduler for
+        the session workers. Their senders have already returned so the
+        requests which cannot be queued are answered with an EIO error.
+        """
+        workers = self._workers
+        if not workers:
+            for packet, _epoch in items:
+                self._deliver(_error_packet(packet))
+            return
+
+        queued = set()
+        try:
+            batches = {}
+            for item in items:
+                batches.setdefault(
+                    self._worker_index(item[0]), []
+                ).append(item)
+            for index, batch in batches.items():
+                workers[index].packets.put(batch)
+                queued.update(packet.rq_id for packet, _epoch in batch)
+        except Exception:  # pylint: disable=W0703
+            self._logger.exception('Failed queueing scheduled requests:')
+            for packet, _epoch in items:
+                if packet.rq_id not in queued:
+                    self._deliver(_error_packet(packet))
+
+    def execute(self, packet):
+        """
+        Execute a request packet in the calling thread & return its response
+        packet (which is an Op.ERROR packet if xenstore refused the request)
+        rather than queueing it for recv(). With thread_sessions=True this
+        takes no lock shared with other threads so independent requests from
+        several threads are made in parallel. Cannot be used with
+        sessions > 1.
+        """
+        if self._workers:
+            raise NotImplementedError(
+                'execute() cannot be used with session workers'
+            )
+        self._ensure_connected()
+
+        self.tracer.sent(packet)
+        self.metrics.request_sent(packet)
+        responses = []
+        try:
+            item = self._submit(packet, deliver=responses.append)
+            if item is not None:
+                responses.append(self._run_or_error(self._owner(), *item))
+        except BaseException:
+            self.metrics.request_failed(packet)
+            self.tracer.failed(packet)
+            raise
+
+        response = responses[0]
+        self.metrics.reply_ready(response)
+        self.metrics.reply_received(response)
+        self.tracer.received(response)
+        return response
+
+    def _owner(self):
+        """
+        Return the owner of the session requests sent by the calling thread
+        are executed with: this connection or the thread's _ThreadSession.
+        """
+        if self.thread_sessions:
+            return self._thread_session()
+        return self
+
+    def _thread_session(self, wmi_connect_retry=20):
+        """
+        Return the _ThreadSession of the calling thread, initialising COM &
+        opening its session the first time the thread uses the connection.
+        """
+        owner = getattr(self._local, 'owner', None)
+        if owner is not None and owner.session is not None:
+            return owner
+
+        if owner is None:
+            owner = _ThreadSession(threading.current_thread())
+            pythoncom.CoInitialize()
+        # Otherwise close() ended the session from another thread, leaving
+        # COM initialised on this one
+        try:
+            owner.session_id, owner.session = self._open_xenstore_session(
+                wmi_connect_retry=wmi_connect_retry
+            )
+        except Exception:
+            self._local.owner = None
+            _wmi_namespace.clear()
+            pythoncom.CoUninitialize()
+            raise
+
+        with self._thread_owners_lock:
+            self._thread_owners.append(owner)
+        self._local.owner = owner
+        self.metrics.increment('thread_sessions')
+        return owner
+
+    def _end_thread_session(self, owner):
+        """
+        End the session of a _ThreadSession from its own thread & undo the
+        COM initialisation done by _thread_session().
+        """
+        try:
+            if _release_session(owner.session_id):
+                owner.session.EndSession()
+        except wmi.x_wmi:
+            self._logger.debug('Session %s had already gone', owner.session_id)
+        finally:
+            owner.session = None
+            _wmi_namespace.clear()
+            pythoncom.CoUninitialize()
+
+    def release_thread(self):
+        """
+        End the session of the calling thread (with thread_sessions=True).
+        Call this before a thread which used the connection exits, otherwise
+        its session is only ended when the connection is closed & COM stays
+        initialised on the thread. The thread gets a new session if it sends
+        another request.
         """
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            return
+        self._local.owner = None
+
+        with self._thread_owners_lock:
+            ended = owner not in self._thread_owners
+            if not ended:
+                self._thread_owners.remove(owner)
+
+        if ended:
+            # The session was ended by close() from another thread but COM is
+            # still initialised on this one
+            _wmi_namespace.clear()
+            pythoncom.CoUninitialize()
+        else:
+            self._end_thread_session(owner)
+
+    def _ensure_connected(self):
         try:
-            if not self.session:
+            if not self.is_connected:
                 self._logger.debug(
                     'Attempt to send without a connection - connecting now'
                 )
@@ -176,55 +1291,235 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
         except wmi.x_wmi as exc:
             six.raise_from(pyxs.PyXSError, exc)
 
-        self._logger.debug('Sending packet to xenstore: %s', packet)
+    def _worker_index(self, packet):
+        # Packets for the same path always go to the same worker so that
+        # they are executed in the order they were sent
+        return hash(_packet_path(packet)) % len(self._workers)
+
+    def _submit(self, packet, deliver=None):
+        """
+        Check a packet can be sent & answer it from the cache if possible.
+        Returns the (packet, epoch) work item to execute or None if the
+        response has already been passed to deliver (by default _deliver()).
+        """
+        if self._workers and packet.op not in _WMI_OPS + _EMULATED_OPS:
+            raise NotImplementedError(
+                "Unsupported XenStore Action ({x})".format(x=packet.op)
+            )
+
+        if self.write_behind is not None:
+            payload = self.write_behind.submit(packet)
+            if payload is not None:
+                (deliver or self._deliver)(_reply(packet, payload))
+                return None
+
+        epoch = None
+        if self.cache is not None and packet.op in _WMI_OPS \
+                and not packet.tx_id:
+            if self._send_cached(packet, deliver or self._deliver):
+                return None
+            epoch = self.cache.epoch
+
+        return packet, epoch
+
+    def _send_cached(self, packet, deliver):
+        """
+        Answer a READ or DIRECTORY from the cache if possible, returning True
+        if the response has been passed to deliver. WRITE & RM requests
+        invalidate the cache before they are sent.
+        """
+        path = _packet_path(packet)
+        if packet.op not in _CACHED_OPS:
+            self.cache.invalidate(path, recursive=(packet.op == Op.RM))
+            return False
+
+        entry = self.cache.get(packet.op, path)
+        if entry is None:
+            return False
+
+        if entry.missing:
+            deliver(_error_packet(packet, errno.ENOENT))
+        else:
+            deliver(_reply(packet, entry.payload))
+
+        return True
+
+    def _session_lost(self, session_id):
+        """
+        Return whether the session with session_id no longer exists.
+        """
+        try:
+            return not _wmi_namespace()[0].query(
+                WMI_QUERY_TEMPLATE.format(id=session_id)
+            )
+        except Exception:  # pylint: disable=W0703
+            # WMI itself is unavailable so a new session will be needed
+            self._logger.debug('Unable to look for session %s', session_id)
+            _wmi_namespace.clear()
+            return True
+
+    def _should_probe(self, session_id, exc):
+        """
+        Return whether to look for the session with session_id after a
+        request failed with exc (see SESSION_PROBE_INTERVAL).
+        """
+        if _error_code(exc) != errno.ENOENT:
+            return True
+
+        now = _clock()
+        probed = self._probed.get(session_id)
+        if probed is not None and now - probed < SESSION_PROBE_INTERVAL:
+            return False
+        self._probed[session_id] = now
+        return True
+
+    def _run_or_error(self, owner, packet, epoch=None):
+        """
+        Like _run_packet() but a failed request is answered with the Op.ERROR
+        reply xenstore would send, so that a request fails the same way
+        whether it is executed by send() or by a session worker.
+        """
+        try:
+            return self._run_packet(owner, packet, epoch)
+        except pyxs.PyXSError as exc:
+            self._logger.debug('Request %s failed: %s', packet, exc)
+            return _error_packet(packet, _error_code(exc))
+
+    def _run_packet(self, owner, packet, epoch=None):
+        """
+        Process a packet using the session of owner (this connection or a
+        _SessionWorker). If the request fails because the session has gone
+        a new one is created & READ & DIRECTORY requests are repeated. After
+        an ENOENT the session is only looked for once per
+        SESSION_PROBE_INTERVAL.
+        """
+        try:
+            return self._process(owner.session, packet, epoch)
+        except pyxs.PyXSError as exc:
+            if owner.session_id is None or not self._should_probe(
+                owner.session_id, exc
+            ) or not self._session_lost(owner.session_id):
+                raise
+            lost = exc
+
+        self.supervisor.emit(SESSION_LOST, error=lost)
+        self._probed.pop(owner.session_id, None)
+        _release_session(owner.session_id)
+        owner.session_id, owner.session = self._open_xenstore_session()
+        if owner is self:
+            self._session_thread = threading.current_thread()
+        if packet.op not in _REPLAYABLE_OPS:
+            raise lost
+
+        self.supervisor.emit(REPLAYED, error=lost)
+        return self._process(owner.session, packet, epoch)
+
+    def _process(self, session, packet, epoch=None):
+        """
+        Execute a request packet & keep the cache up to date with the result.
+        The epoch is the cache epoch at the time the packet was sent.
+        """
+        if self.cache is None or packet.op not in _WMI_OPS or packet.tx_id:
+            return self._execute(session, packet)
+
+        path = _packet_path(packet)
+        try:
+            response = self._execute(session, packet)
+        except pyxs.PyXSError:
+            if packet.op in _CACHED_OPS:
+                self.cache.put_missing(packet.op, path, epoch)
+            raise
+
+        if response.op == Op.ERROR:
+            return response
+
+        if packet.op in _CACHED_OPS:
+            self.cache.put(packet.op, path, response.payload, epoch)
+        else:
+            # Drop anything read while this request was in flight
+            self.cache.invalidate(path, recursive=(packet.op == Op.RM))
+
+        return response
+
+    def _execute(self, session, packet):
+        """
+        Make the WMI call equivalent to a request packet on the given
+        XenProjectXenStoreSession & return the response packet.
+        """
+        if packet.op in _WATCH_OPS:
+            return self._execute_watch(session, packet)
+        if packet.op in _TRANSACTION_OPS or packet.tx_id:
+            return self._execute_transaction(session, packet)
 
         if packet.op == Op.READ:
             try:
-                result = self.session.GetValue(packet.payload)[0]
+                result = session.GetValue(_to_wmi(_packet_path(packet)))[0]
             except wmi.x_wmi as exc:
-                six.raise_from(
-                    pyxs.PyXSError("session.GetValue call failed"), exc
-                )
+                six.raise_from(pyxs.PyXSError(
+                    _wmi_errno(exc), "session.GetValue call failed"
+                ), exc)
+
+            result = _from_wmi(result)
         elif packet.op == Op.WRITE:
-            payload = packet.payload.split('\x00', 1)
+            payload = _split_payload(packet.payload)
 
             try:
-                self.session.SetValue(payload[0], payload[1])
+                session.SetValue(_to_wmi(payload[0]), _to_wmi(payload[1]))
             except wmi.x_wmi as exc:
-                six.raise_from(
-                    pyxs.PyXSError("session.SetValue call failed"), exc
-                )
+                six.raise_from(pyxs.PyXSError(
+                    _wmi_errno(exc), "session.SetValue call failed"
+                ), exc)
 
-            result = "OK"
+            result = b"OK"
         elif packet.op == Op.RM:
             try:
-                self.session.RemoveValue(packet.payload)[0]
+                session.RemoveValue(_to_wmi(_packet_path(packet)))
             except wmi.x_wmi as exc:
-                six.raise_from(
-                    pyxs.PyXSError("session.RemoveValue call failed"), exc
-                )
+                six.raise_from(pyxs.PyXSError(
+                    _wmi_errno(exc), "session.RemoveValue call failed"
+                ), exc)
 
-            result = "OK"
+            result = b"OK"
         elif packet.op == Op.DIRECTORY:
             try:
-                result = self.session.GetChildren(packet.payload)[0].childNodes
+                result = session.GetChildren(
+                    _to_wmi(_packet_path(packet))
+                )[0].childNodes
             except wmi.x_wmi as exc:
-                six.raise_from(
-                    pyxs.PyXSError("session.GetChildren call failed"), exc
-                )
+                six.raise_from(pyxs.PyXSError(
+                    _wmi_errno(exc), "session.GetChildren call failed"
+                ), exc)
 
-            result = "\x00".join(result)
+            result = _join_children(result)
+            if len(result) > XENSTORE_PAYLOAD_MAX:
+                # xenstored refuses to send listings which do not fit in a
+                # single packet so do the same rather than fail in _reply()
+                return _error_packet(packet, errno.E2BIG)
         else:
             raise NotImplementedError(
                 "Unsupported XenStore Action ({x})".format(x=packet.op)
             )
 
-        self.response_packets.put(
-            Packet(packet.op, result, packet.rq_id, packet.tx_id)
-        )
+        return _reply(packet, result)
+
+    def _deliver(self, packet):
+        """
+        Store a response packet for recv() & notify the Router that there is
+        data available. This is safe to call from the session workers.
+        Replies to the writes flushed by the WriteBehind go to it instead.
+        """
+        if self.scheduler is not None:
+            self.scheduler.completed(packet)
+
+        if self.write_behind is not None \
+                and self.write_behind.completed(packet):
+            self.metrics.reply_ready(packet)
+            self.metrics.reply_received(packet)
+            self.tracer.received(packet)
+            return
 
-        # Notify that data is available
-        self.w_terminator.sendall(NUL)
+        self.metrics.reply_ready(packet)
+        self.response_packets.put(packet)
 
     def recv(self):
         """
@@ -233,28 +1528,106 @@ class XenBusConnectionWinPV(pyxs.connection.PacketConnection):
         the WMI call) so it is already written to a queue for this method to
         read.
         """
-        self.r_terminator.recv(1)
-        return self.response_packets.get(False)
+        packet = self.response_packets.get()
+        self.metrics.reply_received(packet)
+        self.tracer.received(packet)
+        return packet
+
+    def _end_session(self):
+        """
+        End the session of this connection: directly if called by the thread
+        which opened it, otherwise through a new WMI connection (see the
+        class docstring).
+        """
+        self._logger.debug('Closing XenProjectXenStoreSession using WMI')
+        if self._session_thread is threading.current_thread():
+            # The thread which opened the session can use it directly
+            try:
+                self.session.EndSession()
+            except wmi.x_wmi:
+                self._logger.debug('The session had already gone')
+            return
+
+        self._end_sessions_elsewhere([self.session_id])
+
+    def _end_sessions_elsewhere(self, session_ids):
+        """
+        End sessions opened by other threads. They have to be found again
+        from this thread's apartment to be used.
+        """
+        pythoncom.CoInitialize()
+        try:
+            wmi_session = _connect_wmi()[0]
+            for session_id in session_ids:
+                try:
+                    self._lookup_session(wmi_session, session_id).EndSession()
+                except (UnknownSessionError, wmi.x_wmi):
+                    self._logger.debug(
+                        'Session %s had already gone', session_id
+                    )
+        except wmi.x_wmi:
+            self._logger.debug('Unable to end sessions %s', session_ids)
+        finally:
+            pythoncom.CoUninitialize()
+
+    def _close_thread_sessions(self):
+        with self._thread_owners_lock:
+            owners, self._thread_owners = self._thread_owners, []
+
+        # The other threads keep their _ThreadSession (with no session) so
+        # that they undo their COM initialisation when they next open a
+        # session or call release_thread(), rather than initialising again
+        elsewhere = []
+        for owner in owners:
+            if owner.thread is threading.current_thread():
+                self._local.owner = None
+                self._end_thread_session(owner)
+            else:
+                if _release_session(owner.session_id):
+                    elsewhere.append(owner.session_id)
+                owner.session = None
+
+        if elsewhere:
+            self._logger.debug(
+                'Ending the sessions of %d other threads', len(elsewhere)
+            )
+            self._end_sessions_elsewhere(elsewhere)
 
     def close(self, silent=True):  # pylint disable=W0613
         """
         Close the sockets used to notify pyxs when data is ready & cleanup the
         WMI session used to query xenstore.
         """
-        self._logger.debug('Closing XenProjectXenStoreSession using WMI')
-        pythoncom.CoInitialize()
-        session = self._get_xenstore_session()
-        session.EndSession()
-        self.session = None
-        pythoncom.CoUninitialize()
+        if self.write_behind is not None and self.is_connected:
+            self._logger.debug('Flushing buffered writes')
+            self.write_behind.detach()
+
+        if self.scheduler is not None:
+            self._logger.debug('Sending scheduled requests')
+            self.scheduler.detach()
+
+        if self._watch_poller is not None:
+            self._logger.debug('Stopping the watch poller')
+            self._watch_poller.stop()
+            self._watch_poller = None
+
+        if self._workers:
+            self._logger.debug('Stopping session workers')
+            self._stop_workers()
+
+        with self._transaction_lock:
+            self._transactions.clear()
+
+        self._close_thread_sessions()
+
+        if self.session_id is not None:
+            if _release_session(self.session_id):
+                self._end_session()
+            self.session = self.session_id = None
+            self._session_thread = None
 
         self._logger.debug(
             'Shutting down socket used to notify Router of readiness'
         )
-        self.r_terminator.shutdown(socket.SHUT_RDWR)
-
-        self.r_terminator.close()
-        self.w_terminator.close()
-
+        self.response_packets.close()
         self.response_packets = None
-        self.r_terminator = self.w_terminator = None
@@ -0,0 +1,397 @@
+"""
+win_pyxs.workload contains the workload recorder & load generator behind the
+record, replay & load commands of python -m win_pyxs.
+
+A recording is a binary file holding every request packet sent by the
+win_pyxs connections of a program, with the time it was sent. It can be
+replayed (by any number of workers at once) to measure how a backend copes
+with a real application's traffic. Alternatively a synthetic mix of reads,
+writes & directory listings can be generated.
+"""
+
+from __future__ import print_function
+
+__all__ = [
+    'LoadReport',
+    'Operation',
+    'PacketRecorder',
+    'prepare_keys',
+    'read_recording',
+    'recorded_operations',
+    'run_workload',
+    'synthetic_operations',
+]
+
+from collections import namedtuple
+import errno
+import multiprocessing
+import random
+import struct
+import threading
+import time
+
+import pyxs
+from pyxs._internal import NUL, Op
+
+from .metrics import op_name
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# magic, version
+_HEADER = struct.Struct('<4sH')
+_MAGIC = b'WPXR'
+_VERSION = 1
+
+# seconds since recording started, op, tx_id, payload size
+_RECORD = struct.Struct('<dIII')
+
+#: The requests which can be replayed without the state of a transaction
+#: or watch, or side effects on other domains
+REPLAYABLE_OPS = (Op.READ, Op.WRITE, Op.MKDIR, Op.RM, Op.DIRECTORY)
+
+#: A request to make: the time it is due (seconds from the start of the
+#: run), the op & the payload
+Operation = namedtuple('Operation', 'offset op payload')
+
+
+class PacketRecorder(object):
+    """
+    Records the request packets sent through XenBusConnectionWinPV &
+    XenBusConnectionGPLPV while installed.
+
+    :param path: The file to write the recording to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.packets = 0
+
+        self._file = None
+        self._saved = None
+        self._started = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def record(self, packet):
+        offset = _clock() - self._started
+        data = _RECORD.pack(offset, packet.op, packet.tx_id, packet.size) \
+            + packet.payload
+        with self._lock:
+            self._file.write(data)
+            self.packets += 1
+
+    def install(self):
+        """
+        Start recording by wrapping send() of the connection classes (&
+        send_many() & execute() where they have them).
+        """
+        from . import XenBusConnectionGPLPV, XenBusConnectionWinPV
+
+        self._file = open(self.path, 'wb')
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+        self._started = _clock()
+
+        self._saved = []
+        for cls in (XenBusConnectionWinPV, XenBusConnectionGPLPV):
+            for name in ('send', 'send_many', 'execute'):
+                method = cls.__dict__.get(name)
+                if method is not None:
+                    self._saved.append((cls, name, method))
+                    setattr(cls, name, self._wrap(name, method))
+
+    def _wrap(self, name, method):
+        recorder = self
+
+        if name == 'send_many':
+            def _send_many(connection, packets):
+                packets = list(packets)
+                for packet in packets:
+                    recorder.record(packet)
+                return method(connection, packets)
+
+            return _send_many
+
+        def _send(connection, packet):
+            recorder.record(packet)
+            return method(connection, packet)
+
+        return _send
+
+    def uninstall(self):
+        for cls, name, method in self._saved or []:
+            setattr(cls, name, method)
+        self._saved = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_recording(path):
+    """
+    Return the (offset, op, tx_id, payload) tuples stored in a recording.
+    """
+    with open(path, 'rb') as recording:
+        data = recording.read()
+
+    magic, version = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('Not a win_pyxs workload recording')
+
+    packets, position = [], _HEADER.size
+    while position < len(data):
+        offset, op, tx_id, size = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        packets.append((offset, op, tx_id, data[position:position + size]))
+        position += size
+
+    return packets
+
+
+def recorded_operations(path, speed=1.0, rate=None, loops=1):
+    """
+    Return the replayable Operations in a recording. With speed the
+    recorded timing is scaled (2.0 replays twice as fast, 0 as fast as
+    possible) unless rate is given, in which case requests are evenly
+    spaced at rate per second. Requests made inside a transaction &
+    operations other than REPLAYABLE_OPS are skipped.
+    """
+    packets = [
+        (offset, op, payload)
+        for offset, op, tx_id, payload in read_recording(path)
+        if op in REPLAYABLE_OPS and not tx_id
+    ]
+
+    operations = []
+    duration = packets[-1][0] if packets else 0.0
+    for loop in range(loops):
+        for offset, op, payload in packets:
+            if rate:
+                offset = len(operations) / float(rate)
+            elif speed:
+                offset = (offset + loop * duration) / speed
+            else:
+                offset = 0.0
+            operations.append(Operation(offset, op, payload))
+
+    return operations
+
+
+def synthetic_operations(
+    count, mix=None, rate=None, prefix=b'data/win_pyxs-load', keys=100,
+    value_size=32, seed=None
+):
+    """
+    Return count Operations drawn from a mix of reads, writes & directory
+    listings of keys under prefix.
+
+    :param mix: A dict mapping 'read', 'write' & 'directory' to their
+        relative weights. Defaults to 80/15/5.
+    :param rate: If given the requests are spaced at rate per second,
+        otherwise they are made as fast as possible.
+    """
+    mix = mix or {'read': 80, 'write': 15, 'directory': 5}
+    ops = {'read': Op.READ, 'write': Op.WRITE, 'directory': Op.DIRECTORY}
+    choices, weights = [], []
+    for name, weight in sorted(mix.items()):
+        if name not in ops:
+            raise ValueError('Unknown operation in mix: {0}'.format(name))
+        if weight > 0:
+            choices.append(ops[name])
+            weights.append(float(weight))
+
+    total = sum(weights)
+    generator = random.Random(seed)
+    value = b'v' * value_size
+
+    operations = []
+    for index in range(count):
+        pick, op = generator.random() * total, choices[-1]
+        for choice, weight in zip(choices, weights):
+            if pick < weight:
+                op = choice
+                break
+            pick -= weight
+
+        key = prefix + b'/' + str(generator.randrange(keys)).encode('ascii')
+        if op == Op.WRITE:
+            payload = key + NUL + value
+        elif op == Op.DIRECTORY:
+            payload = prefix + NUL
+        else:
+            payload = key + NUL
+
+        offset = index / float(rate) if rate else 0.0
+        operations.append(Operation(offset, op, payload))
+
+    return operations
+
+
+def prepare_keys(client, prefix=b'data/win_pyxs-load', keys=100):
+    """
+    Write the keys used by synthetic_operations so reads succeed.
+    """
+    for index in range(keys):
+        client.write(prefix + b'/' + str(index).encode('ascii'), b'0')
+
+
+class LoadReport(object):
+    """
+    The outcome of run_workload.
+    """
+
+    def __init__(self, latencies=None, errors=None, elapsed=0.0):
+        self.latencies = latencies or []
+        self.errors = errors or {}
+        self.elapsed = elapsed
+
+    @property
+    def operations(self):
+        return len(self.latencies) + sum(self.errors.values())
+
+    @property
+    def throughput(self):
+        return self.operations / self.elapsed if self.elapsed else 0.0
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for name, count in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    def percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+    def summary(self):
+        """
+        Return the report as a dict (latencies in seconds).
+        """
+        return {
+            'operations': self.operations,
+            'errors': dict(self.errors),
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.percentile(1.0),
+        }
+
+    def format(self):
+        summary = self.summary()
+        lines = [
+            'operations: {0}  errors: {1}  elapsed: {2:.3f}s  '
+            'throughput: {3:.1f} ops/s'.format(
+                summary['operations'], sum(self.errors.values()),
+                summary['elapsed'], summary['throughput']
+            ),
+            'latency: p50 {0:.1f}us  p90 {1:.1f}us  p99 {2:.1f}us  '
+            'max {3:.1f}us'.format(*[
+                summary[name] * 1e6 for name in ('p50', 'p90', 'p99', 'max')
+            ]),
+        ]
+        for name, count in sorted(self.errors.items()):
+            lines.append('  {0}: {1}'.format(name, count))
+        return '\n'.join(lines)
+
+
+def _error_name(exc):
+    if isinstance(exc, pyxs.PyXSError) and exc.args \
+            and exc.args[0] in errno.errorcode:
+        return errno.errorcode[exc.args[0]]
+    return exc.__class__.__name__
+
+
+def _run_operations(client, operations, started, report):
+    paced = any(operation.offset for operation in operations)
+    for operation in operations:
+        due = started + operation.offset
+        delay = due - _clock()
+        if delay > 0:
+            time.sleep(delay)
+
+        # With a target rate latency is measured from when the request was
+        # due so that a slow backend is not hidden by the requests it
+        # delayed (coordinated omission)
+        sent = due if paced else _clock()
+        try:
+            client.execute_command(operation.op, operation.payload)
+        except Exception as exc:  # pylint: disable=W0703
+            name = '{0} {1}'.format(op_name(operation.op), _error_name(exc))
+            report.errors[name] = report.errors.get(name, 0) + 1
+        else:
+            report.latencies.append(_clock() - sent)
+
+
+def _run_threads(connect, operations, threads):
+    """
+    Run the operations on each of threads threads, each with a client from
+    connect(). Returns a LoadReport.
+    """
+    clients = [connect() for _ in range(threads)]
+    reports = [LoadReport() for _ in range(threads)]
+    try:
+        started = _clock()
+        workers = [
+            threading.Thread(
+                target=_run_operations,
+                args=(client, operations, started, report)
+            ) for client, report in zip(clients, reports)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = _clock() - started
+    finally:
+        for client in clients:
+            client.close()
+
+    result = LoadReport(elapsed=elapsed)
+    for report in reports:
+        result.merge(report)
+    return result
+
+
+def _process_main(args):
+    connect, operations, threads = args
+    report = _run_threads(connect, operations, threads)
+    return report.latencies, report.errors, report.elapsed
+
+
+def run_workload(connect, operations, threads=1, processes=1):
+    """
+    Run operations on every one of threads threads in each of processes
+    processes & return a LoadReport. A target rate in the operations is
+    per thread.
+
+    :param connect: A function returning a connected pyxs.Client. It must be
+        picklable (e.g. a module-level function or functools.partial of
+        one) when processes > 1.
+    """
+    if processes <= 1:
+        return _run_threads(connect, operations, threads)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(
+            _process_main, [(connect, operations, threads)] * processes
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+    report = LoadReport()
+    for latencies, errors, elapsed in results:
+        report.merge(LoadReport(latencies, errors, elapsed))
+    return report
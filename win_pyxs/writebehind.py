@@ -0,0 +1,357 @@
+"""
+win_pyxs.writebehind contains a write-behind buffer which can be used by the
+connection classes to cut the number of xenstore writes made by agents which
+publish the same keys (such as data/* metrics) over & over again.
+
+Writes outside transactions are answered straight away & the value is kept
+in the buffer. Writing a key again before the buffer is flushed replaces the
+buffered value, so only the last one is written, & writing the value which
+was last written to a key through the buffer is dropped altogether. The
+buffer is flushed by a background thread every interval seconds, as soon as
+max_pending keys are waiting & when the connection is closed.
+
+Reads of a buffered key return the buffered value. Any other request which
+could see (or change) a buffered write, such as a DIRECTORY of its parent,
+an RM of its subtree or anything inside a transaction, first waits for the
+buffer to be flushed, so requests are answered as if the writes had been
+made when they were sent.
+
+Usage::
+
+    from win_pyxs import XenBusConnectionWinPV
+    from win_pyxs.writebehind import WriteBehind
+
+    connection = XenBusConnectionWinPV(
+        thread_sessions=True, write_behind=WriteBehind(interval=1)
+    )
+"""
+
+__all__ = ['WriteBehind']
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from pyxs._internal import NUL, Op, Packet, next_rq_id
+
+from .cache import _in_subtree
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_logger = logging.getLogger(__name__)
+
+# The operations which end (or are part of) a transaction
+_TRANSACTION_OPS = (Op.TRANSACTION_START, Op.TRANSACTION_END)
+
+
+def _related(path, other):
+    return _in_subtree(path, other) or _in_subtree(other, path)
+
+
+class WriteBehind(object):
+    """
+    A buffer of writes waiting to be sent to xenstore & of the values last
+    written to each key. A WriteBehind belongs to a single connection, which
+    attaches to it when it connects.
+
+    :param interval: The number of seconds writes are buffered for before
+        being flushed.
+    :param max_pending: The number of buffered keys which causes a flush
+        before the interval has passed.
+    :param max_age: If given, a value is written again even though it has not
+        changed once this many seconds have passed since it was last written
+        (in case something else changed the key in the meantime).
+    :param max_remembered: The maximum number of keys whose last value is
+        remembered. The least recently written key is forgotten first.
+    :param flush_timeout: How long requests which have to wait for a flush
+        (& close()) wait for the writes to complete.
+    """
+
+    def __init__(
+        self, interval=1.0, max_pending=64, max_age=None,
+        max_remembered=4096, flush_timeout=10.0, clock=_clock
+    ):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.max_remembered = max_remembered
+        self.flush_timeout = flush_timeout
+        self.clock = clock
+
+        # path -> value of the writes waiting to be flushed, the rq_id ->
+        # (path, value) of flushed writes waiting for their reply & path ->
+        # (value, time) of the values written
+        self._pending = OrderedDict()
+        self._in_flight = {}
+        self._written = OrderedDict()
+
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        # Held while a flush sends its writes so flushes cannot overtake
+        # each other
+        self._flush_lock = threading.Lock()
+
+        # The function sending a list of packets for the attached connection
+        self._send = None
+        self._release = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+        self.writes = 0
+        self.unchanged = 0
+        self.coalesced = 0
+        self.read_hits = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def avoided(self):
+        """
+        The number of writes which were not sent to xenstore.
+        """
+        return self.unchanged + self.coalesced
+
+    def attach(self, send, release=None):
+        """
+        Start flushing with send, which is passed a list of WRITE packets &
+        returns a dict mapping the rq_id of each packet which could not be
+        sent to the exception raised (like
+        XenBusConnectionWinPV.send_many()). The replies must be passed to
+        completed(). send is called from the thread of the buffer (& from
+        threads whose requests wait for a flush), which calls release (if
+        given) before it exits so that the connection can free anything it
+        set up for the thread, such as its COM apartment.
+        """
+        with self._lock:
+            self._send = send
+            self._release = release
+            self._stopping = False
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._wakeup.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='win_pyxs-write-behind'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def detach(self):
+        """
+        Flush the buffered writes, wait for them to complete & stop flushing.
+        Called when the connection closes.
+        """
+        try:
+            self.flush(wait=True)
+        except Exception:  # pylint: disable=W0703
+            _logger.exception('Failed flushing buffered writes')
+
+        with self._lock:
+            self._stopping = True
+            self._send = None
+            thread, self._thread = self._thread, None
+        self._wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                break
+
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=W0703
+                _logger.exception('Failed flushing buffered writes')
+
+        release = self._release
+        if release is not None:
+            try:
+                release()
+            except Exception:  # pylint: disable=W0703
+                _logger.exception('Failed releasing the flushing thread')
+
+    def submit(self, packet):
+        """
+        Pass a request on its way to xenstore through the buffer. Returns the
+        payload of the reply if the buffer has answered it (a WRITE or a READ
+        of a buffered key), otherwise None once any buffered writes the
+        request depends on have been flushed.
+        """
+        op, tx_id = packet.op, packet.tx_id
+        if op == Op.WATCH_EVENT:
+            return None
+
+        with self._lock:
+            if packet.rq_id in self._in_flight:
+                # Sent by flush()
+                return None
+
+        path, _sep, value = packet.payload.partition(NUL)
+        if op == Op.WRITE and not tx_id:
+            self._buffer(path, value)
+            return b'OK'
+
+        with self._lock:
+            if op == Op.READ and not tx_id and path in self._pending:
+                self.read_hits += 1
+                return self._pending[path]
+
+            if tx_id or op in _TRANSACTION_OPS:
+                barrier = bool(self._pending)
+            else:
+                barrier = any(
+                    _related(pending, path) for pending in self._pending
+                )
+
+        if barrier:
+            self.flush(wait=True)
+        if op == Op.RM or (op == Op.WRITE and tx_id):
+            self.forget(path, recursive=(op == Op.RM))
+        return None
+
+    def _buffer(self, path, value):
+        with self._lock:
+            self.writes += 1
+            replaced = path in self._pending
+            if replaced:
+                self.coalesced += 1
+                del self._pending[path]
+
+            written = self._written.get(path)
+            if written is not None and written[0] == value and (
+                self.max_age is None
+                or self.clock() - written[1] < self.max_age
+            ):
+                self.unchanged += 1
+                return
+
+            self._pending[path] = value
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self._wakeup.set()
+
+    def forget(self, path, recursive=False):
+        """
+        Forget the value last written to path (& with recursive, its subtree)
+        so that the next write of it is sent even if the value is the same.
+        """
+        with self._lock:
+            if recursive:
+                for written in [
+                    written for written in self._written
+                    if _in_subtree(written, path)
+                ]:
+                    del self._written[written]
+            else:
+                self._written.pop(path, None)
+
+    def flush(self, wait=False):
+        """
+        Send the buffered writes. With wait, also wait (up to flush_timeout
+        seconds) for every write sent by the buffer to complete. Returns the
+        number of writes sent.
+        """
+        with self._flush_lock:
+            with self._lock:
+                send = self._send
+                if send is None or not self._pending:
+                    packets = []
+                else:
+                    packets = [
+                        Packet(Op.WRITE, path + NUL + value, next_rq_id())
+                        for path, value in self._pending.items()
+                    ]
+                    for packet in packets:
+                        path, value = packet.payload.split(NUL, 1)
+                        self._in_flight[packet.rq_id] = (path, value)
+                        # Not known until the write completes
+                        self._written.pop(path, None)
+                    self._pending.clear()
+                    self.flushes += 1
+                    self.flushed += len(packets)
+
+            if packets:
+                failures = send(packets)
+                for rq_id, exc in failures.items():
+                    _logger.warning('Failed sending buffered write: %s', exc)
+                    self._failed(rq_id)
+
+        if wait:
+            deadline = self.clock() + self.flush_timeout
+            with self._lock:
+                while self._in_flight:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        _logger.warning(
+                            'Timed out waiting for %d buffered writes',
+                            len(self._in_flight)
+                        )
+                        break
+                    self._done.wait(remaining)
+
+        return len(packets)
+
+    def _failed(self, rq_id):
+        with self._lock:
+            path, _value = self._in_flight.pop(rq_id)
+            self.failures += 1
+            self._written.pop(path, None)
+            self._done.notify_all()
+
+    def completed(self, packet):
+        """
+        Record the reply to a write sent by flush(). Returns False if packet
+        is not such a reply.
+        """
+        with self._lock:
+            written = self._in_flight.pop(packet.rq_id, None)
+            if written is None:
+                return False
+
+            path, value = written
+            if packet.op == Op.ERROR:
+                _logger.warning(
+                    'Buffered write of %r failed: %r', path,
+                    bytes(bytearray(packet.payload))
+                )
+                self.failures += 1
+                self._written.pop(path, None)
+            elif all(
+                pending[0] != path for pending in self._in_flight.values()
+            ):
+                # Unless a later write of the same path is still in flight
+                self._written.pop(path, None)
+                self._written[path] = (value, self.clock())
+                while len(self._written) > self.max_remembered:
+                    self._written.popitem(last=False)
+
+            self._done.notify_all()
+        return True
+
+    def stats(self):
+        """
+        Return the buffer counters as a dict so they can be logged or
+        exported.
+        """
+        return {
+            'pending': len(self._pending),
+            'remembered': len(self._written),
+            'writes': self.writes,
+            'unchanged': self.unchanged,
+            'coalesced': self.coalesced,
+            'avoided': self.avoided,
+            'read_hits': self.read_hits,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'failures': self.failures,
+        }